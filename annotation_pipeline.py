@@ -0,0 +1,247 @@
+'''
+Pipelined annotation of many texts with a trained token classification model.
+
+The four stages of test_ner_v1.testing_function_with_model
+    parse     spaCy sentence splitting and tokenization (see spacy_cache.py)
+    encode    batches of sentences from consecutive texts, subword tokenization
+    model     forward pass and argmax
+    decode    labels of the first word piece of every word, per text, in the order of the texts
+run in their own threads, connected by bounded queues of queue_size items. spaCy and the tokenizer run ahead of the
+model, which always has the next batch waiting, and decoding (and whatever the caller does with the results, e.g.
+writing them) overlaps with the next forward pass. The throughput is then set by the slowest stage instead of the sum
+of all stages; the busy time of every stage is reported at the end, e.g.
+
+    pipeline = AnnotationPipeline(model, tokenizer, ids_to_labels, spacy_nlp, max_len=256, batch_size=32)
+    for sentences, predicted_labels in pipeline.annotate(texts):
+        ...
+    pipeline.print_utilization()
+'''
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from ner_dataset import SentenceEncoder
+from spacy_cache import pipe_sentences_and_tokens
+
+# end of the items of a stage
+_END = object()
+
+
+class StageStatistics:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.wall_seconds = 0.0
+        self.wait_seconds = 0.0  # waiting for the previous stage or for room in the queue of the next one
+
+    @property
+    def busy_seconds(self):
+        return max(self.wall_seconds - self.wait_seconds, 0.0)
+
+
+def get_sentences_and_predicted_labels(text, sentences, predicted_labels):
+    return sentences, predicted_labels
+
+
+class AnnotationPipeline:
+    '''
+    Annotate texts with model in pipelined stages (see the module docstring). With pipelined=False the stages run one
+    after another in the calling thread, e.g. to compare the throughput.
+    '''
+    def __init__(self, model, tokenizer, ids_to_labels, spacy_nlp, max_len=256, batch_size=32, queue_size=4,
+                 spacy_batch_size=32, n_process=1, device=None, pipelined=True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.encoder = SentenceEncoder(tokenizer, max_len)
+        self.label_names = np.array([ids_to_labels[i] for i in range(len(ids_to_labels))], dtype=object)
+        self.spacy_nlp = spacy_nlp
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.spacy_batch_size = spacy_batch_size
+        self.n_process = n_process
+        self.device = device if device is not None else next(model.parameters()).device
+        self.pipelined = pipelined
+        self.statistics = []
+        self.wall_seconds = 0.0
+        self._stop = threading.Event()
+        self._errors = []
+
+    def _parse(self, texts):
+        '''
+        (text, sentences) of every text
+        '''
+        pending_texts = collections.deque()
+
+        def record(texts):
+            for text in texts:
+                pending_texts.append(text)
+                yield text
+
+        for sentences in pipe_sentences_and_tokens(record(texts), self.spacy_nlp, self.spacy_batch_size,
+                                                   self.n_process):
+            yield pending_texts.popleft(), sentences
+
+    def _encode_batch(self, documents, sentence_references, words):
+        batch = {'documents': documents, 'sentences': sentence_references}
+        if words:
+            # input_ids, attention_mask and the first word piece of every word, which gets its label
+            batch.update(self.encoder.encode(words))
+        return batch
+
+    def _encode(self, parsed_documents):
+        '''
+        Batches of batch_size sentences, with the documents that start in them
+        '''
+        documents, sentence_references, words = [], [], []
+        for document_index, (text, sentences) in enumerate(parsed_documents):
+            documents.append((document_index, text, sentences))
+            for sentence_index, sentence in enumerate(sentences):
+                sentence_references.append((document_index, sentence_index))
+                words.append(' '.join(token['text'] for token in sentence).split())
+                if len(words) == self.batch_size:
+                    yield self._encode_batch(documents, sentence_references, words)
+                    documents, sentence_references, words = [], [], []
+        if documents:
+            yield self._encode_batch(documents, sentence_references, words)
+
+    def _predict(self, batches):
+        with torch.no_grad():
+            for batch in batches:
+                if batch['sentences']:
+                    outputs = self.model(input_ids=torch.as_tensor(batch['input_ids'], device=self.device),
+                                         attention_mask=torch.as_tensor(batch['attention_mask'], device=self.device))
+                    batch['predictions'] = torch.argmax(outputs[0], axis=-1).cpu().numpy()
+                yield batch
+
+    def _decode(self, batches, decode_function):
+        '''
+        decode_function(text, sentences, predicted labels of every sentence) of every document, in document order
+        '''
+        pending_documents = {}
+        next_document_index = 0
+        for batch in batches:
+            for document_index, text, sentences in batch['documents']:
+                pending_documents[document_index] = [text, sentences, [None] * len(sentences), len(sentences)]
+            for row, (document_index, sentence_index) in enumerate(batch['sentences']):
+                predictions = batch['predictions'][row][batch['first_pieces'][row]]
+                document = pending_documents[document_index]
+                document[2][sentence_index] = self.label_names[predictions].tolist()
+                document[3] -= 1
+            while next_document_index in pending_documents and pending_documents[next_document_index][3] == 0:
+                text, sentences, predicted_labels, _ = pending_documents.pop(next_document_index)
+                yield decode_function(text, sentences, predicted_labels)
+                next_document_index += 1
+
+    def _timed(self, items, statistics):
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                statistics.wait_seconds += time.perf_counter() - start
+            yield item
+
+    def _put(self, output_queue, item):
+        while not self._stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _iterate_queue(self, input_queue):
+        while True:
+            try:
+                item = input_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            if item is _END:
+                return
+            yield item
+
+    def _start_stage(self, name, stage_function, items):
+        '''
+        Run stage_function(items) in a thread; returns an iterator over its outputs
+        '''
+        statistics = StageStatistics(name)
+        self.statistics.append(statistics)
+        output_queue = queue.Queue(self.queue_size)
+
+        def run():
+            start = time.perf_counter()
+            try:
+                for item in stage_function(self._timed(items, statistics)):
+                    statistics.items += 1
+                    put_start = time.perf_counter()
+                    self._put(output_queue, item)
+                    statistics.wait_seconds += time.perf_counter() - put_start
+            except BaseException as error:
+                self._errors.append(error)
+                self._stop.set()
+            finally:
+                statistics.wall_seconds = time.perf_counter() - start
+                self._put(output_queue, _END)
+
+        threading.Thread(target=run, name='annotation-' + name, daemon=True).start()
+        return self._iterate_queue(output_queue)
+
+    def _run_stage(self, name, stage_function, items):
+        '''
+        stage_function(items) in the calling thread, timed like _start_stage
+        '''
+        statistics = StageStatistics(name)
+        self.statistics.append(statistics)
+        return self._run_timed(stage_function, items, statistics)
+
+    def _run_timed(self, stage_function, items, statistics):
+        start = time.perf_counter()
+        for item in stage_function(self._timed(items, statistics)):
+            statistics.items += 1
+            statistics.wall_seconds = time.perf_counter() - start
+            yield_start = time.perf_counter()
+            yield item
+            # the time spent by the next stages does not count for this one
+            statistics.wait_seconds += time.perf_counter() - yield_start
+        statistics.wall_seconds = time.perf_counter() - start
+
+    def annotate(self, texts, decode_function=get_sentences_and_predicted_labels):
+        '''
+        Yield decode_function(text, sentences, predicted labels of every sentence) for every text, in order. The
+        sentences are the token dicts of spacy_cache.get_sentences_and_tokens_from_spacy, and the predicted labels the
+        labels of their words (fewer than the words of a sentence truncated to max_len word pieces).
+        '''
+        self.statistics = []
+        self._stop.clear()
+        self._errors = []
+        start_stage = self._start_stage if self.pipelined else self._run_stage
+        start = time.perf_counter()
+        try:
+            items = start_stage('parse', self._parse, texts)
+            items = start_stage('encode', self._encode, items)
+            items = start_stage('model', self._predict, items)
+            items = start_stage('decode', lambda batches: self._decode(batches, decode_function), items)
+            for item in items:
+                yield item
+            if self._errors:
+                raise self._errors[0]
+        finally:
+            # also stops the stage threads when the caller does not consume all results
+            self._stop.set()
+            self.wall_seconds = time.perf_counter() - start
+
+    def print_utilization(self):
+        print("Annotation stages ({0:.1f}s{1}):".format(self.wall_seconds, ', pipelined' if self.pipelined else ''))
+        for statistics in self.statistics:
+            print("  {0:<8} {1:8d} items  busy {2:8.2f}s  {3:5.1f}%".format(
+                statistics.name, statistics.items, statistics.busy_seconds,
+                100.0 * statistics.busy_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0))
@@ -0,0 +1,263 @@
+'''
+End-to-end throughput benchmark of the offline pipeline on synthetic corpora of increasing size.
+
+For every scale (a multiple of the sentences of the source corpus, see synthetic_corpus.py) a separate process
+    generate      writes a synthetic brat corpus
+    conversion    brat2conll.brat_to_conll of the brat files
+    parsing       conll_corpus.read_conll of the CoNLL output
+    dedup         train_ner_v1.get_sentence_dataframe (deduplicated sentence DataFrame)
+    tokenization  ner_dataset.encode_dataset of all sentences
+    training      training steps of a tiny randomly initialized BERT, with the collate function of train_ner_v1.py
+and records the time, the throughput and the memory (resident and peak) after every stage. Nothing is downloaded: the
+conversion uses a blank spaCy tokenizer with a sentencizer unless --spacy_model names an installed model, and the
+tokenizer of the tiny BERT is a WordPiece vocabulary built from the corpus. The per-sentence time of every stage,
+relative to the smallest scale, shows where the pipeline stops scaling linearly, e.g.
+    python benchmark_pipeline.py --source output/pico_conll.tsv --scales 1,10,100
+writes output/benchmark_{time}/results.tsv (one row per scale and stage) and prints the table.
+'''
+import argparse
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertConfig, BertForTokenClassification, BertTokenizerFast
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import brat2conll
+import local_utils as utils
+import synthetic_corpus
+from conll_corpus import read_conll
+from ner_dataset import NERDataset, SentenceEncoder, encode_dataset
+from sequence_packing import get_model_inputs
+from sweep_ner import write_table
+from train_ner_v1 import DEFAULT_PARAMETERS, ChildTuningAdamW, get_sentence_dataframe, set_seed
+
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+
+
+def get_memory_mb():
+    '''
+    Resident and peak resident memory of the process, in MB
+    '''
+    resident, peak = None, None
+    try:
+        with open('/proc/self/statm') as f:
+            resident = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (IOError, OSError, ValueError):
+        pass
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+    return resident, peak
+
+
+def build_tiny_bert(corpus, num_labels, model_dir, vocab_size=8000, max_len=256):
+    '''
+    WordPiece tokenizer of the most frequent (lowercased) tokens and characters of corpus, and a randomly initialized
+    2-layer BERT for token classification, saved in model_dir
+    '''
+    token_count = collections.Counter()
+    for token, count in corpus.token_count.items():
+        token_count[token.lower()] += count
+    characters = sorted({character for token in token_count for character in token})
+    vocabulary = SPECIAL_TOKENS + characters + ['##' + character for character in characters]
+    known = set(vocabulary)
+    vocabulary += [token for token, _ in token_count.most_common(vocab_size) if token not in known]
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_filepath = os.path.join(model_dir, 'vocab.txt')
+    with open(vocab_filepath, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(vocabulary) + '\n')
+    tokenizer = BertTokenizerFast(vocab_file=vocab_filepath, do_lower_case=True)
+    config = BertConfig(vocab_size=len(vocabulary), hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=128, max_position_embeddings=max(512, max_len), num_labels=num_labels)
+    return tokenizer, BertForTokenClassification(config)
+
+
+def time_training_steps(model, data_loader, steps, learning_rate=DEFAULT_PARAMETERS['learning_rate'],
+                        max_grad_norm=DEFAULT_PARAMETERS['max_grad_norm']):
+    '''
+    Seconds and number of sentences of steps training steps (after one warm-up step), as in NERTrainer.train
+    '''
+    optimizer = ChildTuningAdamW(params=model.parameters(), lr=learning_rate)
+    model.train()
+    batches = iter(data_loader)
+    seconds, sentences, step = 0.0, 0, -1
+    while step < steps:
+        start = time.perf_counter()
+        batch = next(batches, None)
+        if batch is None:
+            batches = iter(data_loader)
+            continue
+        loss = model(**get_model_inputs(batch, 'cpu'))[0]
+        optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(parameters=model.parameters(), max_norm=max_grad_norm)
+        optimizer.step()
+        step += 1
+        if step > 0:
+            seconds += time.perf_counter() - start
+            sentences += len(batch['input_ids'])
+    return seconds, sentences
+
+
+def run_scale(args):
+    '''
+    All stages on a corpus of args.scale times the source; returns one row per stage
+    '''
+    set_seed(args.seed)
+    work_dir = os.path.join(args.output_dir, 'scale_{0:g}'.format(args.scale))
+    brat_folder = os.path.join(work_dir, 'brat')
+    conll_filepath = os.path.join(work_dir, 'conll.tsv')
+    rows = []
+
+    def record(stage, start, items, unit):
+        seconds = time.perf_counter() - start
+        resident, peak = get_memory_mb()
+        rows.append(collections.OrderedDict([
+            ('scale', args.scale), ('stage', stage), ('seconds', round(seconds, 3)), ('items', items),
+            ('unit', unit), ('items_per_second', round(items / seconds, 1) if seconds > 0 else None),
+            ('resident_mb', round(resident, 1) if resident is not None else None),
+            ('peak_mb', round(peak, 1) if peak is not None else None)]))
+        print("{0:<13} {1:10.2f}s {2:12d} {3:<10} {4}/s".format(stage, seconds, items, unit,
+                                                                rows[-1]['items_per_second']))
+
+    start = time.perf_counter()
+    counts = synthetic_corpus.generate_corpus(args.source, args.scale, brat_folder=brat_folder, seed=args.seed)
+    record('generate', start, counts['sentences'], 'sentences')
+
+    if args.spacy_model == 'blank':
+        import spacy
+        spacy_nlp = spacy.blank('en')
+        spacy_nlp.add_pipe('sentencizer')
+        # the model of brat2conll.get_spacy_nlp, inherited by the worker processes of a parallel conversion
+        brat2conll._spacy_nlp = spacy_nlp
+    elif args.spacy_model:
+        import spacy
+        brat2conll._spacy_nlp = spacy.load(args.spacy_model)
+    start = time.perf_counter()
+    brat2conll.brat_to_conll(brat_folder, conll_filepath, 'spacy', workers=args.workers,
+                             files_per_shard=args.files_per_shard)
+    record('conversion', start, counts['documents'], 'documents')
+
+    start = time.perf_counter()
+    corpus = read_conll(conll_filepath)
+    record('parsing', start, len(corpus.token_ids), 'tokens')
+
+    start = time.perf_counter()
+    data = get_sentence_dataframe(corpus)
+    record('dedup', start, len(corpus), 'sentences')
+
+    labels_to_ids = {label: i for i, label in enumerate(sorted(corpus.label_vocabulary))}
+    tokenizer, model = build_tiny_bert(corpus, len(labels_to_ids), os.path.join(work_dir, 'tiny_bert'),
+                                       max_len=args.max_len)
+    start = time.perf_counter()
+    encode_dataset(NERDataset(data), tokenizer, args.max_len, labels_to_ids)
+    record('tokenization', start, len(data), 'sentences')
+
+    data_loader = DataLoader(NERDataset(data), batch_size=args.batch_size, shuffle=True,
+                             collate_fn=SentenceEncoder(tokenizer, args.max_len, labels_to_ids),
+                             generator=torch.Generator().manual_seed(args.seed))
+    start = time.perf_counter()
+    seconds, sentences = time_training_steps(model, data_loader, args.train_steps)
+    record('training', start, args.train_steps, 'steps')
+    rows[-1]['sentences_per_second'] = round(sentences / seconds, 1) if seconds > 0 else None
+    rows[-1]['steps_per_second'] = round(args.train_steps / seconds, 2) if seconds > 0 else None
+    if not args.keep_files:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return rows
+
+
+def add_scaling(rows):
+    '''
+    Seconds per item of every row relative to the smallest scale of the same stage: 1 is linear scaling, more is
+    worse than linear
+    '''
+    smallest = {}
+    for row in sorted(rows, key=lambda row: row['scale']):
+        if row['items'] and row['seconds'] > 0:
+            seconds_per_item = row['seconds'] / row['items']
+            smallest.setdefault(row['stage'], seconds_per_item)
+            row['relative_cost_per_item'] = round(seconds_per_item / smallest[row['stage']], 2)
+    return rows
+
+
+def run_benchmark(args):
+    '''
+    Every scale in its own process, so that the memory of one scale does not carry over to the next
+    '''
+    rows = []
+    for scale in args.scales:
+        print("Scale {0:g}".format(scale))
+        result_filepath = os.path.join(args.output_dir, 'scale_{0:g}.json'.format(scale))
+        command = [sys.executable, os.path.abspath(__file__), '--scale', str(scale), '--result_file', result_filepath,
+                   '--source', args.source, '--output_dir', args.output_dir, '--spacy_model', args.spacy_model,
+                   '--workers', str(args.workers), '--files_per_shard', str(args.files_per_shard),
+                   '--max_len', str(args.max_len), '--batch_size', str(args.batch_size),
+                   '--train_steps', str(args.train_steps), '--seed', str(args.seed)]
+        if args.keep_files:
+            command.append('--keep_files')
+        returncode = subprocess.call(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if returncode != 0:
+            print("Scale {0:g} failed ({1}), larger scales are skipped".format(scale, returncode))
+            break
+        with open(result_filepath) as f:
+            rows += json.load(f)
+        add_scaling(rows)
+        write_table(rows, os.path.join(args.output_dir, 'results.tsv'))
+    print_table(rows)
+    print("Results: {0}".format(os.path.join(args.output_dir, 'results.tsv')))
+    return rows
+
+
+def print_table(rows):
+    print("scale   stage           seconds        items/s  cost/item  resident MB  peak MB")
+    for row in rows:
+        print("{0:<7g} {1:<13} {2:10.2f} {3:>14} {4:>10} {5:>12} {6:>8}".format(
+            row['scale'], row['stage'], row['seconds'], '{0} {1}'.format(row['items_per_second'], row['unit'][:4]),
+            row.get('relative_cost_per_item', ''), row['resident_mb'], row['peak_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput and memory of the offline pipeline stages on synthetic '
+                                                 'corpora of increasing size')
+    parser.add_argument('--source', default=DEFAULT_PARAMETERS['filepath'], help='CoNLL corpus to resample')
+    parser.add_argument('--scales', default='1,10', type=lambda scales: [float(scale) for scale in scales.split(',')],
+                        help='comma-separated corpus sizes, in multiples of the source corpus')
+    parser.add_argument('--output_dir', default=None, help='default: output/benchmark_{time}')
+    parser.add_argument('--spacy_model', default='blank',
+                        help="spaCy model of the conversion, 'blank' for the offline blank English tokenizer")
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the conversion')
+    parser.add_argument('--files_per_shard', type=int, default=100)
+    parser.add_argument('--max_len', type=int, default=DEFAULT_PARAMETERS['max_len'])
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_PARAMETERS['train_batch_size'])
+    parser.add_argument('--train_steps', type=int, default=50, help='timed training steps')
+    parser.add_argument('--keep_files', action='store_true', help='keep the generated corpora')
+    parser.add_argument('--seed', type=int, default=DEFAULT_PARAMETERS['seed'])
+    # a single scale, run by run_benchmark in its own process
+    parser.add_argument('--scale', type=float, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result_file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.output_dir = os.path.abspath(args.output_dir or os.path.join(
+        'output', 'benchmark_{0}'.format(utils.get_current_time_in_seconds())))
+    args.source = os.path.abspath(args.source)
+    utils.create_folder_if_not_exists(args.output_dir)
+    if args.scale is None:
+        run_benchmark(args)
+        return
+    rows = run_scale(args)
+    with open(args.result_file, 'w') as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
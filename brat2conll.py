@@ -1,11 +1,23 @@
+import argparse
 import codecs
+import collections
+import concurrent.futures
 import glob
+import hashlib
 import json
 import os
 import logging
+import shutil
 import spacy
 
+import local_utils as utils
 import utils_nlp
+from conll_io import concatenate_files, open_conll
+from spacy_cache import SpacyDocCache, pipe_sentences_and_tokens
+
+# version of the CoNLL output (and diagnostics) of a document, a new version invalidates the fragments of incremental
+# conversions
+CONVERSION_VERSION = 2
 
 
 def get_start_and_end_offset_of_token_from_spacy(token):
@@ -14,34 +26,29 @@ def get_start_and_end_offset_of_token_from_spacy(token):
     return start, end
 
 
-def get_sentences_and_tokens_from_spacy(text, spacy_nlp):
-    document = spacy_nlp(text)
-    # sentences
-    sentences = []
-    for span in document.sents:
-        sentence = [document[i] for i in range(span.start, span.end)]
-        sentence_tokens = []
-        for token in sentence:
-            token_dict = {}
-            token_dict['start'], token_dict['end'] = get_start_and_end_offset_of_token_from_spacy(token)
-            token_dict['text'] = text[token_dict['start']:token_dict['end']]
-            if token_dict['text'].strip() in ['\n', '\t', ' ', '']:
-                continue
-            # Make sure that the token text does not contain any space
-            if len(token_dict['text'].split(' ')) != 1:
-                print(
-                    "WARNING: the text of the token contains space character, replaced with hyphen\n\t{0}\n\t{1}".format(
-                        token_dict['text'],
-                        token_dict['text'].replace(' ', '-')))
-                token_dict['text'] = token_dict['text'].replace(' ', '-')
-            sentence_tokens.append(token_dict)
-        sentences.append(sentence_tokens)
-    return sentences
-
-
-
-
-def get_entities_from_brat(text_filepath, annotation_filepath, verbose=False):
+# spaCy model of the process, loaded on first use (once per worker process in parallel mode)
+_spacy_nlp = None
+
+
+def get_spacy_nlp(spacy_cache_dir=None):
+    '''
+    The spaCy model, or with spacy_cache_dir a SpacyDocCache of it, which only loads the model for texts that are not
+    cached yet
+    '''
+    global _spacy_nlp
+    if spacy_cache_dir is not None:
+        return SpacyDocCache(spacy_cache_dir, _spacy_nlp or "en_core_sci_lg")
+    if _spacy_nlp is None:
+        _spacy_nlp = spacy.load("en_core_sci_lg")
+    return _spacy_nlp
+
+
+def get_entities_from_brat(text_filepath, annotation_filepath, verbose=False, diagnostics=None):
+    '''
+    Text and entities of a brat document. Entities whose offsets are out of the text or whose text does not match the
+    text at their offsets (whitespace-normalized) are printed as warnings, or collected in diagnostics['mismatches'] if
+    a diagnostics dict is given.
+    '''
     # load text
     with codecs.open(text_filepath, 'r', 'UTF-8') as f:
         text = f.read()
@@ -67,114 +74,335 @@ def get_entities_from_brat(text_filepath, annotation_filepath, verbose=False):
                 if verbose:
                     print("entity: {0}".format(entity))
                 # Check compatibility between brat text and anootation
-                if utils_nlp.replace_unicode_whitespaces_with_ascii_whitespace(text[entity['start']:entity['end']]) != \
+                if not 0 <= entity['start'] <= entity['end'] <= len(text):
+                    mismatch = 'offsets'
+                elif utils_nlp.replace_unicode_whitespaces_with_ascii_whitespace(text[entity['start']:entity['end']]) != \
                         utils_nlp.replace_unicode_whitespaces_with_ascii_whitespace(entity['text']):
+                    mismatch = 'text'
+                else:
+                    mismatch = None
+                if mismatch is not None and diagnostics is None:
                     print("Warning: brat text and annotation do not match.")
                     print("\ttext: {0}".format(text[entity['start']:entity['end']]))
                     print("\tanno: {0}".format(entity['text']))
+                elif mismatch is not None:
+                    diagnostics['mismatches'].append({'id': entity['id'], 'type': mismatch, 'start': entity['start'],
+                                                      'end': entity['end'], 'text': text[entity['start']:entity['end']],
+                                                      'annotation': entity['text']})
                 # add to entitys data
                 entities.append(entity)
     if verbose: print("\n\n")
+    if diagnostics is not None:
+        diagnostics['entities'] = len(entities)
 
     return text, entities
 
 
-def check_brat_annotation_and_text_compatibility(brat_folder):
+def get_document_diagnostics():
+    return {'entities': 0, 'mismatches': []}
+
+
+def check_brat_annotation_and_text_compatibility(brat_folder, report_filepath=None):
     '''
     Check if brat annotation and text files are compatible.
+    Returns the diagnostics of every file, and writes them as a json report to report_filepath if given.
+    brat_to_conll runs the same checks while converting, this is only needed to check a folder without converting it.
     '''
     dataset_type = os.path.basename(brat_folder)
     print("Checking the validity of BRAT-formatted {0} set... ".format(dataset_type), end='')
     text_filepaths = sorted(glob.glob(os.path.join(brat_folder, '*.txt')))
+    document_diagnostics = {}
     for text_filepath in text_filepaths:
         base_filename = os.path.splitext(os.path.basename(text_filepath))[0]
         annotation_filepath = os.path.join(os.path.dirname(text_filepath), base_filename + '.ann')
         # check if annotation file exists
         if not os.path.exists(annotation_filepath):
             raise IOError("Annotation file does not exist: {0}".format(annotation_filepath))
-        text, entities = get_entities_from_brat(text_filepath, annotation_filepath)
+        document_diagnostics[base_filename] = get_document_diagnostics()
+        get_entities_from_brat(text_filepath, annotation_filepath, diagnostics=document_diagnostics[base_filename])
     print("Done.")
+    report = get_validation_report(brat_folder, document_diagnostics)
+    print_validation_summary(report, report_filepath)
+    if report_filepath is not None:
+        write_validation_report(report, report_filepath)
+    return report
 
 
-def brat_to_conll(input_folder, output_filepath, tokenizer, language='en'):
+def get_validation_report(input_folder, document_diagnostics):
     '''
-    Assumes '.txt' and '.ann' files are in the input_folder.
-    Checks for the compatibility between .txt and .ann at the same time.
+    Mismatch counts of the whole folder and of every file, with the details of the mismatches
     '''
-    if tokenizer == 'spacy':
-        # spacy_nlp = spacy.load(language)
-        spacy_nlp = spacy.load("en_core_sci_lg")
-    else:
-        raise ValueError("tokenizer should be either 'spacy' or 'stanford'.")
-    verbose = False
-    dataset_type = os.path.basename(input_folder)
-    print("Formatting {0} set from BRAT to CONLL... ".format(dataset_type), end='')
-    text_filepaths = sorted(glob.glob(os.path.join(input_folder, '*.txt')))
-    output_file = codecs.open(output_filepath, 'w', 'utf-8')
-    for text_filepath in text_filepaths:
+    files = collections.OrderedDict()
+    for base_filename in sorted(document_diagnostics):
+        diagnostics = document_diagnostics[base_filename]
+        files[base_filename] = {'entities': diagnostics['entities'],
+                                'mismatches': len(diagnostics['mismatches']),
+                                'mismatch_details': diagnostics['mismatches']}
+    return collections.OrderedDict([
+        ('input_folder', input_folder),
+        ('files', len(files)),
+        ('entities', sum(file_report['entities'] for file_report in files.values())),
+        ('mismatches', sum(file_report['mismatches'] for file_report in files.values())),
+        ('files_with_mismatches', sum(1 for file_report in files.values() if file_report['mismatches'] > 0)),
+        ('per_file', files)])
+
+
+def write_validation_report(report, report_filepath):
+    with codecs.open(report_filepath, 'w', 'UTF-8') as f:
+        json.dump(report, f, indent=1, ensure_ascii=False)
+
+
+def print_validation_summary(report, report_filepath=None):
+    if report['mismatches'] > 0:
+        print("Warning: {0} of {1} annotations in {2} files do not match the text{3}".format(
+            report['mismatches'], report['entities'], report['files_with_mismatches'],
+            ', see {0}'.format(report_filepath) if report_filepath else ''))
+
+
+def get_brat_documents(input_folder):
+    '''
+    (base_filename, text_filepath, annotation_filepath) of the .txt files in input_folder, sorted by file name.
+    Creates empty annotation files for texts without one.
+    '''
+    documents = []
+    for text_filepath in sorted(glob.glob(os.path.join(input_folder, '*.txt'))):
         base_filename = os.path.splitext(os.path.basename(text_filepath))[0]
         annotation_filepath = os.path.join(os.path.dirname(text_filepath), base_filename + '.ann')
         # create annotation file if it does not exist
         if not os.path.exists(annotation_filepath):
             codecs.open(annotation_filepath, 'w', 'UTF-8').close()
+        documents.append((base_filename, text_filepath, annotation_filepath))
+    return documents
 
-        text, entities = get_entities_from_brat(text_filepath, annotation_filepath)
-        entities = sorted(entities, key=lambda entity: entity["start"])
-
-        if tokenizer == 'spacy':
-            sentences = get_sentences_and_tokens_from_spacy(text, spacy_nlp)
-
-        for sentence in sentences:
-            inside = False
-            previous_token_label = 'O'
-            for token in sentence:
-                token['label'] = 'O'
-                for entity in entities:
-                    if entity['start'] <= token['start'] < entity['end'] or \
-                            entity['start'] < token['end'] <= entity['end'] or \
-                            token['start'] < entity['start'] < entity['end'] < token['end']:
-
-                        token['label'] = entity['type'].replace('-',
-                                                                '_')  # Because the ANN doesn't support tag with '-' in it
-
-                        break
-                    elif token['end'] < entity['start']:
-                        break
-
-                if len(entities) == 0:
-                    entity = {'end': 0}
-                if token['label'] == 'O':
-                    gold_label = 'O'
-                    inside = False
-                elif inside and token['label'] == previous_token_label:
-                    gold_label = 'I-{0}'.format(token['label'])
-                else:
-                    inside = True
-                    gold_label = 'B-{0}'.format(token['label'])
-                if token['end'] == entity['end']:
-                    inside = False
-                previous_token_label = token['label']
-                if verbose: print(
-                    '{0}\t{1}\t{2}\t{3}\t{4}\n'.format(token['text'], base_filename, token['start'], token['end'],
-                                                   gold_label))
-                output_file.write(
-                    '{0}\t{1}\t{2}\t{3}\t{4}\n'.format(token['text'], base_filename, token['start'], token['end'],
-                                                   gold_label))
-            if verbose: print('\n')
-            output_file.write('\n')
-
-    output_file.close()
+
+def convert_brat_documents(documents, output_filepath=None, fragment_folder=None, n_process=1, batch_size=32,
+                           verbose=False, progress_interval=0, spacy_cache_dir=None):
+    '''
+    Convert documents (see get_brat_documents) to CoNLL, either all of them in order into output_filepath, or each of
+    them into its own fragment file {base_filename}.tsv in fragment_folder.
+    The texts are tokenized in batches with spacy_nlp.pipe, in n_process processes, or taken from the spaCy cache in
+    spacy_cache_dir (see spacy_cache.py).
+    Every file is read once, when spaCy reads its text, so only the documents of the batches in flight are in memory;
+    the annotation checks of get_entities_from_brat run on the way, returns their diagnostics for every document.
+    '''
+    spacy_nlp = get_spacy_nlp(spacy_cache_dir)
+    document_diagnostics = collections.OrderedDict()
+    # documents read and not written yet: spaCy reads the texts a few batches ahead of the output
+    pending_documents = collections.deque()
+
+    def read_texts():
+        for base_filename, text_filepath, annotation_filepath in documents:
+            document_diagnostics[base_filename] = get_document_diagnostics()
+            text, entities = get_entities_from_brat(text_filepath, annotation_filepath,
+                                                    diagnostics=document_diagnostics[base_filename])
+            pending_documents.append((base_filename, entities))
+            yield text
+
+    output_file = open_conll(output_filepath, 'w') if fragment_folder is None else None
+    for number_of_documents, sentences in \
+            enumerate(pipe_sentences_and_tokens(read_texts(), spacy_nlp, batch_size, n_process), start=1):
+        base_filename, entities = pending_documents.popleft()
+        lines = []
+        for sentence, labels in zip(sentences, utils_nlp.get_bio_labels_from_entities(sentences, entities)):
+            for token, gold_label in zip(sentence, labels):
+                lines.append('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(token['text'], base_filename, token['start'],
+                                                               token['end'], gold_label))
+            lines.append('\n')
+        if verbose: print('\n'.join(lines))
+        if fragment_folder is not None:
+            with open_conll(get_fragment_filepath(fragment_folder, base_filename), 'w') as fragment_file:
+                fragment_file.write(''.join(lines))
+        else:
+            output_file.write(''.join(lines))
+        if progress_interval > 0 and number_of_documents % progress_interval == 0:
+            print("Converted {0}/{1} files".format(number_of_documents, len(documents)))
+    if fragment_folder is None:
+        output_file.close()
+    if spacy_cache_dir is not None:
+        print("spaCy cache: {0} texts cached, {1} tokenized".format(spacy_nlp.hits, spacy_nlp.misses))
+    return document_diagnostics
+
+
+def convert_brat_documents_in_parallel(documents, workers, n_process, files_per_shard, shard_folder=None,
+                                       fragment_folder=None, spacy_cache_dir=None):
+    '''
+    Convert shards of files_per_shard documents in a pool of worker processes (each with its own spaCy model and
+    n_process spaCy processes), either into one file per shard in shard_folder or into per-document fragments.
+    Returns the shard files in document order and the diagnostics of every document.
+    '''
+    shard_filepaths = []
+    document_diagnostics = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for shard_start in range(0, len(documents), files_per_shard):
+            shard_filepath = None
+            if shard_folder is not None:
+                shard_filepath = os.path.join(shard_folder, 'shard_{0:06d}.tsv'.format(len(shard_filepaths)))
+                shard_filepaths.append(shard_filepath)
+            futures.append(executor.submit(convert_brat_documents,
+                                           documents[shard_start:shard_start + files_per_shard],
+                                           shard_filepath, fragment_folder, n_process,
+                                           spacy_cache_dir=spacy_cache_dir))
+        for future in concurrent.futures.as_completed(futures):
+            document_diagnostics.update(future.result())
+            print("Converted {0}/{1} files".format(len(document_diagnostics), len(documents)))
+    return shard_filepaths, document_diagnostics
+
+
+def get_fragment_filepath(fragment_folder, base_filename):
+    return os.path.join(fragment_folder, base_filename + '.tsv')
+
+
+def get_document_hash(text_filepath, annotation_filepath):
+    sha1 = hashlib.sha1()
+    for filepath in [text_filepath, annotation_filepath]:
+        with open(filepath, 'rb') as f:
+            sha1.update(f.read())
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def get_document_stat(text_filepath, annotation_filepath):
+    return [[os.stat(filepath).st_size, os.stat(filepath).st_mtime_ns]
+            for filepath in [text_filepath, annotation_filepath]]
+
+
+def load_manifest(manifest_filepath):
+    '''
+    Manifest of the incremental conversion: hash, stat and diagnostics of every converted document, or an empty
+    manifest if the
+    cache is missing or was written by another version of the conversion
+    '''
+    if os.path.exists(manifest_filepath):
+        with open(manifest_filepath) as f:
+            manifest = json.load(f)
+        if manifest.get('conversion_version') == CONVERSION_VERSION:
+            return manifest
+    return {'conversion_version': CONVERSION_VERSION, 'documents': {}}
+
+
+def update_conversion_cache(documents, cache_folder, workers=1, n_process=1, files_per_shard=100,
+                            spacy_cache_dir=None):
+    '''
+    Bring the per-document fragments in cache_folder up to date with documents: convert added and changed
+    documents only, and drop the fragments of deleted ones. A document is unchanged if the stat of its files is
+    unchanged, or else if the sha1 of their content is.
+    Returns the fragments of documents and their diagnostics (kept in the manifest for unchanged documents).
+    '''
+    fragment_folder = os.path.join(cache_folder, 'fragments')
+    manifest_filepath = os.path.join(cache_folder, 'manifest.json')
+    utils.create_folder_if_not_exists(fragment_folder)
+    manifest = load_manifest(manifest_filepath)
+    cached_documents = manifest['documents']
+
+    documents_to_convert, document_entries = [], {}
+    for base_filename, text_filepath, annotation_filepath in documents:
+        stat = get_document_stat(text_filepath, annotation_filepath)
+        entry = cached_documents.get(base_filename)
+        fragment_exists = os.path.exists(get_fragment_filepath(fragment_folder, base_filename))
+        # entries of older manifests have no diagnostics, their documents are converted again
+        is_cached = entry is not None and 'diagnostics' in entry and fragment_exists
+        if is_cached and entry['stat'] == stat:
+            document_entries[base_filename] = entry
+            continue
+        document_hash = get_document_hash(text_filepath, annotation_filepath)
+        document_entries[base_filename] = {'sha1': document_hash, 'stat': stat}
+        if is_cached and entry['sha1'] == document_hash:
+            document_entries[base_filename]['diagnostics'] = entry['diagnostics']
+        else:
+            documents_to_convert.append((base_filename, text_filepath, annotation_filepath))
+
+    deleted_documents = set(cached_documents) - set(document_entries)
+    for base_filename in deleted_documents:
+        fragment_filepath = get_fragment_filepath(fragment_folder, base_filename)
+        if os.path.exists(fragment_filepath):
+            os.remove(fragment_filepath)
+    print("{0} files unchanged, {1} to convert, {2} deleted".format(
+        len(documents) - len(documents_to_convert), len(documents_to_convert), len(deleted_documents)))
+
+    if workers > 1 and len(documents_to_convert) > files_per_shard:
+        _, converted_diagnostics = convert_brat_documents_in_parallel(documents_to_convert, workers, n_process,
+                                                                      files_per_shard, fragment_folder=fragment_folder,
+                                                                      spacy_cache_dir=spacy_cache_dir)
+    else:
+        converted_diagnostics = convert_brat_documents(documents_to_convert, fragment_folder=fragment_folder,
+                                                       n_process=n_process, progress_interval=files_per_shard,
+                                                       spacy_cache_dir=spacy_cache_dir)
+    for base_filename, diagnostics in converted_diagnostics.items():
+        document_entries[base_filename]['diagnostics'] = diagnostics
+
+    manifest['documents'] = document_entries
+    with open(manifest_filepath + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_filepath + '.tmp', manifest_filepath)
+    return [get_fragment_filepath(fragment_folder, base_filename) for base_filename, _, _ in documents], \
+        {base_filename: entry['diagnostics'] for base_filename, entry in document_entries.items()}
+
+
+def brat_to_conll(input_folder, output_filepath, tokenizer, language='en', workers=1, n_process=1,
+                  files_per_shard=100, incremental=False, report_filepath=None, spacy_cache_dir=None):
+    '''
+    Assumes '.txt' and '.ann' files are in the input_folder.
+    Checks for the compatibility between .txt and .ann at the same time.
+    With workers > 1, shards of files_per_shard files are converted by a pool of worker processes, and the shard
+    outputs are concatenated in file name order, so the output does not depend on the number of workers.
+    With incremental, the CoNLL of every document is kept in {output_filepath}.cache and only added or changed
+    documents are converted again.
+    Annotations that do not match the text are reported in a json report, report_filepath (default:
+    {output_filepath}.report.json), with the counts and the details of every file.
+    With spacy_cache_dir, the spaCy tokenization of every text is cached there (see spacy_cache.py), and converting
+    the same texts again does not run spaCy.
+    '''
+    if tokenizer != 'spacy':
+        raise ValueError("tokenizer should be either 'spacy' or 'stanford'.")
+    dataset_type = os.path.basename(input_folder)
+    print("Formatting {0} set from BRAT to CONLL... ".format(dataset_type))
+    documents = get_brat_documents(input_folder)
+    if incremental:
+        fragment_filepaths, document_diagnostics = update_conversion_cache(
+            documents, output_filepath + '.cache', workers, n_process, files_per_shard, spacy_cache_dir)
+        concatenate_files(fragment_filepaths, output_filepath)
+    elif workers <= 1:
+        document_diagnostics = convert_brat_documents(documents, output_filepath, n_process=n_process,
+                                                      progress_interval=files_per_shard,
+                                                      spacy_cache_dir=spacy_cache_dir)
+    else:
+        shard_folder = output_filepath + '.shards'
+        shutil.rmtree(shard_folder, ignore_errors=True)
+        os.makedirs(shard_folder)
+        shard_filepaths, document_diagnostics = convert_brat_documents_in_parallel(
+            documents, workers, n_process, files_per_shard, shard_folder=shard_folder,
+            spacy_cache_dir=spacy_cache_dir)
+        concatenate_files(shard_filepaths, output_filepath)
+        shutil.rmtree(shard_folder)
+    report_filepath = report_filepath or output_filepath + '.report.json'
+    report = get_validation_report(input_folder, document_diagnostics)
+    write_validation_report(report, report_filepath)
+    print_validation_summary(report, report_filepath)
     print('Done.')
-    if tokenizer == 'spacy':
-        del spacy_nlp
+    return report
 
 
 def main():
-    input_folder = 'data/'
-    output_filepath = 'output/pico_conll_v2.tsv'
+    parser = argparse.ArgumentParser(description='Convert brat annotations (.txt and .ann files) to CoNLL')
+    parser.add_argument('--input_folder', default='data/')
+    parser.add_argument('--output_filepath', default='output/pico_conll_v2.tsv')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes converting shards of files')
+    parser.add_argument('--n_process', type=int, default=1, help='spaCy processes of every worker (nlp.pipe)')
+    parser.add_argument('--files_per_shard', type=int, default=100)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert added or changed files, reusing the output of the others from '
+                             '{output_filepath}.cache')
+    parser.add_argument('--report_filepath', default=None,
+                        help='json report of the annotations that do not match the text, default: '
+                             '{output_filepath}.report.json')
+    parser.add_argument('--spacy_cache_dir', default=None,
+                        help='cache of the spaCy tokenization, reused by later conversions of the same texts')
+    args = parser.parse_args()
     tokenizer = 'spacy'
     language = 'en'
-    brat_to_conll(input_folder, output_filepath, tokenizer, language)
+    brat_to_conll(args.input_folder, args.output_filepath, tokenizer, language, args.workers, args.n_process,
+                  args.files_per_shard, args.incremental, args.report_filepath, args.spacy_cache_dir)
 
 
 
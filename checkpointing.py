@@ -0,0 +1,180 @@
+import copy
+import glob
+import math
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+CHECKPOINT_FILENAME = 'checkpoint_epoch{epoch}_step{step}.pt'
+CHECKPOINT_REGEX = re.compile(r'checkpoint_epoch(\d+)_step(\d+)\.pt$')
+
+
+def snapshot(obj):
+    '''
+    Copy nested dicts/lists of tensors, with every tensor cloned to the cpu.
+    Training can keep updating the originals while the copy is being written.
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def list_checkpoints(checkpoint_dir):
+    '''
+    Training-state checkpoints in checkpoint_dir, oldest first.
+    '''
+    checkpoints = []
+    for filepath in glob.glob(os.path.join(checkpoint_dir, 'checkpoint_epoch*_step*.pt')):
+        match = CHECKPOINT_REGEX.search(os.path.basename(filepath))
+        if match:
+            checkpoints.append(((int(match.group(1)), int(match.group(2))), filepath))
+    return [filepath for _, filepath in sorted(checkpoints)]
+
+
+def find_latest_checkpoint(checkpoint_dir):
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_training_state(checkpoint_filepath):
+    try:
+        return torch.load(checkpoint_filepath, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13 has no weights_only argument
+        return torch.load(checkpoint_filepath, map_location='cpu')
+
+
+class AsyncCheckpointWriter:
+    '''
+    Writes checkpoints from a background thread.
+    Jobs run in submission order. At most max_pending snapshots wait in the queue, which bounds the extra memory;
+    submit() only blocks when checkpoints are produced faster than they can be written.
+    keep_last is the number of training-state checkpoints to retain (0 keeps all of them).
+    '''
+    def __init__(self, checkpoint_dir, keep_last=3, max_pending=1):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                function, args, kwargs = job
+                function(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def submit(self, function, *args, **kwargs):
+        '''
+        Run function(*args, **kwargs) on the writer thread. The arguments must not be modified by the caller
+        afterwards, i.e. pass snapshots.
+        '''
+        self._raise_error()
+        self.queue.put((function, args, kwargs))
+
+    def save_training_state(self, state, epoch, step):
+        '''
+        Snapshot state now and write it as the checkpoint training continues from at (epoch, step).
+        '''
+        self.submit(self._write_training_state, snapshot(state), epoch, step)
+
+    def _write_training_state(self, state, epoch, step):
+        filepath = os.path.join(self.checkpoint_dir, CHECKPOINT_FILENAME.format(epoch=epoch, step=step))
+        # write to a temporary file first, so that a preempted write never leaves a truncated latest checkpoint
+        torch.save(state, filepath + '.tmp')
+        os.replace(filepath + '.tmp', filepath)
+        if self.keep_last > 0:
+            for old_filepath in list_checkpoints(self.checkpoint_dir)[:-self.keep_last]:
+                os.remove(old_filepath)
+
+    def wait(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+
+class ResumableSampler(Sampler):
+    '''
+    Shuffling sampler whose order only depends on (seed, epoch), so that training can continue from the middle of an
+    epoch by skipping the samples that were already consumed.
+    With num_replicas > 1 every rank gets its own equally sized shard, like DistributedSampler.
+    '''
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_index = 0
+        self.num_samples = math.ceil(len(data_source) / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch, start_index=0):
+        '''
+        start_index is the number of samples of this rank that were already consumed in the epoch.
+        '''
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.data_source)))
+        # pad so that the data splits evenly between the replicas
+        indices = (indices * math.ceil(self.total_size / max(len(indices), 1)))[:self.total_size]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'start_index': self.start_index, 'seed': self.seed}
@@ -0,0 +1,104 @@
+import collections
+import csv
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from conll_io import get_conll_columns
+
+
+class ConllCorpus:
+    '''
+    A CoNLL dataset as flat arrays: the interned token and label ids of all tokens, and the offsets of the sentences
+    in them (sentence i is token_ids[sentence_offsets[i]:sentence_offsets[i + 1]]).
+    The token / label / character statistics are only computed when they are requested.
+    '''
+    def __init__(self, token_ids, label_ids, sentence_offsets, token_vocabulary, label_vocabulary):
+        self.token_ids = token_ids
+        self.label_ids = label_ids
+        self.sentence_offsets = sentence_offsets
+        self.token_vocabulary = token_vocabulary
+        self.label_vocabulary = label_vocabulary
+        self._token_count = None
+
+    def __len__(self):
+        return len(self.sentence_offsets) - 1
+
+    def get_tokens(self, sentence_index):
+        start, end = self.sentence_offsets[sentence_index], self.sentence_offsets[sentence_index + 1]
+        return [self.token_vocabulary[i] for i in self.token_ids[start:end]]
+
+    def get_labels(self, sentence_index):
+        start, end = self.sentence_offsets[sentence_index], self.sentence_offsets[sentence_index + 1]
+        return [self.label_vocabulary[i] for i in self.label_ids[start:end]]
+
+    def get_unique_sentence_indices(self):
+        '''
+        Index of the first occurrence of every distinct (tokens, labels) sentence, in corpus order
+        '''
+        first_occurrences = {}
+        offsets = self.sentence_offsets
+        for i in range(len(self)):
+            key = (self.token_ids[offsets[i]:offsets[i + 1]].tobytes(),
+                   self.label_ids[offsets[i]:offsets[i + 1]].tobytes())
+            first_occurrences.setdefault(key, i)
+        return np.fromiter(first_occurrences.values(), dtype=np.int64, count=len(first_occurrences))
+
+    def fingerprint(self):
+        sha1 = hashlib.sha1()
+        for array in [self.token_ids, self.label_ids, self.sentence_offsets]:
+            sha1.update(array.tobytes())
+        for vocabulary in [self.token_vocabulary, self.label_vocabulary]:
+            sha1.update('\n'.join(vocabulary).encode('utf-8'))
+        return sha1.hexdigest()
+
+    @property
+    def token_count(self):
+        if self._token_count is None:
+            counts = np.bincount(self.token_ids, minlength=len(self.token_vocabulary))
+            self._token_count = collections.Counter(dict(zip(self.token_vocabulary, counts.tolist())))
+        return self._token_count
+
+    @property
+    def label_count(self):
+        counts = np.bincount(self.label_ids, minlength=len(self.label_vocabulary))
+        return collections.Counter(dict(zip(self.label_vocabulary, counts.tolist())))
+
+    @property
+    def character_count(self):
+        character_count = collections.Counter()
+        for token, count in self.token_count.items():
+            for character in token:
+                character_count[character] += count
+        return character_count
+
+
+def read_conll(dataset_filepath):
+    '''
+    Parse a CoNLL file (sentences separated by empty lines or -DOCSTART- lines, column layout detected by
+    conll_io.get_conll_columns, optionally gzip or zstd compressed) into a ConllCorpus in bulk.
+    '''
+    conll_columns = get_conll_columns(dataset_filepath)
+    if not conll_columns:
+        return ConllCorpus(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64),
+                           [], [])
+    # the C parser reads the (decompressed) bytes directly, only the token and label columns are kept
+    columns = pd.read_csv(dataset_filepath, sep='\t', header=None,
+                          usecols=[conll_columns['token'], conll_columns['label']], dtype=str,
+                          quoting=csv.QUOTE_NONE, na_filter=False, skip_blank_lines=False, encoding='UTF-8',
+                          compression='infer')
+    tokens = columns.iloc[:, 0].str.strip()
+    labels = columns.iloc[:, -1].str.strip()
+    is_separator = ((tokens.str.len() == 0) | tokens.str.contains('-DOCSTART-', regex=False)).values
+
+    # a sentence starts at every token that follows a separator line
+    is_sentence_start = ~is_separator & np.concatenate([[True], is_separator[:-1]])
+    is_token = ~is_separator
+    sentence_starts = np.cumsum(is_token)[is_sentence_start] - 1
+    sentence_offsets = np.append(sentence_starts, is_token.sum()).astype(np.int64)
+
+    token_ids, token_vocabulary = pd.factorize(tokens[is_token])
+    label_ids, label_vocabulary = pd.factorize(labels[is_token])
+    return ConllCorpus(token_ids.astype(np.int32), label_ids.astype(np.int32), sentence_offsets,
+                       list(token_vocabulary), list(label_vocabulary))
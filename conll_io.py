@@ -0,0 +1,88 @@
+'''
+CoNLL file I/O shared by the converters and readers. The compression follows the file extension:
+    .gz          gzip
+    .zst, .zstd  zstandard (pip install zstandard)
+    otherwise    plain text
+Files are streamed through large buffers, so writing many short lines does not mean many small writes.
+'''
+import gzip
+import io
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BUFFER_SIZE = 1 << 20
+
+# column layouts of the CoNLL files of this repo, by number of columns
+CONLL_COLUMN_LAYOUTS = {
+    5: ['token', 'document', 'start', 'end', 'label'],  # brat2conll.py
+    4: ['token', 'start', 'end', 'label'],  # pre_processing_from_df (LitCoin)
+    2: ['token', 'label'],
+}
+
+
+def get_compression(filepath):
+    if filepath.endswith('.gz'):
+        return 'gzip'
+    if filepath.endswith('.zst') or filepath.endswith('.zstd'):
+        return 'zstd'
+    return None
+
+
+def open_binary(filepath, mode='rb'):
+    '''
+    Buffered binary stream of filepath ('rb', 'wb' or 'ab'), compressed or decompressed on the fly
+    '''
+    compression = get_compression(filepath)
+    if compression == 'gzip':
+        raw = gzip.open(filepath, mode, compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Reading or writing {0} needs the zstandard package: pip install zstandard".format(
+                filepath))
+        raw = zstandard.open(filepath, mode)
+    else:
+        return open(filepath, mode, buffering=BUFFER_SIZE)
+    return io.BufferedReader(raw, BUFFER_SIZE) if mode.startswith('r') else io.BufferedWriter(raw, BUFFER_SIZE)
+
+
+def open_conll(filepath, mode='r'):
+    '''
+    UTF-8 text stream of a CoNLL file, 'r', 'w' or 'a'. Line endings are left as they are, like codecs.open.
+    '''
+    return io.TextIOWrapper(open_binary(filepath, mode[0] + 'b'), encoding='utf-8', newline='')
+
+
+def concatenate_files(input_filepaths, output_filepath):
+    '''
+    Concatenate plain files into output_filepath (compressed according to its extension), copying bytes
+    '''
+    with open_binary(output_filepath, 'wb') as output_file:
+        for input_filepath in input_filepaths:
+            with open(input_filepath, 'rb') as input_file:
+                shutil.copyfileobj(input_file, output_file, BUFFER_SIZE)
+
+
+def get_number_of_columns(dataset_filepath):
+    with open_conll(dataset_filepath) as f:
+        for line in f:
+            if line.strip():
+                return len(line.rstrip('\r\n').split('\t'))
+    return 0
+
+
+def get_conll_columns(dataset_filepath):
+    '''
+    Index of every column of a CoNLL file ('token', 'label', and 'document' / 'start' / 'end' when present), detected
+    from the number of columns. Unknown layouts have the token in the first and the label in the last column.
+    '''
+    number_of_columns = get_number_of_columns(dataset_filepath)
+    if number_of_columns == 0:
+        return {}
+    layout = CONLL_COLUMN_LAYOUTS.get(number_of_columns)
+    if layout is None:
+        return {'token': 0, 'label': number_of_columns - 1}
+    return {name: index for index, name in enumerate(layout)}
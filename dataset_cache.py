@@ -0,0 +1,63 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+
+ENCODED_KEYS = ['input_ids', 'attention_mask', 'labels']
+
+
+def get_cache_key(*parts):
+    '''
+    Hash of the parts that determine the tokenized dataset; DataFrames are hashed by content
+    '''
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            sha1.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+        else:
+            sha1.update(repr(part).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class EncodedDataset(Dataset):
+    '''
+    Dataset over pre-tokenized arrays, one row per sentence
+    '''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.len = len(arrays[ENCODED_KEYS[0]])
+
+    def __getitem__(self, index):
+        return {key: torch.as_tensor(np.asarray(array[index], dtype=np.int64)) for key, array in self.arrays.items()}
+
+    def __len__(self):
+        return self.len
+
+
+def load_or_encode_dataset(encode_arrays, cache_dir, cache_key):
+    '''
+    Tokenize the dataset once with encode_arrays() (padded input_ids, attention_mask and labels arrays, see
+    ner_dataset.encode_dataset) and keep the arrays as .npy files in cache_dir/cache_key. The arrays are
+    memory-mapped, so concurrent runs on one machine share them through the page cache.
+    '''
+    cache_path = os.path.join(cache_dir, cache_key)
+    if not os.path.isdir(cache_path):
+        print("Tokenizing dataset into {0}... ".format(cache_path), end='')
+        arrays = encode_arrays()
+        temporary_path = '{0}.tmp{1}'.format(cache_path, os.getpid())
+        os.makedirs(temporary_path, exist_ok=True)
+        for key in ENCODED_KEYS:
+            # token ids and labels fit into int32, which halves the size of the cache
+            np.save(os.path.join(temporary_path, key + '.npy'), np.asarray(arrays[key]).astype(np.int32))
+        try:
+            os.rename(temporary_path, cache_path)
+        except OSError:
+            # another run finished the same cache first
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        print("Done.")
+    return EncodedDataset({key: np.load(os.path.join(cache_path, key + '.npy'), mmap_mode='r')
+                           for key in ENCODED_KEYS})
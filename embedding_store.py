@@ -0,0 +1,230 @@
+'''
+Binary, memory-mapped store of pretrained token embeddings (GloVe / word2vec text format: one token and its
+vector components per line, separated by spaces).
+
+The text file is converted once:
+    python embedding_store.py --input data/glove.6B.100d.txt --output data/glove.6B.100d.store
+into a folder with
+    vectors.npy        float32 matrix, one row per token
+    tokens.bin         utf-8 bytes of all tokens, one after the other
+    token_offsets.npy  start of the token of every row in tokens.bin (and the end of the last one)
+    token_hashes.npy   sorted 64 bit hashes of the tokens, with
+    token_rows.npy     the row of every hash
+    manifest.json      number of tokens, dimension and the source file
+Loading only maps the files, so it takes milliseconds whatever the size of the vectors, and a token is found by
+binary search of its hash. Set parameters['token_pretrained_embedding_filepath'] to the folder to have
+utils_nlp.load_pretrained_token_embeddings return the store instead of a dict.
+'''
+import argparse
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+
+STORE_FORMAT_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+DIGIT_PATTERN = re.compile(r'\d')
+
+
+def get_token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def get_normalized_tokens(token, check_for_lowercase=True, check_for_digits_replaced_with_zeros=True):
+    '''
+    The forms of token looked up, in the order of utils_nlp.is_token_in_pretrained_embeddings
+    '''
+    tokens = [token]
+    if check_for_lowercase:
+        tokens.append(token.lower())
+    if check_for_digits_replaced_with_zeros:
+        tokens.append(DIGIT_PATTERN.sub('0', token))
+    if check_for_lowercase and check_for_digits_replaced_with_zeros:
+        tokens.append(DIGIT_PATTERN.sub('0', token.lower()))
+    return tokens
+
+
+def get_vector_dimension(text_filepath):
+    '''
+    Number of vectors and most common number of vector components of a text embedding file; lines with another number
+    of components (e.g. a word2vec header) are skipped by the conversion
+    '''
+    dimensions = collections.Counter()
+    with open(text_filepath, 'r', encoding='utf-8') as f:
+        for line in f:
+            dimensions[line.strip().count(' ')] += 1
+    dimension, number_of_vectors = dimensions.most_common(1)[0]
+    return number_of_vectors, dimension
+
+
+def convert_text_embeddings(text_filepath, store_dir):
+    '''
+    Convert a text embedding file into a store in store_dir. A token that occurs several times gets the vector of its
+    last line, as in utils_nlp.load_pretrained_token_embeddings.
+    '''
+    number_of_vectors, dimension = get_vector_dimension(text_filepath)
+    temporary_dir = '{0}.tmp{1}'.format(store_dir.rstrip('/'), os.getpid())
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+
+    vectors = np.lib.format.open_memmap(os.path.join(temporary_dir, 'vectors.npy'), mode='w+', dtype=np.float32,
+                                        shape=(number_of_vectors, dimension))
+    token_rows = {}
+    token_offsets = [0]
+    with open(text_filepath, 'r', encoding='utf-8') as f, \
+            open(os.path.join(temporary_dir, 'tokens.bin'), 'wb') as tokens_file:
+        row = 0
+        for line in f:
+            line = line.strip().split(' ')
+            if len(line) != dimension + 1:
+                continue
+            vectors[row] = np.asarray(line[1:], dtype=np.float32)
+            token = line[0]
+            token_rows[token] = row
+            token_bytes = token.encode('utf-8')
+            tokens_file.write(token_bytes)
+            token_offsets.append(token_offsets[-1] + len(token_bytes))
+            row += 1
+    vectors.flush()
+    del vectors
+    np.save(os.path.join(temporary_dir, 'token_offsets.npy'), np.array(token_offsets, dtype=np.int64))
+    hashes = np.fromiter((get_token_hash(token) for token in token_rows), dtype=np.uint64, count=len(token_rows))
+    rows = np.fromiter(token_rows.values(), dtype=np.int64, count=len(token_rows))
+    order = np.argsort(hashes, kind='stable')
+    np.save(os.path.join(temporary_dir, 'token_hashes.npy'), hashes[order])
+    np.save(os.path.join(temporary_dir, 'token_rows.npy'), rows[order])
+    manifest = {'format_version': STORE_FORMAT_VERSION,
+                'number_of_vectors': number_of_vectors,
+                'number_of_tokens': len(token_rows),
+                'dimension': dimension,
+                'source': os.path.abspath(text_filepath),
+                'source_size': os.path.getsize(text_filepath)}
+    with open(os.path.join(temporary_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(temporary_dir, store_dir)
+    return manifest
+
+
+def is_embedding_store(filepath):
+    return os.path.isfile(os.path.join(filepath, MANIFEST_FILENAME))
+
+
+class EmbeddingStore:
+    '''
+    Memory-mapped store written by convert_text_embeddings. It can be used like the dict of
+    utils_nlp.load_pretrained_token_embeddings (token in store, store[token], len(store), iterating over the tokens),
+    and get_indices / get_vectors look up many tokens at once, with the lowercase and digits replaced with zeros
+    fallbacks of utils_nlp.is_token_in_pretrained_embeddings.
+    '''
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, MANIFEST_FILENAME)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] > STORE_FORMAT_VERSION:
+            raise ValueError("Embedding store format {0} is newer than the supported format {1}: {2}".format(
+                self.manifest['format_version'], STORE_FORMAT_VERSION, store_dir))
+        self.store_dir = store_dir
+        self.dimension = self.manifest['dimension']
+        self.vectors = np.load(os.path.join(store_dir, 'vectors.npy'), mmap_mode='r')
+        self.token_offsets = np.load(os.path.join(store_dir, 'token_offsets.npy'), mmap_mode='r')
+        self.token_hashes = np.load(os.path.join(store_dir, 'token_hashes.npy'), mmap_mode='r')
+        self.token_rows = np.load(os.path.join(store_dir, 'token_rows.npy'), mmap_mode='r')
+        self.token_bytes = np.memmap(os.path.join(store_dir, 'tokens.bin'), dtype=np.uint8, mode='r') \
+            if self.token_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def get_token(self, row):
+        return self.token_bytes[self.token_offsets[row]:self.token_offsets[row + 1]].tobytes().decode('utf-8')
+
+    def get_row(self, token):
+        '''
+        Row of the vector of token, or -1
+        '''
+        token_hash = np.uint64(get_token_hash(token))
+        position = int(np.searchsorted(self.token_hashes, token_hash))
+        # different tokens may share a hash: compare the tokens of all rows with the same hash
+        while position < len(self.token_hashes) and self.token_hashes[position] == token_hash:
+            row = int(self.token_rows[position])
+            if self.get_token(row) == token:
+                return row
+            position += 1
+        return -1
+
+    def get_index(self, token, check_for_lowercase=True, check_for_digits_replaced_with_zeros=True):
+        '''
+        Row of the first form of token (see get_normalized_tokens) that has a vector, or -1
+        '''
+        for normalized_token in get_normalized_tokens(token, check_for_lowercase, check_for_digits_replaced_with_zeros):
+            row = self.get_row(normalized_token)
+            if row >= 0:
+                return row
+        return -1
+
+    def get_indices(self, tokens, check_for_lowercase=True, check_for_digits_replaced_with_zeros=True):
+        '''
+        Rows of many tokens (-1 for tokens without vector), each distinct token being looked up once
+        '''
+        index_table = {}
+        indices = np.empty(len(tokens), dtype=np.int64)
+        for i, token in enumerate(tokens):
+            if token not in index_table:
+                index_table[token] = self.get_index(token, check_for_lowercase, check_for_digits_replaced_with_zeros)
+            indices[i] = index_table[token]
+        return indices
+
+    def get_vectors(self, tokens, check_for_lowercase=True, check_for_digits_replaced_with_zeros=True):
+        '''
+        Matrix of the vectors of tokens (zeros for tokens without vector), and the mask of tokens that have one
+        '''
+        indices = self.get_indices(tokens, check_for_lowercase, check_for_digits_replaced_with_zeros)
+        found = indices >= 0
+        vectors = np.zeros((len(tokens), self.dimension), dtype=np.float32)
+        vectors[found] = self.vectors[indices[found]]
+        return vectors, found
+
+    def __contains__(self, token):
+        return self.get_row(token) >= 0
+
+    def __getitem__(self, token):
+        row = self.get_row(token)
+        if row < 0:
+            raise KeyError(token)
+        return self.vectors[row]
+
+    def get(self, token, default=None):
+        row = self.get_row(token)
+        return self.vectors[row] if row >= 0 else default
+
+    def __len__(self):
+        return len(self.token_hashes)
+
+    def __iter__(self):
+        for row in np.sort(self.token_rows):
+            yield self.get_token(int(row))
+
+    def keys(self):
+        return iter(self)
+
+
+def load_embedding_store(store_dir):
+    return EmbeddingStore(store_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a text embedding file (GloVe / word2vec format) into a '
+                                                 'memory-mapped embedding store')
+    parser.add_argument('--input', required=True, help='text embedding file, one token and its vector per line')
+    parser.add_argument('--output', required=True, help='store folder to create')
+    args = parser.parse_args()
+    manifest = convert_text_embeddings(args.input, args.output)
+    print("{0} vectors of dimension {1} written to {2}".format(manifest['number_of_tokens'], manifest['dimension'],
+                                                               args.output))
+
+
+if __name__ == '__main__':
+    main()
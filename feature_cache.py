@@ -0,0 +1,128 @@
+'''
+Memory-mapped cache of the hidden states of a frozen encoder, one float16 vector per word (the first word piece of
+every word, as in the label alignment of ner_dataset.SentenceEncoder), for training only the classification head
+(train_ner_v1.py --head_only).
+
+The encoder runs once over the distinct token sequences of the corpus; the labels are not part of the cache, so adding
+or renaming labels reuses it. A cache folder holds
+    features.npy          float16 (words, hidden size) matrix, the words of all sentences one after the other
+    sentence_offsets.npy  first row of every sentence in features (and the end of the last one)
+    manifest.json         encoder, layer, max_len, numbers of sentences and words
+Words beyond max_len word pieces have no features, a sentence has at most as many rows as words.
+'''
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from dataset_cache import get_cache_key
+from ner_dataset import SentenceEncoder
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def get_unique_token_sequences(sentences):
+    '''
+    The distinct token sequences of sentences (lists of words) in order of first occurrence, and the index of every
+    sentence in them
+    '''
+    sequence_indices = {}
+    sentence_indices = np.fromiter((sequence_indices.setdefault(tuple(tokens), len(sequence_indices))
+                                    for tokens in sentences), dtype=np.int64, count=len(sentences))
+    return [list(tokens) for tokens in sequence_indices], sentence_indices
+
+
+def get_feature_cache_key(encoder_id, layer, max_len, sequences):
+    return get_cache_key(encoder_id, layer, max_len, '\n'.join(' '.join(tokens) for tokens in sequences))
+
+
+def compute_features(model, tokenizer, sequences, layer, max_len, feature_dir, device, batch_size=64):
+    '''
+    Write the layer hidden states of the first word piece of every word of sequences into feature_dir
+    (hidden_states[layer] of the base model: 0 are the embeddings, -1 the last layer)
+    '''
+    encoder = SentenceEncoder(tokenizer, max_len)
+    hidden_size = model.config.hidden_size
+    was_training = model.training
+    model.eval()
+    # one row per word, except the words that are truncated away
+    batches, number_of_words = [], 0
+    for start in range(0, len(sequences), batch_size):
+        arrays = encoder.encode(sequences[start:start + batch_size])
+        batches.append(arrays)
+        number_of_words += int(arrays['first_pieces'].sum())
+    temporary_dir = '{0}.tmp{1}'.format(feature_dir.rstrip('/'), os.getpid())
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    features = np.lib.format.open_memmap(os.path.join(temporary_dir, 'features.npy'), mode='w+', dtype=np.float16,
+                                         shape=(number_of_words, hidden_size))
+    words_per_sentence = []
+    row = 0
+    with torch.no_grad():
+        for arrays in batches:
+            outputs = model.base_model(input_ids=torch.as_tensor(arrays['input_ids'], device=device),
+                                       attention_mask=torch.as_tensor(arrays['attention_mask'], device=device),
+                                       output_hidden_states=True)
+            hidden_states = outputs.hidden_states[layer]
+            first_pieces = torch.as_tensor(arrays['first_pieces'], device=device)
+            batch_features = hidden_states[first_pieces].cpu().numpy().astype(np.float16)
+            features[row:row + len(batch_features)] = batch_features
+            row += len(batch_features)
+            words_per_sentence.extend(arrays['first_pieces'].sum(axis=1).tolist())
+    features.flush()
+    del features
+    np.save(os.path.join(temporary_dir, 'sentence_offsets.npy'),
+            np.concatenate([[0], np.cumsum(words_per_sentence)]).astype(np.int64))
+    model.train(was_training)
+    return temporary_dir, {'sentences': len(sequences), 'words': number_of_words, 'hidden_size': hidden_size}
+
+
+class FeatureCache:
+    '''
+    Features of a cache folder written by load_or_compute_features
+    '''
+    def __init__(self, feature_dir):
+        with open(os.path.join(feature_dir, MANIFEST_FILENAME)) as f:
+            self.manifest = json.load(f)
+        self.features = np.load(os.path.join(feature_dir, 'features.npy'), mmap_mode='r')
+        self.sentence_offsets = np.load(os.path.join(feature_dir, 'sentence_offsets.npy'))
+        self.hidden_size = self.manifest['hidden_size']
+
+    def get_word_rows(self, sequence_indices, words_per_sentence):
+        '''
+        Feature rows of the words of the given sequences, and the number of words of every sentence that have
+        features (the first words_per_sentence[i] at most)
+        '''
+        starts = self.sentence_offsets[sequence_indices]
+        lengths = np.minimum(self.sentence_offsets[np.asarray(sequence_indices) + 1] - starts, words_per_sentence)
+        rows = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+        return rows, lengths
+
+
+def load_or_compute_features(model, tokenizer, sentences, layer, max_len, cache_dir, encoder_id, device,
+                             batch_size=64):
+    '''
+    FeatureCache of the sentences (lists of words), computed with model unless cache_dir already has it, and the
+    index of every sentence in it
+    '''
+    sequences, sentence_indices = get_unique_token_sequences(sentences)
+    feature_dir = os.path.join(cache_dir, get_feature_cache_key(encoder_id, layer, max_len, sequences))
+    if not os.path.isdir(feature_dir):
+        print("Computing encoder features of {0} sentences into {1}... ".format(len(sequences), feature_dir))
+        os.makedirs(cache_dir, exist_ok=True)
+        temporary_dir, manifest = compute_features(model, tokenizer, sequences, layer, max_len, feature_dir, device,
+                                                   batch_size)
+        manifest.update({'encoder': encoder_id, 'layer': layer, 'max_len': max_len})
+        with open(os.path.join(temporary_dir, MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.rename(temporary_dir, feature_dir)
+        except OSError:
+            # another run finished the same cache first
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+        print("Done.")
+    else:
+        print("Using the encoder features in {0}".format(feature_dir))
+    return FeatureCache(feature_dir), sentence_indices
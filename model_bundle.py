@@ -0,0 +1,173 @@
+'''
+Self-describing model bundle: one folder with the weights, the tokenizer files, the model config, the label vocabulary
+and the inference config, described by a manifest with the sha256 of every file.
+
+    trained_model/pico_bundle/
+        manifest.json
+        model.safetensors
+        config.json
+        tokenizer files (tokenizer.json, vocab.txt, ...)
+
+Loading needs neither the hub nor the label pickles, and the weights are read tensor by tensor from the
+memory-mapped safetensors file. Existing .model checkpoints can be converted with
+    python model_bundle.py --checkpoint trained_model/3_acc_0.9159417462513971.model --output trained_model/pico_bundle
+'''
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import AutoConfig, AutoModelForTokenClassification, AutoTokenizer
+
+from model_pruning import apply_pruned_structure
+
+BUNDLE_FORMAT_VERSION = 1
+MANIFEST_FILENAME = 'manifest.json'
+WEIGHTS_FILENAME = 'model.safetensors'
+DEFAULT_INFERENCE_CONFIG = {'max_len': 256,
+                            'spacy_model': 'en_core_sci_lg'}
+
+
+def get_file_sha256(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def save_model_bundle(bundle_dir, model, tokenizer, ids_to_labels, inference_config=None, state_dict=None):
+    '''
+    Write model (or state_dict, with the architecture of model), tokenizer and labels as a bundle.
+    The bundle is assembled in a temporary folder and moved into place at the end, so bundle_dir is either the old
+    or the complete new bundle.
+    '''
+    temporary_dir = '{0}.tmp{1}'.format(bundle_dir.rstrip('/'), os.getpid())
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+
+    labels = [ids_to_labels[i] for i in range(len(ids_to_labels))]
+    config = copy_config_with_labels(model.config, labels)
+    config.save_pretrained(temporary_dir)
+    tokenizer.save_pretrained(temporary_dir)
+    state_dict = state_dict if state_dict is not None else model.state_dict()
+    save_file({name: tensor.detach().cpu().contiguous() for name, tensor in state_dict.items()},
+              os.path.join(temporary_dir, WEIGHTS_FILENAME), metadata={'format': 'pt'})
+
+    files = {}
+    for filename in sorted(os.listdir(temporary_dir)):
+        filepath = os.path.join(temporary_dir, filename)
+        files[filename] = {'sha256': get_file_sha256(filepath), 'size': os.path.getsize(filepath)}
+    manifest = {'format_version': BUNDLE_FORMAT_VERSION,
+                'created': datetime.datetime.now().isoformat(),
+                'architecture': type(model).__name__,
+                'labels': labels,
+                'inference_config': dict(DEFAULT_INFERENCE_CONFIG, **(inference_config or {})),
+                'files': files}
+    with open(os.path.join(temporary_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.exists(bundle_dir):
+        shutil.rmtree(bundle_dir)
+    os.rename(temporary_dir, bundle_dir)
+    return manifest
+
+
+def copy_config_with_labels(config, labels):
+    config = config.__class__.from_dict(config.to_dict())
+    config.id2label = {i: label for i, label in enumerate(labels)}
+    config.label2id = {label: i for i, label in enumerate(labels)}
+    return config
+
+
+def read_manifest(bundle_dir):
+    with open(os.path.join(bundle_dir, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] > BUNDLE_FORMAT_VERSION:
+        raise ValueError("Model bundle format {0} is newer than the supported format {1}: {2}".format(
+            manifest['format_version'], BUNDLE_FORMAT_VERSION, bundle_dir))
+    return manifest
+
+
+def verify_model_bundle(bundle_dir, manifest=None):
+    '''
+    Check the size and sha256 of every file listed in the manifest
+    '''
+    manifest = manifest or read_manifest(bundle_dir)
+    for filename, file_info in manifest['files'].items():
+        filepath = os.path.join(bundle_dir, filename)
+        if not os.path.exists(filepath):
+            raise IOError("Model bundle file does not exist: {0}".format(filepath))
+        if os.path.getsize(filepath) != file_info['size'] or get_file_sha256(filepath) != file_info['sha256']:
+            raise ValueError("Model bundle file is corrupted (checksum mismatch): {0}".format(filepath))
+
+
+class ModelBundle:
+    def __init__(self, model, tokenizer, labels_to_ids, ids_to_labels, inference_config, manifest):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.labels_to_ids = labels_to_ids
+        self.ids_to_labels = ids_to_labels
+        self.inference_config = inference_config
+        self.manifest = manifest
+
+
+def load_model_bundle(bundle_dir, device='cpu', verify=True):
+    '''
+    Load a bundle written by save_model_bundle, ready for inference (model in eval mode on device).
+    verify=False skips hashing the files, e.g. for bundles that were verified when they were deployed.
+    '''
+    manifest = read_manifest(bundle_dir)
+    if verify:
+        verify_model_bundle(bundle_dir, manifest)
+    config = AutoConfig.from_pretrained(bundle_dir, local_files_only=True)
+    model = AutoModelForTokenClassification.from_config(config)
+    # a pruned model (see model_pruning.py) has fewer heads and FFN neurons than its config says
+    apply_pruned_structure(model)
+    # copy the weights one tensor at a time out of the memory-mapped file, which keeps the peak memory at about one
+    # copy of the model
+    with safe_open(os.path.join(bundle_dir, WEIGHTS_FILENAME), framework='pt') as f:
+        saved_names = set(f.keys())
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                if name in saved_names:
+                    tensor.copy_(f.get_tensor(name))
+                elif not name.endswith('position_ids'):  # a buffer that only some transformers versions save
+                    raise ValueError("Model bundle has no weights for {0}: {1}".format(name, bundle_dir))
+    model.to(device)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(bundle_dir, local_files_only=True)
+    labels = manifest['labels']
+    return ModelBundle(model, tokenizer, {label: i for i, label in enumerate(labels)}, dict(enumerate(labels)),
+                       manifest['inference_config'], manifest)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a trained .model checkpoint and the label pickles into a '
+                                                 'model bundle')
+    parser.add_argument('--checkpoint', required=True, help='state dict saved by train_ner_v1.py (.model)')
+    parser.add_argument('--output', required=True, help='bundle folder to create')
+    parser.add_argument('--model_name', default="microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext",
+                        help='pretrained model the checkpoint was fine-tuned from')
+    parser.add_argument('--label_dir', default='output', help='folder of ids_to_labels.pickle')
+    parser.add_argument('--max_len', type=int, default=DEFAULT_INFERENCE_CONFIG['max_len'])
+    args = parser.parse_args()
+
+    with open(os.path.join(args.label_dir, 'ids_to_labels.pickle'), 'rb') as handle:
+        ids_to_labels = pickle.load(handle)
+    model = AutoModelForTokenClassification.from_pretrained(args.model_name, num_labels=len(ids_to_labels))
+    model.load_state_dict(torch.load(args.checkpoint, map_location=torch.device('cpu')))
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    save_model_bundle(args.output, model, tokenizer, ids_to_labels,
+                      {'max_len': args.max_len, 'model_name': args.model_name})
+    print("Model bundle written to {0}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+'''
+Structured pruning of the attention heads and FFN neurons of a fine-tuned BERT token classification model.
+
+The importance of a head (or neuron) is the gradient of the loss with respect to a mask on its output, accumulated
+over batches as in Michel et al., "Are Sixteen Heads Really Better than One?". It needs no masks in the model: for the
+output o of a unit that goes through a linear layer W, dL/dmask = sum(o * dL/do) = sum(W * dL/dW) over the input
+columns of W that read the unit, so the scores come from the weight gradients of the attention output and FFN output
+layers after an ordinary backward pass.
+
+Pruning slices the query / key / value / attention output and the FFN layers of every encoder layer, so the pruned
+model is a smaller dense model. The number of heads and neurons left in every layer is written to the model config
+('pruned_layers'), and apply_pruned_structure rebuilds that architecture from the config before the weights are
+loaded (see model_bundle.load_model_bundle).
+'''
+import numpy as np
+import torch
+
+from sequence_packing import get_model_inputs
+
+PRUNED_LAYERS_KEY = 'pruned_layers'
+
+
+def get_encoder_layers(model):
+    return model.base_model.encoder.layer
+
+
+def get_layer_sizes(model):
+    '''
+    Number of attention heads and FFN neurons of every encoder layer
+    '''
+    return [{'num_attention_heads': layer.attention.self.num_attention_heads,
+             'intermediate_size': layer.intermediate.dense.out_features} for layer in get_encoder_layers(model)]
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def prune_linear(linear, indices, dim):
+    '''
+    Copy of linear with only the given output (dim=0) or input (dim=1) features
+    '''
+    indices = torch.as_tensor(indices, dtype=torch.long, device=linear.weight.device)
+    weight = linear.weight.index_select(dim, indices).detach().clone()
+    bias = None
+    if linear.bias is not None:
+        bias = linear.bias[indices] if dim == 0 else linear.bias
+        bias = bias.detach().clone()
+    new_size = list(linear.weight.size())
+    new_size[dim] = len(indices)
+    pruned = torch.nn.Linear(new_size[1], new_size[0], bias=bias is not None).to(linear.weight.device,
+                                                                               linear.weight.dtype)
+    with torch.no_grad():
+        pruned.weight.copy_(weight)
+        if bias is not None:
+            pruned.bias.copy_(bias)
+    return pruned
+
+
+def prune_layer(layer, kept_heads, kept_neurons):
+    '''
+    Keep only the attention heads kept_heads and the FFN neurons kept_neurons of an encoder layer
+    '''
+    self_attention = layer.attention.self
+    head_size = self_attention.attention_head_size
+    kept_heads = np.sort(np.asarray(kept_heads, dtype=np.int64))
+    head_columns = (kept_heads[:, None] * head_size + np.arange(head_size)).reshape(-1)
+    self_attention.query = prune_linear(self_attention.query, head_columns, 0)
+    self_attention.key = prune_linear(self_attention.key, head_columns, 0)
+    self_attention.value = prune_linear(self_attention.value, head_columns, 0)
+    layer.attention.output.dense = prune_linear(layer.attention.output.dense, head_columns, 1)
+    self_attention.num_attention_heads = len(kept_heads)
+    self_attention.all_head_size = len(kept_heads) * head_size
+
+    kept_neurons = np.sort(np.asarray(kept_neurons, dtype=np.int64))
+    layer.intermediate.dense = prune_linear(layer.intermediate.dense, kept_neurons, 0)
+    layer.output.dense = prune_linear(layer.output.dense, kept_neurons, 1)
+
+
+def prune_model(model, kept_heads, kept_neurons):
+    '''
+    Prune model in place to the heads and neurons kept in every layer (lists of index arrays, one per layer) and
+    record the new layer sizes in its config
+    '''
+    for layer, layer_heads, layer_neurons in zip(get_encoder_layers(model), kept_heads, kept_neurons):
+        prune_layer(layer, layer_heads, layer_neurons)
+    setattr(model.config, PRUNED_LAYERS_KEY, get_layer_sizes(model))
+    return model
+
+
+def apply_pruned_structure(model):
+    '''
+    Give a model built from a config with 'pruned_layers' the layer sizes of the pruned model, so that its weights
+    can be loaded; the values of the weights are not kept
+    '''
+    layer_sizes = getattr(model.config, PRUNED_LAYERS_KEY, None)
+    if not layer_sizes:
+        return model
+    for layer, sizes in zip(get_encoder_layers(model), layer_sizes):
+        prune_layer(layer, np.arange(sizes['num_attention_heads']), np.arange(sizes['intermediate_size']))
+    return model
+
+
+def compute_importance(model, data_loader, device):
+    '''
+    Importance scores of the heads and of the FFN neurons of every layer (lists of arrays, one per layer) on the
+    labelled batches of data_loader
+    '''
+    was_training = model.training
+    # no dropout, the scores are those of the model used for inference
+    model.eval()
+    layers = get_encoder_layers(model)
+    head_scores = [torch.zeros(layer.attention.self.num_attention_heads, device=device) for layer in layers]
+    neuron_scores = [torch.zeros(layer.intermediate.dense.out_features, device=device) for layer in layers]
+    for batch in data_loader:
+        model.zero_grad()
+        outputs = model(**get_model_inputs(batch, device))
+        outputs[0].backward()
+        with torch.no_grad():
+            for i, layer in enumerate(layers):
+                attention_output = layer.attention.output.dense.weight
+                head_gradients = (attention_output * attention_output.grad).sum(0)
+                head_scores[i] += head_gradients.view(len(head_scores[i]), -1).sum(-1).abs()
+                ffn_output = layer.output.dense.weight
+                neuron_scores[i] += (ffn_output * ffn_output.grad).sum(0).abs()
+    model.zero_grad()
+    model.train(was_training)
+    return [scores.cpu().numpy() for scores in head_scores], [scores.cpu().numpy() for scores in neuron_scores]
+
+
+def select_kept_units(scores, prune_fraction, minimum_per_layer=1):
+    '''
+    Indices of the units kept in every layer when the prune_fraction least important units of all layers are removed.
+    The scores are normalized per layer (L2 norm) before they are ranked across layers, and every layer keeps at least
+    minimum_per_layer units.
+    '''
+    normalized_scores = [layer_scores / max(np.linalg.norm(layer_scores), 1e-12) for layer_scores in scores]
+    layer_ids = np.concatenate([np.full(len(layer_scores), i) for i, layer_scores in enumerate(scores)])
+    unit_ids = np.concatenate([np.arange(len(layer_scores)) for layer_scores in scores])
+    order = np.argsort(np.concatenate(normalized_scores), kind='stable')
+    kept = [np.ones(len(layer_scores), dtype=bool) for layer_scores in scores]
+    remaining = [len(layer_scores) for layer_scores in scores]
+    units_to_prune = int(round(prune_fraction * len(order)))
+    for position in order:
+        if units_to_prune == 0:
+            break
+        layer_id = layer_ids[position]
+        if remaining[layer_id] > minimum_per_layer:
+            kept[layer_id][unit_ids[position]] = False
+            remaining[layer_id] -= 1
+            units_to_prune -= 1
+    return [np.flatnonzero(layer_kept) for layer_kept in kept]
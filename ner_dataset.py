@@ -0,0 +1,116 @@
+'''
+Datasets of word-split sentences for training and inference, tokenized a whole batch at a time.
+
+NERDataset items are the words (and labels, and any extra columns) of one sentence. SentenceEncoder is the collate
+function: it tokenizes a batch with one call of the fast tokenizer and puts the label of every word on its first word
+piece with array operations on the word ids; the other word pieces, the special tokens and the padding get -100.
+
+    loader = DataLoader(NERDataset(df), batch_size=32, collate_fn=SentenceEncoder(tokenizer, max_len, labels_to_ids))
+
+encode_dataset tokenizes a whole dataset into fixed-length arrays, for the tokenized dataset cache and for sequence
+packing.
+'''
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+IGNORE_INDEX = -100
+
+
+def get_first_pieces(word_ids):
+    '''
+    Mask of the first word piece of every word, given the word ids of a batch (NaN for special tokens and padding)
+    '''
+    previous_word_ids = np.full_like(word_ids, np.nan)
+    previous_word_ids[:, 1:] = word_ids[:, :-1]
+    return ~np.isnan(word_ids) & (word_ids != previous_word_ids)
+
+
+class SentenceEncoder:
+    '''
+    Batch tokenization of word-split sentences and label alignment. padding='longest' pads a batch to its longest
+    sentence, 'max_length' to max_len.
+    '''
+    def __init__(self, tokenizer, max_len, labels_to_ids=None, padding='longest'):
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+        self.labels_to_ids = labels_to_ids
+        self.padding = padding
+
+    def encode(self, sentences, word_labels=None):
+        '''
+        input_ids, attention_mask and, with word_labels, the labels of a batch of sentences (lists of words) as numpy
+        arrays; without word_labels, the mask of the first word pieces ('first_pieces') instead of the labels
+        '''
+        encoding = self.tokenizer(list(sentences), is_split_into_words=True, padding=self.padding, truncation=True,
+                                  max_length=self.max_len, return_tensors='np')
+        # None (special tokens and padding) becomes NaN
+        word_ids = np.array([encoding.word_ids(i) for i in range(len(sentences))], dtype=float)
+        first_pieces = get_first_pieces(word_ids)
+        arrays = {'input_ids': encoding['input_ids'].astype(np.int64),
+                  'attention_mask': encoding['attention_mask'].astype(np.int64)}
+        if word_labels is None:
+            arrays['first_pieces'] = first_pieces
+            return arrays
+        for i, (words, labels) in enumerate(zip(sentences, word_labels)):
+            if len(words) != len(labels):
+                raise ValueError("Sentence {0} of the batch has {1} words and {2} labels: {3}".format(
+                    i, len(words), len(labels), ' '.join(words)))
+        label_ids = np.fromiter((self.labels_to_ids[label] for labels in word_labels for label in labels),
+                                dtype=np.int64)
+        # the labels of all sentences one after the other, with a last one for the positions that are not used (the
+        # start of an empty last sentence)
+        label_ids = np.append(label_ids, IGNORE_INDEX)
+        sentence_starts = np.cumsum([0] + [len(labels) for labels in word_labels[:-1]])
+        positions = sentence_starts[:, None] + np.where(first_pieces, word_ids, 0).astype(np.int64)
+        arrays['labels'] = np.where(first_pieces, label_ids[positions], IGNORE_INDEX)
+        return arrays
+
+    def __call__(self, items):
+        '''
+        Collate function: the batch of the encoded sentences of items, with their other fields collated as usual
+        '''
+        word_labels = [item['labels'] for item in items] if 'labels' in items[0] else None
+        arrays = self.encode([item['tokens'] for item in items], word_labels)
+        batch = {key: torch.as_tensor(array) for key, array in arrays.items()}
+        other_keys = [key for key in items[0] if key not in ['tokens', 'labels']]
+        if other_keys:
+            batch.update(default_collate([{key: item[key] for key in other_keys} for item in items]))
+        return batch
+
+
+class NERDataset(Dataset):
+    '''
+    Sentences of a DataFrame with a 'tokens' column of word lists, an optional 'labels' column of label lists, and
+    the extra columns given
+    '''
+    def __init__(self, dataframe, columns=()):
+        self.len = len(dataframe)
+        self.tokens = dataframe['tokens'].tolist()
+        self.labels = dataframe['labels'].tolist() if 'labels' in dataframe else None
+        self.columns = {column: dataframe[column].tolist() for column in columns}
+
+    def __getitem__(self, index):
+        item = {'tokens': self.tokens[index]}
+        if self.labels is not None:
+            item['labels'] = self.labels[index]
+        for column, values in self.columns.items():
+            item[column] = values[index]
+        return item
+
+    def __len__(self):
+        return self.len
+
+
+def encode_dataset(ner_dataset, tokenizer, max_len, labels_to_ids, batch_size=1024):
+    '''
+    input_ids, attention_mask and labels of every sentence of ner_dataset, padded to max_len, as int32 arrays
+    '''
+    encoder = SentenceEncoder(tokenizer, max_len, labels_to_ids, padding='max_length')
+    batches = []
+    for start in range(0, len(ner_dataset), batch_size):
+        items = [ner_dataset[index] for index in range(start, min(start + batch_size, len(ner_dataset)))]
+        batches.append(encoder.encode([item['tokens'] for item in items], [item['labels'] for item in items]))
+    return {key: np.concatenate([batch[key] for batch in batches]).astype(np.int32) if batches else
+            np.zeros((0, max_len), dtype=np.int32) for key in ['input_ids', 'attention_mask', 'labels']}
@@ -0,0 +1,201 @@
+import numpy as np
+import torch
+
+
+def split_tag(label):
+    '''
+    'B-Outcome' -> ('B', 'Outcome'), 'O' -> ('O', '')
+    '''
+    if label == 'O':
+        return 'O', ''
+    return label[0], label[2:]
+
+
+def end_of_chunk(previous_tag, tag, previous_type, type_):
+    '''
+    Same rules as conlleval: does a chunk end between the previous and the current word
+    '''
+    return previous_tag in ['E', 'S'] or \
+           previous_tag in ['B', 'I'] and tag in ['B', 'S', 'O'] or \
+           previous_tag != 'O' and previous_type != type_
+
+
+def start_of_chunk(previous_tag, tag, previous_type, type_):
+    '''
+    Same rules as conlleval: does a chunk start at the current word
+    '''
+    return tag in ['B', 'S'] or \
+           previous_tag in ['E', 'S', 'O'] and tag in ['E', 'I'] or \
+           tag != 'O' and previous_type != type_
+
+
+def get_chunks(labels):
+    '''
+    Entity chunks (start, end, type) of a sequence of BIO or BIOES labels, end exclusive
+    '''
+    chunks = []
+    previous_tag, previous_type = 'O', ''
+    chunk_start = None
+    for i, label in enumerate(labels):
+        tag, type_ = split_tag(label)
+        if chunk_start is not None and end_of_chunk(previous_tag, tag, previous_type, type_):
+            chunks.append((chunk_start, i, previous_type))
+            chunk_start = None
+        if start_of_chunk(previous_tag, tag, previous_type, type_):
+            chunk_start = i
+        previous_tag, previous_type = tag, type_
+    if chunk_start is not None:
+        chunks.append((chunk_start, len(labels), previous_type))
+    return chunks
+
+
+def get_chunk_tables(labels):
+    '''
+    Tables of the conlleval chunk rules over label ids; the last row stands for the start of a sentence (previous
+    label 'O'):
+        starts[previous id, id]   a chunk starts at the current word
+        ends[previous id, id]     the chunk of the previous word ends before the current word
+    '''
+    tags_and_types = [split_tag(label) for label in labels] + [('O', '')]
+    starts = np.zeros((len(labels) + 1, len(labels)), dtype=bool)
+    ends = np.zeros((len(labels) + 1, len(labels)), dtype=bool)
+    for previous_id, (previous_tag, previous_type) in enumerate(tags_and_types):
+        for label_id, (tag, type_) in enumerate(tags_and_types[:-1]):
+            starts[previous_id, label_id] = start_of_chunk(previous_tag, tag, previous_type, type_)
+            # every word that is not 'O' is in a chunk, so the previous word is in a chunk unless it is 'O'
+            ends[previous_id, label_id] = previous_tag != 'O' and end_of_chunk(previous_tag, tag, previous_type, type_)
+    return starts, ends
+
+
+class EntityEvaluator:
+    '''
+    Entity-level precision, recall and F1 per type, computed like conlleval from label-id arrays. Batches are added
+    with update_batch (or single sentences with update) and only the counts per type are kept, so the memory does not
+    grow with the number of sentences.
+    '''
+    def __init__(self, ids_to_labels):
+        self.types = []
+        self.correct_chunks = np.zeros(0, dtype=np.int64)
+        self.gold_chunks = np.zeros(0, dtype=np.int64)
+        self.predicted_chunks = np.zeros(0, dtype=np.int64)
+        self.correct_tokens = 0
+        self.total_tokens = 0
+        self.set_labels(ids_to_labels)
+
+    def set_labels(self, ids_to_labels):
+        '''
+        Use the label ids of ids_to_labels from now on, e.g. when labels were added; the counts are kept
+        '''
+        self.ids_to_labels = ids_to_labels
+        labels = [ids_to_labels[i] for i in range(len(ids_to_labels))]
+        types = sorted(set(self.types) | set(split_tag(label)[1] for label in labels) - {''})
+        type_ids = {type_: i for i, type_ in enumerate(types)}
+        self.label_types = np.array([type_ids.get(split_tag(label)[1], -1) for label in labels], dtype=np.int64)
+        self.chunk_starts, self.chunk_ends = get_chunk_tables(labels)
+        old_type_ids = np.array([type_ids[type_] for type_ in self.types], dtype=np.int64)
+        for name in ['correct_chunks', 'gold_chunks', 'predicted_chunks']:
+            counts = np.zeros(len(types), dtype=np.int64)
+            counts[old_type_ids] = getattr(self, name)
+            setattr(self, name, counts)
+        self.types = types
+
+    def get_chunks(self, label_ids, sentence_starts):
+        '''
+        Entity chunks of the words label_ids, whose sentences start where sentence_starts is True, as start and end
+        (exclusive) positions and type ids
+        '''
+        previous_ids = np.empty(len(label_ids), dtype=np.int64)
+        previous_ids[1:] = label_ids[:-1]
+        previous_ids[sentence_starts] = len(self.label_types)
+        starts = np.flatnonzero(self.chunk_starts[previous_ids, label_ids])
+        # a chunk ends before the first word after its start that ends it or starts a sentence
+        ends = np.append(np.flatnonzero(self.chunk_ends[previous_ids, label_ids] | sentence_starts), len(label_ids))
+        ends = ends[np.searchsorted(ends, starts, side='right')]
+        return starts, ends, self.label_types[label_ids[starts]]
+
+    def update_batch(self, label_ids, prediction_ids, sentence_starts):
+        '''
+        Add the words of several sentences: label ids, predicted label ids, and True at the first word of every
+        sentence
+        '''
+        label_ids = np.asarray(label_ids, dtype=np.int64)
+        prediction_ids = np.asarray(prediction_ids, dtype=np.int64)
+        sentence_starts = np.asarray(sentence_starts, dtype=bool)
+        self.correct_tokens += int((label_ids == prediction_ids).sum())
+        self.total_tokens += len(label_ids)
+        if len(label_ids) == 0:
+            return
+        gold_starts, gold_ends, gold_types = self.get_chunks(label_ids, sentence_starts)
+        predicted_starts, predicted_ends, predicted_types = self.get_chunks(prediction_ids, sentence_starts)
+        self.gold_chunks += np.bincount(gold_types, minlength=len(self.types))
+        self.predicted_chunks += np.bincount(predicted_types, minlength=len(self.types))
+        # a predicted chunk is correct if a gold chunk has the same start, end and type
+        key_base = np.int64(len(label_ids) + 1)
+        gold_keys = (gold_starts * key_base + gold_ends) * len(self.types) + gold_types
+        predicted_keys = (predicted_starts * key_base + predicted_ends) * len(self.types) + predicted_types
+        correct_keys = np.intersect1d(gold_keys, predicted_keys, assume_unique=True)
+        self.correct_chunks += np.bincount(correct_keys % len(self.types), minlength=len(self.types))
+
+    def update_padded_batch(self, label_ids, prediction_ids, ignore_index=-100):
+        '''
+        Add a (batch size, sequence length) batch, in which only the positions whose label is not ignore_index are
+        words (e.g. the first word piece of every word)
+        '''
+        label_ids = np.asarray(label_ids)
+        active = label_ids != ignore_index
+        sentence_starts = active & (np.cumsum(active, axis=1) == 1)
+        self.update_batch(label_ids[active], np.asarray(prediction_ids)[active], sentence_starts[active])
+
+    def update(self, label_ids, prediction_ids):
+        '''
+        Add one sentence, given as the label ids and predicted label ids of its words
+        '''
+        sentence_starts = np.zeros(len(label_ids), dtype=bool)
+        sentence_starts[:1] = True
+        self.update_batch(label_ids, prediction_ids, sentence_starts)
+
+    def compute(self):
+        '''
+        Same dict as utils_nlp.get_parsed_conll_output: percentages, and like conlleval the support of a type is the
+        number of predicted chunks of that type
+        '''
+        def scores(correct, gold, predicted):
+            precision = 100.0 * correct / predicted if predicted > 0 else 0.0
+            recall = 100.0 * correct / gold if gold > 0 else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+            return {'precision': precision, 'recall': recall, 'f1': f1}
+
+        parsed_output = {}
+        parsed_output['all'] = scores(int(self.correct_chunks.sum()), int(self.gold_chunks.sum()),
+                                      int(self.predicted_chunks.sum()))
+        parsed_output['all']['accuracy'] = 100.0 * self.correct_tokens / self.total_tokens if self.total_tokens else 0.0
+        total_support = 0
+        for i, type_ in enumerate(self.types):
+            if self.gold_chunks[i] == 0 and self.predicted_chunks[i] == 0:
+                continue
+            support = int(self.predicted_chunks[i])
+            total_support += support
+            parsed_output[type_.replace('_', '-')] = scores(int(self.correct_chunks[i]), int(self.gold_chunks[i]),
+                                                           support)
+            parsed_output[type_.replace('_', '-')]['support'] = support
+        parsed_output['all']['support'] = total_support
+        return parsed_output
+
+
+def evaluate_model(model, data_loader, ids_to_labels, device):
+    '''
+    Entity-level evaluation of a token classification model on the batches of data_loader.
+    Only the first word piece of every word carries a label (the others are -100).
+    '''
+    was_training = model.training
+    model.eval()
+    evaluator = EntityEvaluator(ids_to_labels)
+    with torch.no_grad():
+        for batch in data_loader:
+            ids = batch['input_ids'].to(device, dtype=torch.long)
+            mask = batch['attention_mask'].to(device, dtype=torch.long)
+            outputs = model(input_ids=ids, attention_mask=mask)
+            predictions = torch.argmax(outputs[0], axis=-1).cpu().numpy()
+            evaluator.update_padded_batch(batch['labels'].numpy(), predictions)
+    model.train(was_training)
+    return evaluator.compute()
@@ -0,0 +1,189 @@
+'''
+Post-training structured pruning of a fine-tuned NER model bundle, an alternative to distillation that starts from
+the trained model itself.
+
+The attention heads and FFN neurons are scored on the training sentences of the CoNLL file (see model_pruning.py),
+and the least important ones are removed at increasing pruning levels (fraction of the heads and of the FFN neurons
+removed). Every level is optionally fine-tuned for a few epochs to recover, then evaluated on the holdout split of
+train_ner_v1.py (training_option 3, same seed) for entity F1 and forward-pass latency, e.g.
+    python prune_ner.py --bundle output/model_bundle --filepath output/pico_conll.tsv --levels 0.2,0.4,0.5,0.6
+        --target_latency 0.6 --recovery_epochs 1 --output trained_model/pico_bundle_pruned
+prints F1 against latency at every level, and saves the first level that reaches the target size (fraction of the
+parameters kept) or latency (fraction of the latency of the unpruned model) as a bundle that load_model_bundle and
+test_ner_v1.py load like any other. Without a target the last level is saved.
+'''
+import argparse
+import copy
+import json
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+import model_pruning
+from conll_corpus import read_conll
+from model_bundle import load_model_bundle, save_model_bundle
+from ner_dataset import NERDataset, SentenceEncoder
+from ner_evaluation import evaluate_model
+from sequence_packing import get_model_inputs
+from train_ner_v1 import DEFAULT_PARAMETERS, ChildTuningAdamW, get_sentence_dataframe, set_seed, split_data
+
+
+def measure_latency(model, batches, device, repeats=3):
+    '''
+    Mean seconds of a forward pass over batches (best of repeats passes over all of them)
+    '''
+    was_training = model.training
+    model.eval()
+    pass_seconds = []
+    with torch.no_grad():
+        # warm-up
+        model(input_ids=batches[0]['input_ids'].to(device), attention_mask=batches[0]['attention_mask'].to(device))
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for batch in batches:
+                model(input_ids=batch['input_ids'].to(device), attention_mask=batch['attention_mask'].to(device))
+            if device != 'cpu' and torch.cuda.is_available():
+                torch.cuda.synchronize()
+            pass_seconds.append(time.perf_counter() - start)
+    model.train(was_training)
+    return min(pass_seconds) / len(batches)
+
+
+def fine_tune(model, data_loader, device, epochs, learning_rate, max_grad_norm):
+    '''
+    Short recovery fine-tuning of a pruned model
+    '''
+    optimizer = ChildTuningAdamW(params=model.parameters(), lr=learning_rate)
+    model.train()
+    for epoch in range(epochs):
+        loss_sum = 0.0
+        for batch in data_loader:
+            loss = model(**get_model_inputs(batch, device))[0]
+            optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(parameters=model.parameters(), max_norm=max_grad_norm)
+            optimizer.step()
+            loss_sum += loss.item()
+        print(f"\tRecovery epoch {epoch + 1}: loss {loss_sum / max(len(data_loader), 1)}")
+    model.eval()
+
+
+def evaluate_level(model, holdout_loader, latency_batches, ids_to_labels, device):
+    result = evaluate_model(model, holdout_loader, ids_to_labels, device)
+    layer_sizes = model_pruning.get_layer_sizes(model)
+    return {'f1': result['all']['f1'],
+            'precision': result['all']['precision'],
+            'recall': result['all']['recall'],
+            'heads': sum(sizes['num_attention_heads'] for sizes in layer_sizes),
+            'ffn_neurons': sum(sizes['intermediate_size'] for sizes in layer_sizes),
+            'parameters': model_pruning.count_parameters(model),
+            'batch_seconds': measure_latency(model, latency_batches, device)}
+
+
+def print_report(report):
+    baseline = report[0]
+    print("level  heads  neurons  parameters     size     F1      ms/batch  latency")
+    for row in report:
+        print("{0:5.2f}  {1:5d}  {2:7d}  {3:10d}  {4:6.1f}%  {5:6.2f}  {6:9.2f}  {7:6.1f}%".format(
+            row['level'], row['heads'], row['ffn_neurons'], row['parameters'],
+            100 * row['parameters'] / baseline['parameters'], row['f1'], 1000 * row['batch_seconds'],
+            100 * row['batch_seconds'] / baseline['batch_seconds']))
+
+
+def reaches_target(row, baseline, target_size, target_latency):
+    if target_size is None and target_latency is None:
+        return False
+    return (target_size is None or row['parameters'] <= target_size * baseline['parameters']) and \
+        (target_latency is None or row['batch_seconds'] <= target_latency * baseline['batch_seconds'])
+
+
+def prune_ner(args):
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    set_seed(args.seed)
+    bundle = load_model_bundle(args.bundle, device=device)
+    model, tokenizer = bundle.model, bundle.tokenizer
+    max_len = args.max_len or bundle.inference_config['max_len']
+
+    data = get_sentence_dataframe(read_conll(args.filepath))
+    unknown_labels = {label for labels in data['labels'] for label in labels} - set(bundle.labels_to_ids)
+    if unknown_labels:
+        raise ValueError("Labels of {0} that the model does not have: {1}".format(args.filepath,
+                                                                                   sorted(unknown_labels)))
+    # the holdout split of train_ner_v1.py, which the model was not trained on
+    train_dataset, holdout_dataset = split_data(data, {'training_option': 3,
+                                                       'holdout_size': DEFAULT_PARAMETERS['holdout_size']})
+    collate_fn = SentenceEncoder(tokenizer, max_len, bundle.labels_to_ids)
+    scoring_dataset = train_dataset.sample(n=min(args.scoring_sentences, len(train_dataset)), random_state=args.seed)
+    scoring_loader = DataLoader(NERDataset(scoring_dataset), batch_size=args.batch_size, collate_fn=collate_fn)
+    training_loader = DataLoader(NERDataset(train_dataset), batch_size=args.batch_size, shuffle=True,
+                                 collate_fn=collate_fn, generator=torch.Generator().manual_seed(args.seed))
+    holdout_loader = DataLoader(NERDataset(holdout_dataset), batch_size=args.valid_batch_size, collate_fn=collate_fn)
+    latency_batches = list(holdout_loader)
+
+    print("Scoring attention heads and FFN neurons on {0} sentences".format(len(scoring_dataset)))
+    head_scores, neuron_scores = model_pruning.compute_importance(model, scoring_loader, device)
+
+    report = [dict(level=0.0, **evaluate_level(model, holdout_loader, latency_batches, bundle.ids_to_labels, device))]
+    pruned_model, saved_level = None, None
+    for level in args.levels:
+        print("Pruning level {0}".format(level))
+        pruned_model = model_pruning.prune_model(copy.deepcopy(model),
+                                                 model_pruning.select_kept_units(head_scores, level),
+                                                 model_pruning.select_kept_units(neuron_scores, level))
+        if args.recovery_epochs > 0:
+            fine_tune(pruned_model, training_loader, device, args.recovery_epochs, args.learning_rate,
+                      DEFAULT_PARAMETERS['max_grad_norm'])
+        report.append(dict(level=level, **evaluate_level(pruned_model, holdout_loader, latency_batches,
+                                                         bundle.ids_to_labels, device)))
+        print_report(report)
+        if reaches_target(report[-1], report[0], args.target_size, args.target_latency):
+            saved_level = level
+            break
+    if args.target_size is None and args.target_latency is None and args.levels:
+        saved_level = args.levels[-1]
+
+    if args.report_file:
+        with open(args.report_file, 'w') as handle:
+            json.dump(report, handle, indent=2)
+    if saved_level is None:
+        print("No pruning level reaches the target, no model saved")
+        return report
+    inference_config = dict(bundle.inference_config, max_len=max_len, pruning_level=saved_level,
+                            pruned_from=args.bundle)
+    save_model_bundle(args.output, pruned_model, tokenizer, bundle.ids_to_labels, inference_config)
+    print("Model pruned at level {0} written to {1}".format(saved_level, args.output))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune the attention heads and FFN neurons of a fine-tuned NER model '
+                                                 'bundle')
+    parser.add_argument('--bundle', default='output/model_bundle', help='model bundle of the fine-tuned model')
+    parser.add_argument('--filepath', default=DEFAULT_PARAMETERS['filepath'], help='CoNLL training data')
+    parser.add_argument('--output', default='trained_model/pico_bundle_pruned', help='bundle folder of the pruned '
+                                                                                     'model')
+    parser.add_argument('--levels', default='0.1,0.2,0.3,0.4,0.5',
+                        type=lambda levels: [float(level) for level in levels.split(',')],
+                        help='comma-separated fractions of the heads and FFN neurons to remove, in increasing order')
+    parser.add_argument('--target_size', type=float, default=None,
+                        help='stop at the first level with at most this fraction of the parameters')
+    parser.add_argument('--target_latency', type=float, default=None,
+                        help='stop at the first level with at most this fraction of the unpruned latency')
+    parser.add_argument('--recovery_epochs', type=int, default=0, help='fine-tuning epochs after pruning')
+    parser.add_argument('--learning_rate', type=float, default=DEFAULT_PARAMETERS['learning_rate'])
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_PARAMETERS['train_batch_size'])
+    parser.add_argument('--valid_batch_size', type=int, default=DEFAULT_PARAMETERS['valid_batch_size'])
+    parser.add_argument('--max_len', type=int, default=None, help='default: max_len of the bundle')
+    parser.add_argument('--scoring_sentences', type=int, default=2000,
+                        help='number of training sentences the importance scores are computed on')
+    parser.add_argument('--report_file', default=None, help='write the results of every level to this json file')
+    parser.add_argument('--seed', type=int, default=DEFAULT_PARAMETERS['seed'])
+    args = parser.parse_args()
+    if args.levels != sorted(args.levels) or not all(0 <= level < 1 for level in args.levels):
+        parser.error('--levels must be increasing fractions between 0 and 1')
+    prune_ner(args)
+
+
+if __name__ == '__main__':
+    main()
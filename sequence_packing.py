@@ -0,0 +1,87 @@
+'''
+Sequence packing: several tokenized sentences in one training sequence of max_len tokens.
+
+Every sentence keeps its own [CLS] ... [SEP] tokens and labels, its position ids start at 0 again, and the
+(max_len, max_len) attention mask only lets tokens attend to the tokens of their own sentence, so the model sees each
+sentence as if it was alone in the sequence.
+'''
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import Dataset
+
+# BERT in transformers 4.x expands a (batch, seq_len, seq_len) attention mask itself, newer versions take a boolean
+# (batch, 1, seq_len, seq_len) mask
+EXPAND_ATTENTION_MASK = int(transformers.__version__.split('.')[0]) >= 5
+
+
+def get_sequence_lengths(torch_dataset):
+    return np.array([int(torch_dataset[index]['attention_mask'].sum()) for index in range(len(torch_dataset))])
+
+
+def pack_sequences(lengths, max_len):
+    '''
+    Best-fit decreasing bin packing of sequences into packs of at most max_len tokens: the longest sequences are placed
+    first, each one into the fullest pack it still fits in.
+    Returns the packs as lists of dataset indices, in a deterministic order.
+    '''
+    packs = []
+    packs_by_free_tokens = [[] for _ in range(max_len + 1)]
+    for index in np.argsort(-lengths, kind='stable'):
+        length = lengths[index]
+        free_tokens = next((free_tokens for free_tokens in range(length, max_len + 1)
+                            if packs_by_free_tokens[free_tokens]), None)
+        if free_tokens is None:
+            packs.append([int(index)])
+            packs_by_free_tokens[max_len - length].append(len(packs) - 1)
+        else:
+            pack_index = packs_by_free_tokens[free_tokens].pop()
+            packs[pack_index].append(int(index))
+            packs_by_free_tokens[free_tokens - length].append(pack_index)
+    return packs
+
+
+class PackedDataset(Dataset):
+    '''
+    Packed view of a dataset of padded items (input_ids, attention_mask, labels), one pack per item
+    '''
+    def __init__(self, torch_dataset, max_len, pad_token_id=0):
+        self.dataset = torch_dataset
+        self.max_len = max_len
+        self.pad_token_id = pad_token_id
+        self.lengths = get_sequence_lengths(torch_dataset)
+        self.packs = pack_sequences(self.lengths, max_len)
+
+    def __getitem__(self, index):
+        input_ids = torch.full((self.max_len,), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((self.max_len,), -100, dtype=torch.long)
+        position_ids = torch.zeros(self.max_len, dtype=torch.long)
+        attention_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
+        start = 0
+        for dataset_index in self.packs[index]:
+            item = self.dataset[dataset_index]
+            end = start + self.lengths[dataset_index]
+            input_ids[start:end] = item['input_ids'][:end - start]
+            labels[start:end] = item['labels'][:end - start]
+            position_ids[start:end] = torch.arange(end - start)
+            attention_mask[start:end, start:end] = 1
+            start = end
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels,
+                'position_ids': position_ids}
+
+    def __len__(self):
+        return len(self.packs)
+
+
+def get_model_inputs(batch, device):
+    '''
+    Model inputs of a batch of packed or unpacked items
+    '''
+    inputs = {'input_ids': batch['input_ids'].to(device, dtype=torch.long),
+              'attention_mask': batch['attention_mask'].to(device, dtype=torch.long),
+              'labels': batch['labels'].to(device, dtype=torch.long)}
+    if 'position_ids' in batch:
+        inputs['position_ids'] = batch['position_ids'].to(device, dtype=torch.long)
+        if EXPAND_ATTENTION_MASK:
+            inputs['attention_mask'] = inputs['attention_mask'][:, None].bool()
+    return inputs
@@ -0,0 +1,247 @@
+'''
+On-disk cache of spaCy tokenization and sentence splitting.
+
+Only the token offsets and the sentence boundaries of a text are kept, as one small int32 .npy file per text:
+    {cache_dir}/{model_key}/{sha1[:2]}/{sha1}.npy
+where model_key identifies the spaCy model (name, version and spaCy version) and sha1 is the hash of the text.
+Repeated conversions / preprocessing of the same texts do not run spaCy at all, e.g.
+    spacy_nlp = SpacyDocCache('output/spacy_cache', "en_core_sci_lg")
+    sentences = get_sentences_and_tokens_from_spacy(text, spacy_nlp)
+Given the name of the model instead of a loaded model, the model is only loaded once a text is not in the cache.
+The least recently used entries are deleted once the cache grows beyond max_size bytes.
+'''
+import collections
+import hashlib
+import os
+
+import numpy as np
+
+
+def get_token_offsets_from_spacy_document(document):
+    '''
+    Start and end offsets of all tokens of a spaCy document, and the offsets of the sentences in them
+    '''
+    token_starts = np.fromiter((token.idx for token in document), dtype=np.int32, count=len(document))
+    token_ends = token_starts + np.fromiter((len(token) for token in document), dtype=np.int32, count=len(document))
+    sentence_offsets = np.array([0] + [span.end for span in document.sents], dtype=np.int32)
+    return token_starts, token_ends, sentence_offsets
+
+
+def get_sentences_and_tokens_from_offsets(text, token_starts, token_ends, sentence_offsets):
+    # sentences
+    sentences = []
+    for sentence_start, sentence_end in zip(sentence_offsets[:-1], sentence_offsets[1:]):
+        sentence_tokens = []
+        for start, end in zip(token_starts[sentence_start:sentence_end].tolist(),
+                              token_ends[sentence_start:sentence_end].tolist()):
+            token_dict = {'start': start, 'end': end, 'text': text[start:end]}
+            if token_dict['text'].strip() in ['\n', '\t', ' ', '']:
+                continue
+            # Make sure that the token text does not contain any space
+            if len(token_dict['text'].split(' ')) != 1:
+                print("WARNING: the text of the token contains space character, replaced with hyphen\n\t{0}\n\t{1}".format(
+                    token_dict['text'], token_dict['text'].replace(' ', '-')))
+                token_dict['text'] = token_dict['text'].replace(' ', '-')
+            sentence_tokens.append(token_dict)
+        sentences.append(sentence_tokens)
+    return sentences
+
+
+def get_sentences_and_tokens_from_spacy_document(text, document):
+    return get_sentences_and_tokens_from_offsets(text, *get_token_offsets_from_spacy_document(document))
+
+
+def get_sentences_and_tokens_from_spacy(text, spacy_nlp):
+    '''
+    Sentences of text as lists of token dicts (start, end, text); spacy_nlp is a spaCy model or a SpacyDocCache
+    '''
+    if isinstance(spacy_nlp, SpacyDocCache):
+        return spacy_nlp.get_sentences_and_tokens(text)
+    return get_sentences_and_tokens_from_spacy_document(text, spacy_nlp(text))
+
+
+def pipe_sentences_and_tokens(texts, spacy_nlp, batch_size=32, n_process=1):
+    '''
+    get_sentences_and_tokens_from_spacy of every text, tokenized in batches with spacy_nlp.pipe
+    '''
+    if isinstance(spacy_nlp, SpacyDocCache):
+        return spacy_nlp.pipe_sentences_and_tokens(texts, batch_size, n_process)
+    return (get_sentences_and_tokens_from_spacy_document(text, document)
+            for document, text in spacy_nlp.pipe(((text, text) for text in texts), as_tuples=True,
+                                                 batch_size=batch_size, n_process=n_process))
+
+
+def get_spacy_model_key(spacy_nlp):
+    '''
+    Name of the cache folder of a spaCy model (loaded, or the name of an installed model package): its name, version
+    and the spaCy version
+    '''
+    import spacy
+    if isinstance(spacy_nlp, str):
+        name, version = spacy_nlp, spacy.util.get_package_version(spacy_nlp)
+    else:
+        name, version = '{0}_{1}'.format(spacy_nlp.meta.get('lang'), spacy_nlp.meta.get('name')), \
+            spacy_nlp.meta.get('version')
+    model_description = '{0}-{1}|spacy-{2}'.format(name, version, spacy.__version__)
+    return '{0}-{1}'.format(name, hashlib.sha1(model_description.encode('utf-8')).hexdigest()[:12])
+
+
+class SpacyDocCache:
+    '''
+    spaCy model with an on-disk cache of its token offsets and sentence boundaries, keyed by model and text hash.
+    spacy_nlp is a loaded model, or the name of an installed model, which is then only loaded once a text is not in the
+    cache.
+    '''
+    def __init__(self, cache_dir, spacy_nlp, max_size=2 << 30):
+        self.model_name = spacy_nlp if isinstance(spacy_nlp, str) else None
+        self._spacy_nlp = None if isinstance(spacy_nlp, str) else spacy_nlp
+        self.cache_dir = os.path.join(cache_dir, get_spacy_model_key(spacy_nlp))
+        self.max_size = max_size
+        self._size = None  # bytes in the cache folder, scanned on the first write
+        self.hits, self.misses = 0, 0
+
+    @property
+    def spacy_nlp(self):
+        if self._spacy_nlp is None:
+            import spacy
+            self._spacy_nlp = spacy.load(self.model_name)
+        return self._spacy_nlp
+
+    def _get_filepath(self, text):
+        text_hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, text_hash[:2], text_hash + '.npy')
+
+    def _load(self, text):
+        filepath = self._get_filepath(text)
+        try:
+            array = np.load(filepath)
+        except (OSError, ValueError):
+            return None
+        try:
+            # the modification time orders the entries for eviction
+            os.utime(filepath)
+        except OSError:
+            pass
+        number_of_tokens, number_of_sentences = int(array[0]), int(array[1])
+        token_starts = array[2:2 + number_of_tokens]
+        token_ends = array[2 + number_of_tokens:2 + 2 * number_of_tokens]
+        sentence_offsets = array[2 + 2 * number_of_tokens:3 + 2 * number_of_tokens + number_of_sentences]
+        return token_starts, token_ends, sentence_offsets
+
+    def _store(self, text, token_starts, token_ends, sentence_offsets):
+        filepath = self._get_filepath(text)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        array = np.concatenate([np.array([len(token_starts), len(sentence_offsets) - 1], dtype=np.int32),
+                                token_starts, token_ends, sentence_offsets]).astype(np.int32)
+        temporary_filepath = '{0}.tmp{1}.npy'.format(filepath, os.getpid())
+        np.save(temporary_filepath, array)
+        os.replace(temporary_filepath, filepath)
+        if self._size is None:
+            self._size = self.get_size()
+        else:
+            self._size += os.path.getsize(filepath)
+        if self._size > self.max_size:
+            self.evict()
+
+    def _get_entries(self):
+        entries = []
+        for directory_entry in os.scandir(self.cache_dir):
+            if directory_entry.is_dir():
+                for entry in os.scandir(directory_entry.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:  # evicted by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def get_size(self):
+        return sum(size for _, size, _ in self._get_entries()) if os.path.isdir(self.cache_dir) else 0
+
+    def evict(self, target_fraction=0.8):
+        '''
+        Delete the least recently used entries until the cache is below target_fraction of max_size
+        '''
+        entries = sorted(self._get_entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, filepath in entries:
+            if self._size <= self.max_size * target_fraction:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+    def get_token_offsets(self, text):
+        cached = self._load(text)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        offsets = get_token_offsets_from_spacy_document(self.spacy_nlp(text))
+        self._store(text, *offsets)
+        return offsets
+
+    def get_sentences_and_tokens(self, text):
+        return get_sentences_and_tokens_from_offsets(text, *self.get_token_offsets(text))
+
+    def pipe_token_offsets(self, texts, batch_size=32, n_process=1):
+        '''
+        (text, token offsets) of every text, streamed in order. The texts that are not cached yet go through a single
+        spacy_nlp.pipe, started at the first of them, and the cached texts read on the way wait in a deque for the
+        texts before them.
+        '''
+        texts = iter(texts)
+        # [text, offsets] of the texts read and not yielded yet, offsets is None until spaCy has tokenized the text
+        pending = collections.deque()
+        missing_texts = collections.deque()
+        documents = None
+
+        def read(text):
+            offsets = self._load(text)
+            pending.append([text, offsets])
+            if offsets is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return offsets is None
+
+        def get_missing_texts():
+            # the misses read by the loop below, then the ones spaCy reads ahead for its batches
+            while True:
+                while missing_texts:
+                    yield missing_texts.popleft()
+                text = next(texts, None)
+                if text is None:
+                    return
+                if read(text):
+                    yield text
+
+        while True:
+            while pending and pending[0][1] is not None:
+                yield tuple(pending.popleft())
+            if pending:
+                text = pending[0][0]
+                pending[0][1] = get_token_offsets_from_spacy_document(next(documents))
+                self._store(text, *pending[0][1])
+                continue
+            # everything read so far is yielded, spaCy has no text ahead
+            text = next(texts, None)
+            if text is None:
+                return
+            if read(text):
+                missing_texts.append(text)
+                if documents is None:
+                    documents = iter(self.spacy_nlp.pipe(get_missing_texts(), batch_size=batch_size,
+                                                         n_process=n_process))
+
+    def pipe_sentences_and_tokens(self, texts, batch_size=32, n_process=1):
+        return (get_sentences_and_tokens_from_offsets(text, *offsets)
+                for text, offsets in self.pipe_token_offsets(texts, batch_size, n_process))
+
+    def precompute(self, texts, batch_size=32, n_process=1):
+        '''
+        Fill the cache with the texts that are not cached yet
+        '''
+        collections.deque(self.pipe_token_offsets(texts, batch_size, n_process), maxlen=0)
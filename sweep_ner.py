@@ -0,0 +1,180 @@
+'''
+Hyperparameter sweep / k-fold runner for train_ner_v1.py.
+
+Every run is a separate train_ner_v1.py process with its own output folder, pinned to its own block of cores with
+matching thread limits. All runs share one tokenized dataset cache, and the holdout results of all runs end up in
+one table, e.g.
+    python sweep_ner.py --search_space sweep.json --num_folds 5 --workers 4
+with sweep.json
+    {"learning_rate": [1e-5, 3e-5], "max_len": [128, 256], "optimizer_mode": ["none", "ChildTuning-F"]}
+'''
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import json
+import os
+import queue
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import local_utils as utils
+
+DEFAULT_SEARCH_SPACE = collections.OrderedDict([
+    ('learning_rate', [1e-5, 3e-5, 5e-5]),
+    ('max_len', [128, 256]),
+    ('optimizer_mode', ['none', 'ChildTuning-D', 'ChildTuning-F']),
+])
+
+
+def get_configurations(search_space, search, num_samples, seed=200):
+    '''
+    All combinations of the search space (grid), or num_samples random combinations of it (random)
+    '''
+    names = list(search_space.keys())
+    configurations = [collections.OrderedDict(zip(names, values))
+                      for values in itertools.product(*[search_space[name] for name in names])]
+    if search == 'random':
+        configurations = random.Random(seed).sample(configurations, min(num_samples, len(configurations)))
+    return configurations
+
+
+def get_core_blocks(workers, threads_per_run):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    return [cores[i * threads_per_run:(i + 1) * threads_per_run] or cores for i in range(workers)]
+
+
+def run_training(run, core_blocks, threads_per_run, tokenized_cache_dir):
+    '''
+    Run one train_ner_v1.py process on a free block of cores and return its row of the results table
+    '''
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train_ner_v1.py'),
+               '--output_dir', run['output_dir'],
+               '--results_file', os.path.join(run['output_dir'], 'results.json'),
+               '--tokenized_cache_dir', tokenized_cache_dir]
+    for name, value in run['configuration'].items():
+        command += ['--{0}'.format(name), str(value)]
+    if run['num_folds'] > 1:
+        command += ['--num_folds', str(run['num_folds']), '--fold', str(run['fold'])]
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_run), MKL_NUM_THREADS=str(threads_per_run))
+
+    cores = core_blocks.get()
+    # the process pins itself: preexec_fn is not safe in the threads of the pool
+    command += ['--cpu_affinity', ','.join(str(core) for core in cores)]
+    utils.create_folder_if_not_exists(run['output_dir'])
+    start_time = time.time()
+    try:
+        with open(os.path.join(run['output_dir'], 'train.log'), 'w') as log_file:
+            returncode = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT, env=env,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        core_blocks.put(cores)
+
+    row = collections.OrderedDict([('run_id', run['run_id']), ('fold', run['fold'])])
+    row.update(run['configuration'])
+    row['status'] = 'ok' if returncode == 0 else 'failed ({0})'.format(returncode)
+    row['wall_seconds'] = round(time.time() - start_time, 1)
+    results_filepath = os.path.join(run['output_dir'], 'results.json')
+    if returncode == 0 and os.path.exists(results_filepath):
+        with open(results_filepath) as f:
+            results = json.load(f)
+        row['f1'] = results['best_f1']
+        row['epochs'] = results['epochs']
+        row['trainable_parameters'] = results.get('trainable_parameters')
+        row['step_seconds'] = results.get('step_seconds')
+        for entity_type, type_result in sorted((results['best_result'] or {}).items()):
+            if entity_type != 'all':
+                row['f1_{0}'.format(entity_type)] = type_result['f1']
+    return row
+
+
+def write_table(rows, filepath):
+    columns = []
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+    with open(filepath, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(row.get(column, '')) for column in columns) + '\n')
+
+
+def summarize(rows, parameter_names):
+    '''
+    Mean and standard deviation of the holdout F1 over the folds of each configuration, best first
+    '''
+    groups = collections.OrderedDict()
+    for row in rows:
+        groups.setdefault(tuple(row[name] for name in parameter_names), []).append(row)
+    summary = []
+    for configuration, group in groups.items():
+        f1s = [row['f1'] for row in group if row.get('f1') is not None]
+        summary_row = collections.OrderedDict(zip(parameter_names, configuration))
+        summary_row['folds'] = len(f1s)
+        summary_row['f1_mean'] = float(np.mean(f1s)) if f1s else None
+        summary_row['f1_std'] = float(np.std(f1s)) if f1s else None
+        summary.append(summary_row)
+    return sorted(summary, key=lambda row: -1 if row['f1_mean'] is None else row['f1_mean'], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep / k-fold cross-validation of train_ner_v1.py')
+    parser.add_argument('--search_space', default=None,
+                        help='json file mapping train_ner_v1.py options (learning_rate, max_len, optimizer_mode, '
+                             'model_name, ...) to lists of values')
+    parser.add_argument('--search', default='grid', choices=['grid', 'random'])
+    parser.add_argument('--num_samples', type=int, default=10, help='number of configurations of a random search')
+    parser.add_argument('--num_folds', type=int, default=5, help='1 uses the default holdout split of every run')
+    parser.add_argument('--workers', type=int, default=2, help='number of runs in parallel')
+    parser.add_argument('--threads_per_run', type=int, default=None,
+                        help='cores (and torch threads) per run, default: all cores split between the workers')
+    parser.add_argument('--output_dir', default=None, help='default: output/sweep_{time}')
+    args = parser.parse_args()
+
+    if args.search_space:
+        with open(args.search_space) as f:
+            search_space = json.load(f, object_pairs_hook=collections.OrderedDict)
+    else:
+        search_space = DEFAULT_SEARCH_SPACE
+    output_dir = os.path.abspath(args.output_dir or
+                                 os.path.join('output', 'sweep_{0}'.format(utils.get_current_time_in_seconds())))
+    threads_per_run = args.threads_per_run or max(1, (os.cpu_count() or 1) // args.workers)
+    utils.create_folder_if_not_exists(output_dir)
+
+    runs = []
+    for run_id, configuration in enumerate(get_configurations(search_space, args.search, args.num_samples)):
+        for fold in range(args.num_folds):
+            runs.append({'run_id': run_id, 'fold': fold, 'num_folds': args.num_folds, 'configuration': configuration,
+                         'output_dir': os.path.join(output_dir, 'run{0}_fold{1}'.format(run_id, fold))})
+    print("Running {0} trainings, {1} at a time with {2} threads each".format(len(runs), args.workers,
+                                                                             threads_per_run))
+
+    core_blocks = queue.Queue()
+    for cores in get_core_blocks(args.workers, threads_per_run):
+        core_blocks.put(cores)
+    tokenized_cache_dir = os.path.join(output_dir, 'tokenized_cache')
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_training, run, core_blocks, threads_per_run, tokenized_cache_dir)
+                   for run in runs]
+        for future in concurrent.futures.as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            print("[{0}/{1}] run {2} fold {3}: {4}, F1 {5}".format(len(rows), len(runs), row['run_id'], row['fold'],
+                                                                  row['status'], row.get('f1')))
+            # keep the table up to date, so that a partial sweep can already be compared
+            write_table(sorted(rows, key=lambda row: (row['run_id'], row['fold'])),
+                        os.path.join(output_dir, 'results.tsv'))
+
+    summary = summarize(rows, list(search_space.keys()))
+    write_table(summary, os.path.join(output_dir, 'summary.tsv'))
+    print("Results: {0}".format(os.path.join(output_dir, 'results.tsv')))
+    for summary_row in summary:
+        print('\t'.join('{0}={1}'.format(name, value) for name, value in summary_row.items()))
+
+
+if __name__ == '__main__':
+    main()
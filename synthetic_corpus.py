@@ -0,0 +1,206 @@
+'''
+Synthetic corpora of any size, resampled from an existing CoNLL corpus, to test how the pipeline scales.
+
+Every generated sentence is a sentence of the source corpus whose entities are replaced, with probability
+entity_replacement, by another entity of the same type drawn from all the entities of the source, and whose other
+tokens are replaced, with probability token_replacement, by a token drawn from all the tokens outside of entities.
+The sentence, entity type and token frequencies are thus those of the source, but the sentences are mostly new, so
+deduplication does not shrink the corpus back to its source. Documents get as many sentences as a random document of
+the source. The corpus is written as brat .txt / .ann files (the input of brat2conll.py), as a CoNLL file (its output,
+BIO labels), or both:
+    python synthetic_corpus.py --source output/pico_conll.tsv --scale 10 --conll_filepath output/synthetic_10x.tsv
+        --brat_folder data/synthetic_10x
+'''
+import argparse
+import codecs
+import csv
+import os
+import random
+
+import numpy as np
+import pandas as pd
+
+from conll_corpus import read_conll
+from conll_io import get_conll_columns, open_conll
+from ner_evaluation import get_chunks
+
+DEFAULT_SENTENCES_PER_DOCUMENT = 14
+
+
+def get_sentences_per_document(dataset_filepath, corpus):
+    '''
+    Number of sentences of every document of a CoNLL file with a document column, None without one
+    '''
+    conll_columns = get_conll_columns(dataset_filepath)
+    if 'document' not in conll_columns:
+        return None
+    columns = pd.read_csv(dataset_filepath, sep='\t', header=None,
+                          usecols=[conll_columns['token'], conll_columns['document']], dtype=str,
+                          quoting=csv.QUOTE_NONE, na_filter=False, skip_blank_lines=False, encoding='UTF-8',
+                          compression='infer')
+    tokens = columns[conll_columns['token']].str.strip()
+    # the same token rows as read_conll
+    is_token = ((tokens.str.len() > 0) & ~tokens.str.contains('-DOCSTART-', regex=False)).values
+    documents = columns[conll_columns['document']].values[is_token]
+    sentence_documents = documents[corpus.sentence_offsets[:-1]]
+    # documents are contiguous in the file, a new document starts where the document id changes
+    document_starts = np.flatnonzero(np.concatenate([[True], sentence_documents[1:] != sentence_documents[:-1]]))
+    return np.diff(np.append(document_starts, len(sentence_documents)))
+
+
+class SentenceSampler:
+    '''
+    The sentences of a source corpus as sequences of segments, ('O', token) or (entity type, entity tokens), and the
+    pools of the entities of every type and of the tokens outside of entities
+    '''
+    def __init__(self, corpus, sentences_per_document=None, seed=200, entity_replacement=0.5, token_replacement=0.1):
+        self.random = random.Random(seed)
+        self.entity_replacement = entity_replacement
+        self.token_replacement = token_replacement
+        self.sentences_per_document = sentences_per_document if sentences_per_document is not None and \
+            len(sentences_per_document) > 0 else np.array([DEFAULT_SENTENCES_PER_DOCUMENT])
+        self.sentences = []
+        self.entities = {}
+        self.outside_tokens = []
+        for i in range(len(corpus)):
+            tokens, labels = corpus.get_tokens(i), corpus.get_labels(i)
+            segments = []
+            position = 0
+            for start, end, entity_type in get_chunks(labels) + [(len(tokens), len(tokens), None)]:
+                for token in tokens[position:start]:
+                    segments.append(('O', token))
+                    self.outside_tokens.append(token)
+                if entity_type is not None:
+                    entity = tuple(tokens[start:end])
+                    segments.append((entity_type, entity))
+                    self.entities.setdefault(entity_type, []).append(entity)
+                position = end
+            if segments:
+                self.sentences.append(segments)
+        if not self.sentences:
+            raise ValueError("The source corpus has no sentences")
+
+    def sample_sentence(self):
+        '''
+        Tokens and BIO labels of a new sentence
+        '''
+        tokens, labels = [], []
+        for segment_type, segment in self.random.choice(self.sentences):
+            if segment_type == 'O':
+                if self.random.random() < self.token_replacement:
+                    segment = self.random.choice(self.outside_tokens)
+                tokens.append(segment)
+                labels.append('O')
+            else:
+                if self.random.random() < self.entity_replacement:
+                    segment = self.random.choice(self.entities[segment_type])
+                tokens.extend(segment)
+                labels.append('B-' + segment_type)
+                labels.extend(['I-' + segment_type] * (len(segment) - 1))
+        return tokens, labels
+
+    def sample_documents(self, number_of_sentences, document_prefix='synthetic'):
+        '''
+        (document id, [(tokens, labels) of every sentence]) of documents with number_of_sentences sentences in total
+        '''
+        document_index = 0
+        while number_of_sentences > 0:
+            document_size = min(int(self.random.choice(self.sentences_per_document)), number_of_sentences)
+            yield '{0}{1:08d}'.format(document_prefix, document_index), \
+                [self.sample_sentence() for _ in range(document_size)]
+            number_of_sentences -= document_size
+            document_index += 1
+
+
+def get_document_text_and_offsets(sentences):
+    '''
+    Text of a document, the tokens separated by spaces, and the (start, end) of every token of every sentence
+    '''
+    parts, offsets = [], []
+    position = 0
+    for tokens, _ in sentences:
+        sentence_offsets = []
+        for token in tokens:
+            sentence_offsets.append((position, position + len(token)))
+            parts.append(token)
+            position += len(token) + 1
+        offsets.append(sentence_offsets)
+    return ' '.join(parts), offsets
+
+
+def write_corpus(documents, conll_filepath=None, brat_folder=None):
+    '''
+    Write documents (see SentenceSampler.sample_documents) as a CoNLL file and / or as brat files; returns the number
+    of documents, sentences, tokens and entities written
+    '''
+    counts = {'documents': 0, 'sentences': 0, 'tokens': 0, 'entities': 0}
+    if brat_folder is not None:
+        os.makedirs(brat_folder, exist_ok=True)
+    conll_file = open_conll(conll_filepath, 'w') if conll_filepath is not None else None
+    for document_id, sentences in documents:
+        text, offsets = get_document_text_and_offsets(sentences)
+        lines, annotations = [], []
+        for (tokens, labels), sentence_offsets in zip(sentences, offsets):
+            for token, (start, end), label in zip(tokens, sentence_offsets, labels):
+                lines.append('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(token, document_id, start, end, label))
+            lines.append('\n')
+            for start, end, entity_type in get_chunks(labels):
+                entity_start, entity_end = sentence_offsets[start][0], sentence_offsets[end - 1][1]
+                annotations.append('T{0}\t{1} {2} {3}\t{4}\n'.format(len(annotations) + 1, entity_type, entity_start,
+                                                                     entity_end, text[entity_start:entity_end]))
+            counts['sentences'] += 1
+            counts['tokens'] += len(tokens)
+        counts['documents'] += 1
+        counts['entities'] += len(annotations)
+        if conll_file is not None:
+            conll_file.write(''.join(lines))
+        if brat_folder is not None:
+            with codecs.open(os.path.join(brat_folder, document_id + '.txt'), 'w', 'UTF-8') as f:
+                f.write(text)
+            with codecs.open(os.path.join(brat_folder, document_id + '.ann'), 'w', 'UTF-8') as f:
+                f.write(''.join(annotations))
+    if conll_file is not None:
+        conll_file.close()
+    return counts
+
+
+def load_sentence_sampler(source_filepath, seed=200, entity_replacement=0.5, token_replacement=0.1):
+    corpus = read_conll(source_filepath)
+    return SentenceSampler(corpus, get_sentences_per_document(source_filepath, corpus), seed, entity_replacement,
+                           token_replacement), corpus
+
+
+def generate_corpus(source_filepath, scale=1.0, number_of_sentences=None, conll_filepath=None, brat_folder=None,
+                    seed=200, entity_replacement=0.5, token_replacement=0.1):
+    '''
+    Write a synthetic corpus of number_of_sentences sentences (default: scale times the sentences of the source)
+    '''
+    sampler, corpus = load_sentence_sampler(source_filepath, seed, entity_replacement, token_replacement)
+    number_of_sentences = number_of_sentences or int(round(scale * len(corpus)))
+    return write_corpus(sampler.sample_documents(number_of_sentences), conll_filepath, brat_folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic brat / CoNLL corpus resampled from a CoNLL '
+                                                 'corpus')
+    parser.add_argument('--source', default='output/pico_conll.tsv', help='CoNLL corpus to resample')
+    parser.add_argument('--scale', type=float, default=10, help='size of the corpus, in sentences of the source')
+    parser.add_argument('--sentences', type=int, default=None, help='number of sentences, instead of --scale')
+    parser.add_argument('--conll_filepath', default=None, help='CoNLL file to write (.gz / .zst are compressed)')
+    parser.add_argument('--brat_folder', default=None, help='folder of the brat .txt and .ann files to write')
+    parser.add_argument('--entity_replacement', type=float, default=0.5,
+                        help='probability of replacing an entity with another entity of the same type')
+    parser.add_argument('--token_replacement', type=float, default=0.1,
+                        help='probability of replacing a token outside of entities')
+    parser.add_argument('--seed', type=int, default=200)
+    args = parser.parse_args()
+    if args.conll_filepath is None and args.brat_folder is None:
+        parser.error('give --conll_filepath, --brat_folder or both')
+    counts = generate_corpus(args.source, args.scale, args.sentences, args.conll_filepath, args.brat_folder, args.seed,
+                             args.entity_replacement, args.token_replacement)
+    print("{documents} documents, {sentences} sentences, {tokens} tokens, {entities} entities written".format(
+        **counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,12 +11,16 @@ import numpy as np
 import pandas as pd
 import spacy
 import pickle
-from sklearn.metrics import accuracy_score
 from torch.utils.data import Dataset, DataLoader
 from transformers import BertModel, BertForTokenClassification, AutoTokenizer, AutoModel, AutoModelForMaskedLM, AutoModelForTokenClassification
 import torch
 import logging
 import uuid
+from annotation_pipeline import AnnotationPipeline
+from model_bundle import load_model_bundle
+from ner_dataset import NERDataset, SentenceEncoder
+from ner_evaluation import EntityEvaluator
+from spacy_cache import SpacyDocCache, get_sentences_and_tokens_from_spacy
 # logging.basicConfig(level=logging.INFO)
 
 pd.set_option('max_colwidth', 400)
@@ -34,51 +38,39 @@ def set_seed(seed):
 set_seed(200)
 
 
-def get_start_and_end_offset_of_token_from_spacy(token):
-    start = token.idx
-    end = start + len(token)
-    return start, end
-
-def get_sentences_and_tokens_from_spacy(text, spacy_nlp):
-    document = spacy_nlp(text)
-    # sentences
-    sentences = []
-    for span in document.sents:
-        sentence = [document[i] for i in range(span.start, span.end)]
-        sentence_tokens = []
-        for token in sentence:
-            token_dict = {}
-            token_dict['start'], token_dict['end'] = get_start_and_end_offset_of_token_from_spacy(token)
-            token_dict['text'] = text[token_dict['start']:token_dict['end']]
-            if token_dict['text'].strip() in ['\n', '\t', ' ', '']:
-                continue
-            # Make sure that the token text does not contain any space
-            if len(token_dict['text'].split(' ')) != 1:
-                print("WARNING: the text of the token contains space character, replaced with hyphen\n\t{0}\n\t{1}".format(token_dict['text'],
-                                                                                                                           token_dict['text'].replace(' ', '-')))
-                token_dict['text'] = token_dict['text'].replace(' ', '-')
-            sentence_tokens.append(token_dict)
-        sentences.append(sentence_tokens)
-    return sentences
-
 """Testing
 """
 
-# way to load pickle
-with open(os.path.join(dir, 'output/label_dict.pickle'), 'rb') as handle:
-    label_dict = pickle.load(handle)
+# a model bundle (see model_bundle.py) carries the weights, labels, tokenizer and inference config, and is used instead
+# of the label pickles, the .model checkpoint and the hub tokenizer when it exists
+MODEL_BUNDLE_DIR = os.path.join(dir, 'trained_model/pico_bundle')
+MODEL_NAME = "microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext"
+MAX_LEN = 256
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+model_bundle = load_model_bundle(MODEL_BUNDLE_DIR, device=device) if os.path.isdir(MODEL_BUNDLE_DIR) else None
 
-with open(os.path.join(dir, 'output/labels_to_ids.pickle'), 'rb') as handle:
-    labels_to_ids = pickle.load(handle)
+if model_bundle is not None:
+    labels_to_ids = model_bundle.labels_to_ids
+    ids_to_labels = model_bundle.ids_to_labels
+    label_dict = dict(labels_to_ids)
+    MAX_LEN = model_bundle.inference_config['max_len']
+else:
+    # way to load pickle
+    with open(os.path.join(dir, 'output/label_dict.pickle'), 'rb') as handle:
+        label_dict = pickle.load(handle)
 
-with open(os.path.join(dir, 'output/ids_to_labels.pickle'), 'rb') as handle:
-    ids_to_labels = pickle.load(handle)
+    with open(os.path.join(dir, 'output/labels_to_ids.pickle'), 'rb') as handle:
+        labels_to_ids = pickle.load(handle)
+
+    with open(os.path.join(dir, 'output/ids_to_labels.pickle'), 'rb') as handle:
+        ids_to_labels = pickle.load(handle)
 
 
 def load_model():
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = AutoModelForTokenClassification.from_pretrained(
-        "microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext", num_labels=len(label_dict))
+    if model_bundle is not None:
+        return model_bundle.model
+    model = AutoModelForTokenClassification.from_pretrained(MODEL_NAME, num_labels=len(label_dict))
     # model.load_state_dict(
     #     torch.load(os.path.join(dir, 'trained_model/3_acc_0.9159417462513971.model'), map_location=torch.device('cpu')))
     if str(device).strip() == 'cpu':
@@ -96,58 +88,19 @@ def load_model():
 
     return model
 
-model = load_model()
 
-class Test_Dataset(Dataset):
-    def __init__(self, dataframe, tokenizer, max_len):
-        self.len = len(dataframe)
-        self.data = dataframe
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-
-    def __getitem__(self, index):
-        # step 1: get the sentence and word labels
-        abs_id = self.data.abs_id[index]
-        sen_offset = self.data.sen_offset[index]
-        sentence = self.data.sentence[index].strip().split()
-        word_labels = self.data.word_labels[index].split(",")
-
-        # step 2: use tokenizer to encode sentence (includes padding/truncation up to max length)
-        # BertTokenizerFast provides a handy "return_offsets_mapping" functionality for individual tokens
-        encoding = self.tokenizer(sentence,
-                                  #  is_pretokenized=True,
-                                  is_split_into_words=True,
-                                  return_offsets_mapping=True,
-                                  padding='max_length',
-                                  truncation=True,
-                                  max_length=self.max_len)
-
-        # step 3: create token labels only for first word pieces of each tokenized word
-        labels = [labels_to_ids[label] for label in word_labels]
-        # code based on https://huggingface.co/transformers/custom_datasets.html#tok-ner
-        # create an empty array of -100 of length max_length
-        encoded_labels = np.ones(len(encoding["offset_mapping"]), dtype=int) * -100
-
-        # set only labels whose first offset position is 0 and the second is not 0
-        i = 0
-        for idx, mapping in enumerate(encoding["offset_mapping"]):
-            if mapping[0] == 0 and mapping[1] != 0:
-                # overwrite label
-                encoded_labels[idx] = labels[i]
-                i += 1
-
-        # step 4: turn everything into PyTorch tensors
-        item = {key: torch.as_tensor(val) for key, val in encoding.items()}
-        item['labels'] = torch.as_tensor(encoded_labels)
-        item['abs_id'] = abs_id
-        item['sen_offset'] = sen_offset
-
-        return item
-
-    def __len__(self):
-        return self.len
+_tokenizer = None
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = model_bundle.tokenizer if model_bundle is not None else AutoTokenizer.from_pretrained(MODEL_NAME)
+    return _tokenizer
 
 
+model = load_model()
+
 def testing_function(text, spacy_nlp):
     my_uid = uuid.uuid1()
     abs_id = str(my_uid.int)[-9:-1]
@@ -183,15 +136,15 @@ def testing_function(text, spacy_nlp):
     # let's also create a new column called "word_labels" which groups the tags by sentence
     abs_test_formated_df['word_labels'] = abs_test_formated_df['labels'].transform(lambda x: ','.join(x))
     logging.info(abs_test_formated_df.iloc[0].tokens)
-    MAX_LEN = 256
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext")
+    tokenizer = get_tokenizer()
     VALID_BATCH_SIZE = 1
     test_params = {'batch_size': VALID_BATCH_SIZE,
                    'shuffle': False,
                    'num_workers': 1
                    }
-    testing_set = Test_Dataset(abs_test_formated_df, tokenizer, MAX_LEN)
-    testing_loader = DataLoader(testing_set, **test_params)
+    testing_set = NERDataset(abs_test_formated_df, columns=['abs_id', 'sen_offset'])
+    testing_loader = DataLoader(testing_set, collate_fn=SentenceEncoder(tokenizer, MAX_LEN, labels_to_ids),
+                                **test_params)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logging.info('Available device:\t{}'.format(device))
@@ -282,15 +235,15 @@ def testing_function_with_model(text, spacy_nlp, model):
     # let's also create a new column called "word_labels" which groups the tags by sentence
     abs_test_formated_df['word_labels'] = abs_test_formated_df['labels'].transform(lambda x: ','.join(x))
     logging.info(abs_test_formated_df.iloc[0].tokens)
-    MAX_LEN = 256
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext")
+    tokenizer = get_tokenizer()
     VALID_BATCH_SIZE = 1
     test_params = {'batch_size': VALID_BATCH_SIZE,
                    'shuffle': False,
                    'num_workers': 1
                    }
-    testing_set = Test_Dataset(abs_test_formated_df, tokenizer, MAX_LEN)
-    testing_loader = DataLoader(testing_set, **test_params)
+    testing_set = NERDataset(abs_test_formated_df, columns=['abs_id', 'sen_offset'])
+    testing_loader = DataLoader(testing_set, collate_fn=SentenceEncoder(tokenizer, MAX_LEN, labels_to_ids),
+                                **test_params)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     logging.info('Available device:\t{}'.format(device))
@@ -385,17 +338,32 @@ def get_result_entity(text, df):
         entity_list.append([text[start:end], tag_label])
     return entity_list
 
+def get_result_entity_from_predictions(text, sentences, predicted_labels):
+    '''
+    get_result_entity of the sentences of text and their predicted labels (see AnnotationPipeline.annotate)
+    '''
+    df = pd.DataFrame({'abs_id': [''] * len(sentences),
+                       'tokens_offsets': [[(token['start'], token['end']) for token in sentence]
+                                          for sentence in sentences],
+                       'predicted_labels': predicted_labels})
+    return get_result_entity(text, df)
+
 """Evaluation"""
 
 
 def valid(model, testing_loader):
+    '''
+    Loss, token accuracy and conlleval entity-level precision / recall / F1 per type on testing_loader.
+    Returns the labels and predictions of all words, and the scores (same dict as utils_nlp.get_parsed_conll_output).
+    '''
     # put model in evaluation mode
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model.eval()
 
-    eval_loss, eval_accuracy = 0, 0
-    nb_eval_examples, nb_eval_steps = 0, 0
+    eval_loss = 0
+    nb_eval_steps = 0
     eval_preds, eval_labels = [], []
+    evaluator = EntityEvaluator(ids_to_labels)
 
     with torch.no_grad():
         for idx, batch in enumerate(testing_loader):
@@ -410,42 +378,36 @@ def valid(model, testing_loader):
             eval_loss += loss.item()
 
             nb_eval_steps += 1
-            nb_eval_examples += labels.size(0)
 
             if idx % 100 == 0:
                 loss_step = eval_loss / nb_eval_steps
                 print(f"Validation loss per 100 evaluation steps: {loss_step}")
 
-            # compute evaluation accuracy
-            flattened_targets = labels.view(-1)  # shape (batch_size * seq_len,)
-            active_logits = eval_logits.view(-1, model.num_labels)  # shape (batch_size * seq_len, num_labels)
-            flattened_predictions = torch.argmax(active_logits, axis=1)  # shape (batch_size * seq_len,)
-
-            # only compute accuracy at active labels
-            active_accuracy = labels.view(-1) != -100  # shape (batch_size, seq_len)
-
-            labels = torch.masked_select(flattened_targets, active_accuracy)
-            predictions = torch.masked_select(flattened_predictions, active_accuracy)
-
-            eval_labels.extend(labels)
-            eval_preds.extend(predictions)
-
-            tmp_eval_accuracy = accuracy_score(labels.cpu().numpy(), predictions.cpu().numpy())
-            eval_accuracy += tmp_eval_accuracy
+            # only evaluate the active labels (first word piece of every word)
+            labels = labels.cpu().numpy()
+            predictions = torch.argmax(eval_logits, axis=-1).cpu().numpy()
+            evaluator.update_padded_batch(labels, predictions)
+            active = labels != -100
+            eval_labels.append(labels[active])
+            eval_preds.append(predictions[active])
 
-    labels = [ids_to_labels[id.item()] for id in eval_labels]
-    predictions = [ids_to_labels[id.item()] for id in eval_preds]
+    label_names = np.array([ids_to_labels[i] for i in range(len(ids_to_labels))], dtype=object)
+    labels = label_names[np.concatenate(eval_labels)].tolist() if eval_labels else []
+    predictions = label_names[np.concatenate(eval_preds)].tolist() if eval_preds else []
 
+    results = evaluator.compute()
     eval_loss = eval_loss / nb_eval_steps
-    eval_accuracy = eval_accuracy / nb_eval_steps
     print(f"Validation Loss: {eval_loss}")
-    print(f"Validation Accuracy: {eval_accuracy}")
+    print(f"Validation Accuracy: {results['all']['accuracy'] / 100}")
+    for entity_type, scores in results.items():
+        print("{0:>30}  precision: {1:6.2f}  recall: {2:6.2f}  f1: {3:6.2f}".format(
+            entity_type, scores['precision'], scores['recall'], scores['f1']))
 
-    return labels, predictions
+    return labels, predictions, results
 
 
 # def evaluation_auto(testing_loader):
-#     labels, predictions = valid(model, testing_loader)
+#     labels, predictions, results = valid(model, testing_loader)
 #
 #     print(labels[:10])
 #     print(predictions[:10])
@@ -482,23 +444,35 @@ def get_PICO(text):
 
 
 class PICO_Class:
-    def __init__(self):
+    def __init__(self, spacy_cache_dir=None):
+        '''
+        With spacy_cache_dir, the spaCy tokenization of every text is cached there (see spacy_cache.py)
+        '''
         self.model = load_model()
         self.spacy_nlp = spacy.load("en_core_sci_lg")
-        with open(os.path.join(dir, 'output/label_dict.pickle'), 'rb') as handle:
-            self.label_dict = pickle.load(handle)
-
-        with open(os.path.join(dir, 'output/labels_to_ids.pickle'), 'rb') as handle:
-            self.labels_to_ids = pickle.load(handle)
-
-        with open(os.path.join(dir, 'output/ids_to_labels.pickle'), 'rb') as handle:
-            self.ids_to_labels = pickle.load(handle)
+        if spacy_cache_dir is not None:
+            self.spacy_nlp = SpacyDocCache(spacy_cache_dir, self.spacy_nlp)
+        self.label_dict = label_dict
+        self.labels_to_ids = labels_to_ids
+        self.ids_to_labels = ids_to_labels
 
     def get_pico(self, text):
         df = testing_function_with_model(text, self.spacy_nlp, self.model)
         results = get_result_entity(text, df)
         return results
 
+    def get_pico_bulk(self, texts, batch_size=32, pipelined=True):
+        '''
+        get_pico of every text, in order. spaCy, the tokenizer, the model and decoding run in overlapping stages on
+        batches of sentences from consecutive texts (see annotation_pipeline.py); the busy time of every stage is
+        printed at the end.
+        '''
+        pipeline = AnnotationPipeline(self.model, get_tokenizer(), self.ids_to_labels, self.spacy_nlp, MAX_LEN,
+                                      batch_size, pipelined=pipelined)
+        for results in pipeline.annotate(texts, get_result_entity_from_predictions):
+            yield results
+        pipeline.print_utilization()
+
 
 def main():
     pico_fetcher = PICO_Class()
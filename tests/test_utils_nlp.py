@@ -0,0 +1,126 @@
+'''
+Regression tests of utils_nlp.get_bio_labels_from_entities against the token x entity loop that brat2conll.py and
+train_ner_v1.pre_processing_from_df used before it, e.g.
+    python -m pytest tests
+'''
+import copy
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils_nlp  # noqa: E402
+
+
+def get_bio_labels_with_loop(sentences, entities):
+    '''
+    The former labelling loop, entities sorted by start offset as the converters sorted them
+    '''
+    entities = sorted(entities, key=lambda entity: entity['start'])
+    sentence_labels = []
+    for sentence in sentences:
+        inside = False
+        previous_token_label = 'O'
+        labels = []
+        for token in sentence:
+            token['label'] = 'O'
+            for entity in entities:
+                if entity['start'] <= token['start'] < entity['end'] or \
+                        entity['start'] < token['end'] <= entity['end'] or \
+                        token['start'] < entity['start'] < entity['end'] < token['end']:
+                    token['label'] = entity['type'].replace('-', '_')
+                    break
+                elif token['end'] < entity['start']:
+                    break
+            if len(entities) == 0:
+                entity = {'end': 0}
+            if token['label'] == 'O':
+                gold_label = 'O'
+                inside = False
+            elif inside and token['label'] == previous_token_label:
+                gold_label = 'I-{0}'.format(token['label'])
+            else:
+                inside = True
+                gold_label = 'B-{0}'.format(token['label'])
+            if token['end'] == entity['end']:
+                inside = False
+            previous_token_label = token['label']
+            labels.append(gold_label)
+        sentence_labels.append(labels)
+    return sentence_labels
+
+
+def get_sentences(token_lengths, sentence_lengths, gap=1):
+    '''
+    Sentences of tokens with the given lengths, separated by gap characters
+    '''
+    tokens, position = [], 0
+    for length in token_lengths:
+        tokens.append({'start': position, 'end': position + length})
+        position += length + gap
+    sentences, start = [], 0
+    for length in sentence_lengths:
+        sentences.append(tokens[start:start + length])
+        start += length
+    return sentences
+
+
+def entity(start, end, entity_type='Participant'):
+    return {'start': start, 'end': end, 'type': entity_type}
+
+
+def assert_same_labels(sentences, entities):
+    expected = get_bio_labels_with_loop(copy.deepcopy(sentences), copy.deepcopy(entities))
+    assert utils_nlp.get_bio_labels_from_entities(copy.deepcopy(sentences), entities) == expected
+    return expected
+
+
+# tokens [0, 3) [4, 7) [8, 11) [12, 15) [16, 19) | [20, 23) [24, 27) [28, 31)
+SENTENCES = get_sentences([3] * 8, [5, 3])
+
+
+def test_no_entities():
+    assert assert_same_labels(SENTENCES, []) == [['O'] * 5, ['O'] * 3]
+
+
+def test_empty_entities():
+    assert_same_labels(SENTENCES, [entity(4, 4), entity(9, 9, 'Outcome')])
+
+
+def test_adjacent_entities():
+    # the same type twice, back to back, and across the sentence boundary (a sentence starts with B-)
+    labels = assert_same_labels(SENTENCES, [entity(0, 7), entity(8, 11), entity(16, 23, 'Outcome'),
+                                            entity(24, 27, 'Outcome')])
+    assert labels == [['B-Participant', 'I-Participant', 'B-Participant', 'O', 'B-Outcome'],
+                      ['B-Outcome', 'B-Outcome', 'O']]
+
+
+def test_overlapping_entities():
+    assert_same_labels(SENTENCES, [entity(0, 11), entity(4, 19, 'Outcome')])
+    assert_same_labels(SENTENCES, [entity(4, 19, 'Outcome'), entity(0, 11)])
+
+
+def test_nested_entities():
+    assert_same_labels(SENTENCES, [entity(0, 19), entity(4, 7, 'Intervention')])
+    assert_same_labels(SENTENCES, [entity(4, 7, 'Intervention'), entity(4, 15)])
+
+
+def test_entities_inside_and_across_tokens():
+    # part of a token, a span over the gap between tokens, a dash in the type
+    assert_same_labels(SENTENCES, [entity(1, 2), entity(6, 9, 'Outcome-Measure'), entity(20, 31)])
+
+
+def test_random_documents():
+    rng = random.Random(200)
+    types = ['Participant', 'Intervention', 'Outcome']
+    for _ in range(500):
+        sentence_lengths = [rng.randint(1, 6) for _ in range(rng.randint(1, 4))]
+        sentences = get_sentences([rng.randint(1, 5) for _ in range(sum(sentence_lengths))], sentence_lengths,
+                                  gap=rng.randint(0, 1))
+        end = sentences[-1][-1]['end']
+        entities = []
+        for _ in range(rng.randint(0, 6)):
+            start = rng.randint(0, end)
+            entities.append(entity(start, min(end, start + rng.randint(0, 12)), rng.choice(types)))
+        assert_same_labels(sentences, entities)
@@ -5,6 +5,14 @@ Automatically generated by Colaboratory.
 
 Original file is located at
     https://colab.research.google.com/drive/1n4zd9a3Vz4TJUjoeCctJP3S3gPYoyj7r
+
+Training pipeline of the NER model, usable as a library
+    import train_ner_v1
+    train_ner_v1.train_ner({'learning_rate': 3e-5, 'output_dir': 'output/run1'})
+or from the command line
+    python train_ner_v1.py --learning_rate 3e-5 --output_dir output/run1
+Nothing is loaded or trained at import time; the tokenizers (and the spaCy model of pre_processing_from_df) are loaded
+the first time a run needs them and reused by later runs in the same process.
 """
 # ! pip install transformers
 # ! pip install datasets
@@ -17,28 +25,119 @@ Original file is located at
 # !pip install https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.4.0/en_core_sci_lg-0.4.0.tar.gz
 
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+import argparse
+import copy
+import json
 import random
+import time
 import numpy as np
-from tqdm.notebook import tqdm
-# from tqdm import tqdm
 import pandas as pd
-import spacy
-import codecs
-import collections
 import pickle
-from sklearn.metrics import accuracy_score
-from torch.utils.data import Dataset, DataLoader
-from transformers import BertModel, BertForTokenClassification, AutoTokenizer, AutoModel, AutoModelForMaskedLM, AutoModelForTokenClassification
+import shutil
+from torch.utils.data import DataLoader
+from transformers import BertForTokenClassification, AutoTokenizer
 import torch
 from torch.optim import Optimizer
 from typing import Callable, Iterable, Tuple
 from torch.distributions.bernoulli import Bernoulli
 import math
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import Subset
 from torch import cuda
-device = 'cuda' if cuda.is_available() else 'cpu'
-print(device)
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from checkpointing import AsyncCheckpointWriter, ResumableSampler, find_latest_checkpoint, get_rng_state, \
+    load_training_state, set_rng_state, snapshot
+from ner_evaluation import EntityEvaluator, evaluate_model
+from dataset_cache import EncodedDataset, get_cache_key, load_or_encode_dataset
+from conll_corpus import read_conll
+from conll_io import open_conll
+from feature_cache import load_or_compute_features
+from model_bundle import WEIGHTS_FILENAME, load_model_bundle, save_model_bundle
+from model_pruning import PRUNED_LAYERS_KEY
+from ner_dataset import NERDataset, SentenceEncoder, encode_dataset
+from sequence_packing import PackedDataset, get_model_inputs
+from spacy_cache import SpacyDocCache, pipe_sentences_and_tokens
+import local_utils as utils
+import utils_nlp
+
+DEFAULT_PARAMETERS = {
+    'filepath': 'output/pico_conll.tsv',
+    'model_name': "microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext",
+    'max_len': 256,  # 128 #
+    'train_batch_size': 8,
+    'valid_batch_size': 4,
+    'epochs': 10,
+    'learning_rate': 1e-05,
+    'max_grad_norm': 10,
+    'optimizer_mode': None,  # None, 'ChildTuning-D' or 'ChildTuning-F'
+    'reserve_p': 0.3,  # fraction of the gradients ChildTuning keeps
+    # partial fine-tuning: frozen parameters get no gradients and no optimizer state
+    'freeze_embeddings': False,
+    'freeze_layers': 0,  # number of lower encoder layers to freeze
+    'pack_sequences': False,  # pack several training sentences into each sequence of max_len tokens
+    'seed': 200,
+    # 1: 80:20 split, 2: all data for training, 3: holdout_size of the data held out for evaluation,
+    # 4: k-fold cross-validation, fold 'fold' of 'num_folds' is held out
+    'training_option': 3,
+    'holdout_size': 0.1,
+    'num_folds': None,
+    'fold': 0,
+    'label_dir': 'output',  # label_dict / labels_to_ids / ids_to_labels pickles, shared with test_ner_v1.py
+    'output_dir': 'output',  # trained models
+    'checkpoint_dir': None,  # training-state checkpoints, default: {output_dir}/checkpoints
+    'resume': False,  # continue from the latest training-state checkpoint in checkpoint_dir
+    'tokenized_cache_dir': None,  # folder to cache the tokenized dataset in, shared between runs
+    'results_file': None,  # json file with the holdout results of the run
+    'bundle_dir': None,  # model bundle of the best (or last) model, default: {output_dir}/model_bundle
+    'log_interval': 100,  # steps between training loss reports, 0 disables them
+    'checkpoint_interval': 500,  # steps between mid-epoch training-state checkpoints, 0: only at the end of epochs
+    'keep_checkpoints': 3,  # number of training-state checkpoints to keep, 0 keeps all of them
+    # holdout evaluation (training_option 1, 3 and 4)
+    'eval_interval': 1,  # epochs between entity-level F1 evaluations on the holdout split
+    'early_stopping_patience': 2,  # evaluations without F1 improvement before training stops, 0 disables it
+    'early_stopping_min_delta': 0.0,  # F1 gain (in %) needed to count as an improvement
+    'save_best_only': True,  # only keep the model with the best holdout F1 instead of one model per epoch
+    'num_threads_per_process': None,  # distributed mode: None splits the cores evenly between the local processes
+    'cpu_affinity': None,  # cores to pin the process to (list of core ids), e.g. by sweep_ner.py
+    # head-only training: the encoder is frozen and runs once over the corpus, only the classification head is
+    # trained, from the cached encoder features of the words (see feature_cache.py)
+    'head_only': False,
+    'encoder_bundle': None,  # model bundle to take the encoder (and the head rows of its labels) from
+    'feature_layer': -1,  # hidden states of this encoder layer (0: embeddings, -1: last), later layers are dropped
+    'feature_cache_dir': 'output/feature_cache',  # encoder features, shared between runs
+    'head_epochs': 100,
+    'head_learning_rate': 1e-3,
+    'head_batch_size': 1024,  # words
+    # holdout evaluations without F1 improvement before head-only training stops, 0 disables it; larger than
+    # early_stopping_patience, epochs are cheap and new label rows start from random weights
+    'head_early_stopping_patience': 15,
+}
+
+# resources loaded on first use and shared by all runs of the process
+_tokenizers = {}
+_spacy_nlp = None
+
+
+def get_tokenizer(model_name):
+    if model_name not in _tokenizers:
+        # tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+        _tokenizers[model_name] = AutoTokenizer.from_pretrained(model_name)
+    return _tokenizers[model_name]
+
+
+def get_spacy_nlp(spacy_cache_dir=None):
+    '''
+    The spaCy model, or with spacy_cache_dir a SpacyDocCache of it (see spacy_cache.py), which only loads the model
+    for texts that are not cached yet
+    '''
+    global _spacy_nlp
+    if spacy_cache_dir is not None:
+        return SpacyDocCache(spacy_cache_dir, _spacy_nlp or "en_core_sci_lg")
+    if _spacy_nlp is None:
+        import spacy
+        _spacy_nlp = spacy.load("en_core_sci_lg")  # using scispacy
+    return _spacy_nlp
+
 
 def set_seed(seed):
     random.seed(seed)
@@ -47,61 +146,45 @@ def set_seed(seed):
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
 
-set_seed(200)
-training_option = 2
 
 def replace_unicode_whitespaces_with_ascii_whitespace(string):
     return ' '.join(string.split())
 
 
-spacy_nlp = spacy.load("en_core_sci_lg")  # using scispacy
-verbose = True
-
 # output_file = codecs.open('haotest_v2.tsv', 'w', 'utf-8')
 
-def get_start_and_end_offset_of_token_from_spacy(token):
-    start = token.idx
-    end = start + len(token)
-    return start, end
-
-def get_sentences_and_tokens_from_spacy(text, spacy_nlp):
-    document = spacy_nlp(text)
-    # sentences
-    sentences = []
-    for span in document.sents:
-        sentence = [document[i] for i in range(span.start, span.end)]
-        sentence_tokens = []
-        for token in sentence:
-            token_dict = {}
-            token_dict['start'], token_dict['end'] = get_start_and_end_offset_of_token_from_spacy(token)
-            token_dict['text'] = text[token_dict['start']:token_dict['end']]
-            if token_dict['text'].strip() in ['\n', '\t', ' ', '']:
-                continue
-            # Make sure that the token text does not contain any space
-            if len(token_dict['text'].split(' ')) != 1:
-                print("WARNING: the text of the token contains space character, replaced with hyphen\n\t{0}\n\t{1}".format(token_dict['text'], 
-                                                                                                                           token_dict['text'].replace(' ', '-')))
-                token_dict['text'] = token_dict['text'].replace(' ', '-')
-            sentence_tokens.append(token_dict)
-        sentences.append(sentence_tokens)
-    return sentences
-
-def pre_processing_from_df(abs_df, entity_df, output_file):
-    for abs_id, text in zip(abs_df.abstract_id, abs_df.text):
-      print(abs_id, ' ', text)
-      rows_df = entity_df.loc[entity_df['abstract_id']==abs_id]
-
+def pre_processing_from_df(abs_df, entity_df, output_file, spacy_nlp=None, verbose=False, batch_size=64,
+                           n_process=1, spacy_cache_dir=None):
+    '''
+    Write the abstracts of abs_df (abstract_id, text) with the entities of entity_df (abstract_id, type, offset_start,
+    offset_finish, mention) to output_file in CoNLL format, and close it. output_file is a text stream or a file path
+    (compressed if it ends with .gz or .zst, see conll_io).
+    The entities are grouped by abstract once, the abstracts are tokenized in batches with spacy_nlp.pipe, and the
+    lines of every abstract are written at once. verbose prints every abstract, entity and line.
+    spacy_nlp may be a SpacyDocCache; with spacy_cache_dir (and no spacy_nlp) the tokenization is cached there, and
+    preprocessing the same abstracts again does not run spaCy.
+    '''
+    if spacy_nlp is None:
+        spacy_nlp = get_spacy_nlp(spacy_cache_dir)
+    if isinstance(output_file, str):
+        output_file = open_conll(output_file, 'w')
+    # positions of the entities of every abstract, in the order of the table
+    entity_positions = entity_df.groupby('abstract_id', sort=False).indices
+    entity_types = entity_df['type'].to_numpy()
+    entity_starts = entity_df['offset_start'].to_numpy().astype(np.int64)
+    entity_ends = entity_df['offset_finish'].to_numpy().astype(np.int64)
+    entity_mentions = entity_df['mention'].to_numpy()
+
+    abstract_ids, texts = abs_df.abstract_id.tolist(), abs_df.text.tolist()
+    document_sentences = pipe_sentences_and_tokens(texts, spacy_nlp, batch_size, n_process)
+    for abs_id, text, sentences in zip(abstract_ids, texts, document_sentences):
+      if verbose: print(abs_id, ' ', text)
       entities = []
-      for index, arow in rows_df.iterrows():
-        # print(arow)
+      for position in entity_positions.get(abs_id, []):
         # parse entity
-        entity = {}
-        entity['id'] = arow['abstract_id']
-        entity['type'] = arow['type']
-        entity['start'] = int(arow['offset_start'])
-        entity['end'] = int(arow['offset_finish'])
-        entity['text'] = arow['mention']
-        print("entity: {0}".format(entity))
+        entity = {'id': abs_id, 'type': entity_types[position], 'start': int(entity_starts[position]),
+                  'end': int(entity_ends[position]), 'text': entity_mentions[position]}
+        if verbose: print("entity: {0}".format(entity))
         # Check compatibility between brat text and anotation
         if replace_unicode_whitespaces_with_ascii_whitespace(text[entity['start']:entity['end']]) != \
             replace_unicode_whitespaces_with_ascii_whitespace(entity['text']):
@@ -111,333 +194,133 @@ def pre_processing_from_df(abs_df, entity_df, output_file):
         # add to entitys data
         entities.append(entity)
 
-      entities = sorted(entities, key=lambda entity:entity["start"])
-      sentences = get_sentences_and_tokens_from_spacy(text, spacy_nlp)
-
-      for sentence in sentences:
-          inside = False
-          previous_token_label = 'O'
-          for token in sentence:
-              token['label'] = 'O'
-              for entity in entities:
-                  if entity['start'] <= token['start'] < entity['end'] or \
-                      entity['start'] < token['end'] <= entity['end'] or \
-                      token['start'] < entity['start'] < entity['end'] < token['end']:
-                      token['label'] = entity['type'].replace('-', '_') # Because the ANN doesn't support tag with '-' in it
-                      break
-                  elif token['end'] < entity['start']:
-                      break
-
-              if len(entities) == 0:
-                  entity={'end':0}
-              if token['label'] == 'O':
-                  gold_label = 'O'
-                  inside = False
-              elif inside and token['label'] == previous_token_label:
-                  gold_label = 'I-{0}'.format(token['label'])
-              else:
-                  inside = True
-                  gold_label = 'B-{0}'.format(token['label'])
-              if token['end'] == entity['end']:
-                  inside = False
-              previous_token_label = token['label']
-              if verbose: print('{0}\t{1}\t{2}\t{3}\n'.format(token['text'], token['start'], token['end'], gold_label))
-              output_file.write('{0}\t{1}\t{2}\t{3}\n'.format(token['text'], token['start'], token['end'], gold_label))
-          if verbose: print('\n')
-          output_file.write('\n')
+      lines = []
+      for sentence, labels in zip(sentences, utils_nlp.get_bio_labels_from_entities(sentences, entities)):
+          for token, gold_label in zip(sentence, labels):
+              lines.append('{0}\t{1}\t{2}\t{3}\n'.format(token['text'], token['start'], token['end'], gold_label))
+          lines.append('\n')
+      if verbose: print('\n'.join(lines))
+      output_file.write(''.join(lines))
 
     output_file.close()
 
 
-def parse_dataset(dataset_filepath):
-  token_count = collections.defaultdict(lambda: 0)
-  label_count = collections.defaultdict(lambda: 0)
-  character_count = collections.defaultdict(lambda: 0)
-
-  line_count = -1
-  tokens = []
-  labels = []
-  new_token_sequence = []
-  new_label_sequence = []
-  if dataset_filepath:
-      f = codecs.open(dataset_filepath, 'r', 'UTF-8')
-      for line in f:
-          line_count += 1
-          line = line.strip().split('\t')
-          if len(line) == 0 or len(line[0]) == 0 or '-DOCSTART-' in line[0]:
-              if len(new_token_sequence) > 0:
-                  labels.append(new_label_sequence)
-                  tokens.append(new_token_sequence)
-                  new_token_sequence = []
-                  new_label_sequence = []
-              continue
-          token = str(line[0])
-          label = str(line[-1])
-          token_count[token] += 1
-          label_count[label] += 1
-
-          new_token_sequence.append(token)
-          new_label_sequence.append(label)
-
-          for character in token:
-              character_count[character] += 1
-
-          # if line_count > 200: break# for debugging purposes
-
-      if len(new_token_sequence) > 0:
-          labels.append(new_label_sequence)
-          tokens.append(new_token_sequence)
-      f.close()
-  return labels, tokens, token_count, label_count, character_count
-
-filepath = 'output/pico_conll.tsv'
-
-labels, tokens, token_count, label_count, character_count = parse_dataset(filepath)
-
-print(labels[:10])
-print(tokens[:10])
-
-print(len(labels))
-
-
-labels_set = set()
-for x in labels:
-  for y in x:
-    labels_set.add(y)
-print(labels_set)
-labels_to_ids = {k: v for v, k in enumerate(labels_set)}
-ids_to_labels = {v: k for v, k in enumerate(labels_set)}
-label_dict = labels_to_ids
-print(label_dict)
-
-#################################################################################
-# only dump once:
-# delete old ones if training new batch with different labels
-# dump label_dict, need use the same trained dict for prediction
-if os.path.isfile('output/label_dict.pickle'):
-    with open('output/label_dict.pickle', 'rb') as handle:
-        label_dict = pickle.load(handle)
-else:
-    with open('output/label_dict.pickle', 'wb') as handle:
-        pickle.dump(label_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-if os.path.isfile('output/labels_to_ids.pickle'):
-    with open('output/labels_to_ids.pickle', 'rb') as handle:
-        labels_to_ids = pickle.load(handle)
-else:
-    with open('output/labels_to_ids.pickle', 'wb') as handle:
-        pickle.dump(labels_to_ids, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-if os.path.isfile('output/ids_to_labels.pickle'):
-    with open('output/ids_to_labels.pickle', 'rb') as handle:
-        ids_to_labels = pickle.load(handle)
-else:
-    with open('output/ids_to_labels.pickle', 'wb') as handle:
-        pickle.dump(ids_to_labels, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-# way to load pickle
-# with open('filename.pickle', 'rb') as handle:
-#     b = pickle.load(handle)
-###########################################################################################
-
-df = pd.DataFrame(zip(tokens, labels), columns=['tokens', 'labels'])
-
-print(df[:10])
-print(df.shape)
-
-
-
-# let's create a new column called "sentence" which groups the words by sentence 
-df['sentence'] = df['tokens'].transform(lambda x: ' '.join(x))
-# let's also create a new column called "word_labels" which groups the tags by sentence 
-df['word_labels'] = df['labels'].transform(lambda x: ','.join(x))
-df.head()
-
-data = df[["sentence", "word_labels"]].drop_duplicates().reset_index(drop=True)
-data.head()
-
-
-class dataset(Dataset):
-  def __init__(self, dataframe, tokenizer, max_len):
-        self.len = len(dataframe)
-        self.data = dataframe
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-
-  def __getitem__(self, index):
-        # step 1: get the sentence and word labels 
-        sentence = self.data.sentence[index].strip().split()  
-        word_labels = self.data.word_labels[index].split(",") 
-
-        # step 2: use tokenizer to encode sentence (includes padding/truncation up to max length)
-        # BertTokenizerFast provides a handy "return_offsets_mapping" functionality for individual tokens
-        encoding = self.tokenizer(sentence,
-                            #  is_pretokenized=True, 
-                            # add_special_tokens=True,  
-                            is_split_into_words=True,
-                             return_offsets_mapping=True, 
-                             padding= 'max_length',  # 'longest'
-                             truncation=True, 
-                             max_length=self.max_len)
-        
-        
-        # step 3: create token labels only for first word pieces of each tokenized word
-        labels = [labels_to_ids[label] for label in word_labels]
-        # code based on https://huggingface.co/transformers/custom_datasets.html#tok-ner
-        # create an empty array of -100 of length max_length
-        encoded_labels = np.ones(len(encoding["offset_mapping"]), dtype=int) * -100
-        
-        # set only labels whose first offset position is 0 and the second is not 0
-        i = 0
-        for idx, mapping in enumerate(encoding["offset_mapping"]):
-          if mapping[0] == 0 and mapping[1] != 0:
-            # overwrite label
-            encoded_labels[idx] = labels[i]
-            i += 1
-
-        # step 4: turn everything into PyTorch tensors
-        item = {key: torch.as_tensor(val) for key, val in encoding.items()}
-        item['labels'] = torch.as_tensor(encoded_labels)
-        
-        return item
-
-  def __len__(self):
-        return self.len
-
-class LitCoindataset(Dataset):
-  def __init__(self, dataframe, tokenizer, max_len):
-        self.len = len(dataframe)
-        self.data = dataframe
-        self.tokenizer = tokenizer
-        self.max_len = max_len
-
-  def __getitem__(self, index):
-        # step 1: get the sentence and word labels 
-        sentence = self.data.sentence[index].strip().split()  
-        word_labels = self.data.word_labels[index].split(",") 
-
-        # step 2: use tokenizer to encode sentence (includes padding/truncation up to max length)
-        # BertTokenizerFast provides a handy "return_offsets_mapping" functionality for individual tokens
-        encoding = self.tokenizer(sentence,
-                            #  is_pretokenized=True, 
-                            is_split_into_words=True,
-                             return_offsets_mapping=True, 
-                             padding='max_length', 
-                             truncation=True, 
-                             max_length=self.max_len)
-        
-        # step 3: create token labels only for first word pieces of each tokenized word
-        labels = [labels_to_ids[label] for label in word_labels] 
-        # code based on https://huggingface.co/transformers/custom_datasets.html#tok-ner
-        # create an empty array of -100 of length max_length
-        encoded_labels = np.ones(len(encoding["offset_mapping"]), dtype=int) * -100
-        
-        # set only labels whose first offset position is 0 and the second is not 0
-        i = 0
-        for idx, mapping in enumerate(encoding["offset_mapping"]):
-          if mapping[0] == 0 and mapping[1] != 0:
-            # overwrite label
-            encoded_labels[idx] = labels[i]
-            i += 1
-
-        # step 4: turn everything into PyTorch tensors
-        item = {key: torch.as_tensor(val) for key, val in encoding.items()}
-        item['labels'] = torch.as_tensor(encoded_labels)
-        
-        return item
-
-  def __len__(self):
-        return self.len
-
-
-############################################
-# option 1: split to 80:20
-if training_option == 1:
-    train_size = 0.8
-    validation_size = 0.2
-    train_dataset = data.sample(frac=train_size, random_state=200)
-
-    test_dataset = data.drop(train_dataset.index).reset_index(drop=True)
-    train_dataset = train_dataset.reset_index(drop=True)
-
-    validation_dataset = test_dataset.copy()
+def init_distributed(num_threads_per_process=None):
+    '''
+    Distributed data-parallel training on CPU (gloo backend), launched with torchrun, e.g.
+      torchrun --standalone --nproc_per_node=4 train_ner_v1.py
+      torchrun --nnodes=2 --node_rank=0 --nproc_per_node=2 --master_addr=host0 --master_port=29500 train_ner_v1.py
+    every process trains on its own shard of the training data and gradients are averaged after each backward pass.
+    Returns (distributed, rank, world_size).
+    '''
+    if int(os.environ.get('WORLD_SIZE', '1')) <= 1:
+        return False, 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+        local_rank = int(os.environ.get('LOCAL_RANK', '0'))
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', str(dist.get_world_size())))
+        # pin each local process to its own contiguous block of cores, so that processes stay on their socket
+        if hasattr(os, 'sched_getaffinity'):
+            cores = sorted(os.sched_getaffinity(0))
+            cores_per_process = max(1, len(cores) // local_world_size)
+            process_cores = cores[local_rank * cores_per_process:(local_rank + 1) * cores_per_process]
+            if process_cores:
+                os.sched_setaffinity(0, process_cores)
+        else:
+            cores_per_process = max(1, (os.cpu_count() or 1) // local_world_size)
+        torch.set_num_threads(num_threads_per_process or cores_per_process)
+    return True, dist.get_rank(), dist.get_world_size()
+
+
+def dump_pickle(obj, filepath):
+    # write to a temporary file first, so that concurrent runs never read a partially written pickle
+    with open(filepath + '.tmp{}'.format(os.getpid()), 'wb') as handle:
+        pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filepath + '.tmp{}'.format(os.getpid()), filepath)
+
+
+def load_or_dump_label_maps(labels_set, label_dir, distributed=False, is_main_process=True):
+    '''
+    Label maps of the corpus labels, or the ones of an earlier run if its pickles exist.
+    only dump once:
+    delete old ones if training new batch with different labels
+    dump label_dict, need use the same trained dict for prediction
+    in distributed mode only rank 0 dumps them, the other processes wait and load rank 0's files
+    '''
+    # sorted, so that every process of a distributed run derives the same label ids
+    labels_set = sorted(labels_set)
+    print(labels_set)
+    label_maps = {'label_dict': {k: v for v, k in enumerate(labels_set)},
+                  'labels_to_ids': {k: v for v, k in enumerate(labels_set)},
+                  'ids_to_labels': {v: k for v, k in enumerate(labels_set)}}
+    print(label_maps['label_dict'])
+
+    if distributed and not is_main_process:
+        dist.barrier()
+    utils.create_folder_if_not_exists(label_dir)
+    for name in ['label_dict', 'labels_to_ids', 'ids_to_labels']:
+        filepath = os.path.join(label_dir, '{0}.pickle'.format(name))
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as handle:
+                label_maps[name] = pickle.load(handle)
+        else:
+            dump_pickle(label_maps[name], filepath)
+    if distributed and is_main_process:
+        dist.barrier()
+    return label_maps['label_dict'], label_maps['labels_to_ids'], label_maps['ids_to_labels']
+
+
+def get_sentence_dataframe(corpus):
+    '''
+    One row per distinct (tokens, labels) sentence, deduplicated on the id arrays, with the word and label lists as
+    columns
+    '''
+    unique_sentence_indices = corpus.get_unique_sentence_indices()
+    return pd.DataFrame({'sentence_id': np.arange(len(unique_sentence_indices)),
+                         'tokens': [corpus.get_tokens(i) for i in unique_sentence_indices],
+                         'labels': [corpus.get_labels(i) for i in unique_sentence_indices]})
+
+
+def split_data(data, parameters):
+    '''
+    Training and validation (None without holdout) DataFrames of the training option
+    '''
+    training_option = parameters['training_option']
+    validation_dataset = None
+    ############################################
+    # option 1: split to 80:20
+    if training_option == 1:
+        train_size = 0.8
+        train_dataset = data.sample(frac=train_size, random_state=200)
+        validation_dataset = data.drop(train_dataset.index).reset_index(drop=True)
+        train_dataset = train_dataset.reset_index(drop=True)
+    ###################################################################
+    # option 2:
+    # use all data for training
+    elif training_option == 2:
+        train_dataset = data
+    ###################################################################
+    # option 3:
+    # hold out holdout_size of the data, evaluate on it during training and stop early once it stops improving
+    elif training_option == 3:
+        validation_dataset = data.sample(frac=parameters['holdout_size'], random_state=200)
+        train_dataset = data.drop(validation_dataset.index).reset_index(drop=True)
+        validation_dataset = validation_dataset.reset_index(drop=True)
+    ###################################################################
+    # option 4:
+    # k-fold cross-validation: fold 'fold' of 'num_folds' folds is the holdout split, as in option 3
+    elif training_option == 4:
+        fold_ids = np.random.RandomState(200).permutation(len(data)) % parameters['num_folds']
+        validation_dataset = data[fold_ids == parameters['fold']].reset_index(drop=True)
+        train_dataset = data[fold_ids != parameters['fold']].reset_index(drop=True)
+    else:
+        raise ValueError("Unknown training_option: {0}".format(training_option))
 
     print("FULL Dataset: {}".format(data.shape))
     print("TRAIN Dataset: {}".format(train_dataset.shape))
-    print("Validation Dataset: {}".format(validation_dataset.shape))
-    print("TEST Dataset: {}".format(test_dataset.shape))
-
-    train_dataset.head()
-    validation_dataset.head()
-    test_dataset.head()
-###################################################################
-# option 2:
-# use all data for training
-if training_option == 2:
-    train_dataset = data
-    print("FULL Dataset: {}".format(data.shape))
-    print("TRAIN Dataset: {}".format(train_dataset.shape))
-    print(train_dataset.head())
-##################################################################
-# parameters
-MAX_LEN = 256  # 128 #
-TRAIN_BATCH_SIZE = 8
-VALID_BATCH_SIZE = 4
-EPOCHS = 10
-LEARNING_RATE = 1e-05
-MAX_GRAD_NORM = 10
-
-##################################################################
-
-
-# tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
-tokenizer = AutoTokenizer.from_pretrained("microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext")
-
-training_set = dataset(train_dataset, tokenizer, MAX_LEN)
-# testing_set = dataset(test_dataset, tokenizer, MAX_LEN)
-# validation_set = dataset(validation_dataset, tokenizer, MAX_LEN)
-
-train_params = {'batch_size': TRAIN_BATCH_SIZE,
-                'shuffle': True,
-                'num_workers': 0
-                }
-
-test_params = {'batch_size': VALID_BATCH_SIZE,
-                'shuffle': True,
-                'num_workers': 0
-                }
-
-training_loader = DataLoader(training_set, **train_params)
-# testing_loader = DataLoader(testing_set, **test_params)
-
-# model = BertForTokenClassification.from_pretrained('bert-base-uncased', num_labels=len(labels_to_ids))
-model = BertForTokenClassification.from_pretrained("microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext", num_labels=len(label_dict))
-
-
-
-model.to(device)
-
-# print(training_set[2])
-#
-# inputs = training_set[2]
-# input_ids = inputs["input_ids"].unsqueeze(0)
-# attention_mask = inputs["attention_mask"].unsqueeze(0)
-# labels = inputs["labels"].unsqueeze(0)
-#
-# input_ids = input_ids.to(device)
-# attention_mask = attention_mask.to(device)
-# labels = labels.to(device)
-#
-# outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
-# initial_loss = outputs[0]
-# print(initial_loss)
-#
-# outputs = model(input_ids, attention_mask=attention_mask, labels=labels)
-# print(outputs[0].item())
-#
-# tr_logits = outputs[1]
-# print(tr_logits.shape)
-
+    if validation_dataset is not None:
+        print("Validation Dataset: {}".format(validation_dataset.shape))
+    return train_dataset, validation_dataset
 
 
 class ChildTuningAdamW(Optimizer):
@@ -450,7 +333,8 @@ class ChildTuningAdamW(Optimizer):
         weight_decay: float = 0.0,
         correct_bias: bool = True,
         reserve_p = 1.0,
-        mode = None
+        mode = None,
+        seed = None
     ):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
@@ -466,10 +350,28 @@ class ChildTuningAdamW(Optimizer):
         self.gradient_mask = None
         self.reserve_p = reserve_p
         self.mode = mode
+        # ChildTuning-F masks are drawn from a dedicated generator when a seed is given, so that all processes of a
+        # distributed run sample the same mask for their (already averaged) gradients and the replicas stay in sync
+        self.seed = seed
+        self.generators = {}
+
+    def generator_state_dict(self):
+        return {str(device): generator.get_state() for device, generator in self.generators.items()}
+
+    def load_generator_state_dict(self, state_dict):
+        for device, state in state_dict.items():
+            self._get_generator(torch.device(device)).set_state(state)
 
     def set_gradient_mask(self, gradient_mask):
         self.gradient_mask = gradient_mask
 
+    def _get_generator(self, device):
+        if device not in self.generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self.generators[device] = generator
+        return self.generators[device]
+
     def step(self, closure: Callable = None):
         """
         Performs a single optimization step.
@@ -495,8 +397,12 @@ class ChildTuningAdamW(Optimizer):
                             grad *= self.gradient_mask[p]
                     else: 
                         # ChildTuning-F
-                        grad_mask = Bernoulli(grad.new_full(size=grad.size(), fill_value=self.reserve_p))
-                        grad *= grad_mask.sample() / self.reserve_p
+                        if self.seed is None:
+                            grad_mask = Bernoulli(grad.new_full(size=grad.size(), fill_value=self.reserve_p)).sample()
+                        else:
+                            grad_mask = torch.bernoulli(grad.new_full(size=grad.size(), fill_value=self.reserve_p),
+                                                        generator=self._get_generator(grad.device))
+                        grad *= grad_mask / self.reserve_p
                 # =================== HACK END =======================
 
                 state = self.state[p]
@@ -540,74 +446,668 @@ class ChildTuningAdamW(Optimizer):
 
         return loss
 
-# optimizer = torch.optim.Adam(params=model.parameters(), lr=LEARNING_RATE)
-optimizer = ChildTuningAdamW(params=model.parameters(), lr=LEARNING_RATE)
-
-
-# Defining the training function on the 80% of the dataset for tuning the bert model
-def train(epoch):
-    tr_loss, tr_accuracy = 0, 0
-    nb_tr_examples, nb_tr_steps = 0, 0
-    tr_preds, tr_labels = [], []
-    # put model in training mode
-    model.train()
-    
-    for idx, batch in enumerate(training_loader):
-        
-        ids = batch['input_ids'].to(device, dtype = torch.long)
-        mask = batch['attention_mask'].to(device, dtype = torch.long)
-        labels = batch['labels'].to(device, dtype = torch.long)
-
-        outputs = model(input_ids=ids, attention_mask=mask, labels=labels)
-        loss = outputs[0]
-        tr_logits = outputs[1]
-        tr_loss += loss.item()
-
-        nb_tr_steps += 1
-        nb_tr_examples += labels.size(0)
-        
-        if idx % 100==0:
-            loss_step = tr_loss/nb_tr_steps
-            print(f"Training loss per 100 training steps: {loss_step}")
-           
-        # compute training accuracy
-        flattened_targets = labels.view(-1) # shape (batch_size * seq_len,)
-        active_logits = tr_logits.view(-1, model.num_labels) # shape (batch_size * seq_len, num_labels)
-        flattened_predictions = torch.argmax(active_logits, axis=1) # shape (batch_size * seq_len,)
-        
-        # only compute accuracy at active labels
-        active_accuracy = labels.view(-1) != -100 # shape (batch_size, seq_len)
-        #active_labels = torch.where(active_accuracy, labels.view(-1), torch.tensor(-100).type_as(labels))
-        
-        labels = torch.masked_select(flattened_targets, active_accuracy)
-        predictions = torch.masked_select(flattened_predictions, active_accuracy)
-        
-        tr_labels.extend(labels)
-        tr_preds.extend(predictions)
-
-        tmp_tr_accuracy = accuracy_score(labels.cpu().numpy(), predictions.cpu().numpy())
-        tr_accuracy += tmp_tr_accuracy
-    
-        # gradient clipping
-        torch.nn.utils.clip_grad_norm_(
-            parameters=model.parameters(), max_norm=MAX_GRAD_NORM
-        )
-        
-        # backward pass
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-    epoch_loss = tr_loss / nb_tr_steps
-    tr_accuracy = tr_accuracy / nb_tr_steps
-    print(f"Training loss epoch: {epoch_loss}")
-    print(f"Training accuracy epoch: {tr_accuracy}")
-    return epoch_loss, tr_accuracy
-
-print('model number of labels: {}'.format(model.num_labels))
-
-for epoch in range(EPOCHS):
-    print(f"Training epoch: {epoch + 1}")
-    epoch_loss, tr_accuracy = train(epoch)
-    model.save_pretrained(f'output/{epoch + 1}_acc_{tr_accuracy}/')
-    torch.save(model.state_dict(), f'output/{epoch + 1}_acc_{tr_accuracy}.model')
+
+def calculate_fisher_gradient_mask(model, train_model, training_loader, device, reserve_p, distributed=False):
+    '''
+    ChildTuning-D: keep only the gradients of the reserve_p fraction of encoder parameters with the largest Fisher
+    information, estimated from the squared gradients over one pass of the training data.
+    '''
+    fisher = {p: torch.zeros_like(p) for name, p in model.named_parameters() if 'layer' in name and p.requires_grad}
+    if not fisher:
+        # every encoder layer is frozen
+        return {}
+    train_model.train()
+    for batch in training_loader:
+        outputs = train_model(**get_model_inputs(batch, device))
+        outputs[0].backward()
+        for p in fisher:
+            fisher[p] += p.grad ** 2 / len(training_loader)
+        model.zero_grad()
+    if distributed:
+        # the gradients are already averaged across processes, averaging the sums gives every process the same mask
+        for p in fisher:
+            dist.all_reduce(fisher[p])
+    threshold = np.percentile(torch.cat([f.view(-1) for f in fisher.values()]).cpu().numpy(), (1 - reserve_p) * 100)
+    return {p: fisher[p] >= threshold for p in fisher}
+
+
+def freeze_lower_layers(model, freeze_embeddings=False, freeze_layers=0):
+    '''
+    Partial fine-tuning: exclude the embeddings and the freeze_layers lowest encoder layers from training.
+    With the embeddings frozen as well, the backward pass stops at the first trainable layer.
+    Returns the number of trainable parameters and of all parameters.
+    '''
+    encoder_layers = model.base_model.encoder.layer
+    if not 0 <= freeze_layers <= len(encoder_layers):
+        raise ValueError("freeze_layers must be between 0 and {0}, got {1}".format(len(encoder_layers), freeze_layers))
+    frozen_modules = list(encoder_layers[:freeze_layers])
+    if freeze_embeddings:
+        frozen_modules.append(model.base_model.embeddings)
+    for module in frozen_modules:
+        for p in module.parameters():
+            p.requires_grad_(False)
+    trainable_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    return trainable_parameters, sum(p.numel() for p in model.parameters())
+
+
+class NERTrainer:
+    '''
+    One training run: data, model, optimizer, checkpoints and early stopping state of the given parameters
+    '''
+    def __init__(self, parameters, corpus=None):
+        self.parameters = utils.merge_dictionaries(DEFAULT_PARAMETERS, parameters or {})
+        parameters = self.parameters
+        self.distributed, self.rank, self.world_size = init_distributed(parameters['num_threads_per_process'])
+        self.is_main_process = self.rank == 0
+        self.device = 'cpu' if self.distributed else ('cuda' if cuda.is_available() else 'cpu')
+        print(self.device)
+        set_seed(parameters['seed'])
+
+        # token and label ids of the whole corpus, parsed in bulk; the statistics (corpus.token_count, ...) are
+        # computed on request
+        self.corpus = corpus if corpus is not None else read_conll(parameters['filepath'])
+        print(len(self.corpus))
+        self.label_dict, self.labels_to_ids, self.ids_to_labels = load_or_dump_label_maps(
+            self.corpus.label_vocabulary, parameters['label_dir'], self.distributed, self.is_main_process)
+        self.data = get_sentence_dataframe(self.corpus)
+        print(self.data[:10])
+        print(self.data.shape)
+        train_dataset, validation_dataset = split_data(self.data, parameters)
+        self.has_holdout = validation_dataset is not None
+
+        self.output_dir = parameters['output_dir']
+        self.checkpoint_dir = parameters['checkpoint_dir'] or os.path.join(self.output_dir, 'checkpoints')
+        utils.create_folder_if_not_exists(self.output_dir)
+
+        self.tokenizer = get_tokenizer(parameters['model_name'])
+        max_len = parameters['max_len']
+        # sentences are tokenized a batch at a time by the collate function, padded to the longest sentence
+        collate_fn = SentenceEncoder(self.tokenizer, max_len, self.labels_to_ids)
+        self.training_set = NERDataset(train_dataset)
+        if self.has_holdout:
+            self.validation_set = NERDataset(validation_dataset)
+        if parameters['tokenized_cache_dir'] or parameters['pack_sequences']:
+            # tokenized once into arrays padded to max_len; runs with the same data, labels, tokenizer and max_len
+            # share the cached arrays, whatever their split
+            def encode_arrays():
+                return encode_dataset(NERDataset(self.data), self.tokenizer, max_len, self.labels_to_ids)
+            if parameters['tokenized_cache_dir']:
+                cache_key = get_cache_key(parameters['model_name'], max_len, sorted(self.labels_to_ids.items()),
+                                          self.corpus.fingerprint())
+                encoded_data = load_or_encode_dataset(encode_arrays, parameters['tokenized_cache_dir'], cache_key)
+            else:
+                encoded_data = EncodedDataset(encode_arrays())
+            collate_fn = None
+            self.training_set = Subset(encoded_data, train_dataset.sentence_id.tolist())
+            if self.has_holdout:
+                self.validation_set = Subset(encoded_data, validation_dataset.sentence_id.tolist())
+        if parameters['pack_sequences']:
+            # fewer, fuller training sequences; the holdout split is evaluated sentence by sentence
+            number_of_sentences = len(self.training_set)
+            self.training_set = PackedDataset(self.training_set, max_len, self.tokenizer.pad_token_id)
+            print(f"Packed {number_of_sentences} training sentences into {len(self.training_set)} sequences")
+
+        # the sampler order only depends on the seed and the epoch, so that resuming can continue in the middle of an
+        # epoch; in distributed mode each process iterates over its own 1/world_size of the shuffled training set
+        self.train_sampler = ResumableSampler(self.training_set, shuffle=True, seed=parameters['seed'],
+                                              num_replicas=self.world_size, rank=self.rank)
+        # the loader draws its worker base seed from its own generator, creating the iterator of an epoch would
+        # otherwise consume the global rng state that a resumed run restores
+        train_params = {'batch_size': parameters['train_batch_size'],
+                        'sampler': self.train_sampler,
+                        'num_workers': 0,
+                        'generator': torch.Generator().manual_seed(parameters['seed']),
+                        'collate_fn': collate_fn
+                        }
+        test_params = {'batch_size': parameters['valid_batch_size'],
+                       'shuffle': False,
+                       'num_workers': 0,
+                       'collate_fn': collate_fn
+                       }
+        self.training_loader = DataLoader(self.training_set, **train_params)
+        if self.has_holdout:
+            self.validation_loader = DataLoader(self.validation_set, **test_params)
+
+        # model = BertForTokenClassification.from_pretrained('bert-base-uncased', num_labels=len(labels_to_ids))
+        self.model = BertForTokenClassification.from_pretrained(parameters['model_name'],
+                                                                num_labels=len(self.label_dict))
+        self.trainable_parameters, self.total_parameters = freeze_lower_layers(
+            self.model, parameters['freeze_embeddings'], parameters['freeze_layers'])
+        print(f"Trainable parameters: {self.trainable_parameters} of {self.total_parameters} "
+              f"({100 * self.trainable_parameters / self.total_parameters:.1f}%)")
+        self.model.to(self.device)
+        # the forward/backward pass goes through train_model, which averages gradients across processes in
+        # distributed mode
+        self.train_model = DistributedDataParallel(self.model) if self.distributed else self.model
+        print('model number of labels: {}'.format(self.model.num_labels))
+
+        # optimizer = torch.optim.Adam(params=model.parameters(), lr=LEARNING_RATE)
+        self.optimizer = ChildTuningAdamW(params=[p for p in self.model.parameters() if p.requires_grad],
+                                          lr=parameters['learning_rate'],
+                                          reserve_p=parameters['reserve_p'], mode=parameters['optimizer_mode'],
+                                          seed=parameters['seed'] if self.distributed else None)
+        if parameters['optimizer_mode'] == 'ChildTuning-D':
+            # computed before resuming from a checkpoint, so that a resumed run uses the mask of the original run
+            self.optimizer.set_gradient_mask(calculate_fisher_gradient_mask(
+                self.model, self.train_model, self.training_loader, self.device, parameters['reserve_p'],
+                self.distributed))
+
+        # checkpoints are written by a background thread of rank 0 from snapshots, so that training does not wait for
+        # the disk
+        self.checkpoint_writer = AsyncCheckpointWriter(self.checkpoint_dir, keep_last=parameters['keep_checkpoints']) \
+            if self.is_main_process else None
+        self.global_step = 0
+        self.step_seconds = []  # mean training step time of every epoch
+        # best holdout F1 so far and the files of the model that reached it, and the files of the model of the bundle
+        # (None if they were not saved), from which a resumed run restores bundle_model_state
+        self.early_stopping = {'best_f1': None, 'best_result': None, 'best_model_prefix': None,
+                               'bundle_model_prefix': None, 'evaluations_without_improvement': 0}
+        # weights of the model that is exported as the model bundle at the end of training
+        self.bundle_model_state = None
+        self.start_epoch, self.start_step, self.resume_metrics = 0, 0, None
+        if parameters['resume']:
+            self.resume()
+
+    def resume(self):
+        checkpoint_filepath = find_latest_checkpoint(self.checkpoint_dir)
+        if checkpoint_filepath is None:
+            print(f"No checkpoint found in {self.checkpoint_dir}, training from scratch")
+            return
+        print(f"Resuming from {checkpoint_filepath}")
+        training_state = load_training_state(checkpoint_filepath)
+        self.model.load_state_dict(training_state['model'])
+        self.optimizer.load_state_dict(training_state['optimizer'])
+        self.optimizer.load_generator_state_dict(training_state['childtuning_generators'])
+        self.start_epoch, self.start_step = training_state['epoch'], training_state['step']
+        self.global_step = training_state['global_step']
+        self.early_stopping.update(training_state['early_stopping'])
+        # checkpoints written before bundle_model_prefix was recorded only have the best model
+        bundle_model_prefix = self.early_stopping['bundle_model_prefix'] or self.early_stopping['best_model_prefix']
+        if self.is_main_process and bundle_model_prefix is not None:
+            if os.path.exists(f'{bundle_model_prefix}.model'):
+                self.bundle_model_state = torch.load(f'{bundle_model_prefix}.model', map_location='cpu')
+            else:
+                print(f"WARNING: {bundle_model_prefix}.model not found, the model bundle will be the model of the "
+                      f"first epoch trained after resuming unless a later one is better")
+        if len(training_state['processes']) == self.world_size:
+            set_rng_state(training_state['processes'][self.rank]['rng'])
+            self.resume_metrics = training_state['processes'][self.rank]['metrics']
+        else:
+            print("WARNING: the checkpoint was written with a different number of processes, "
+                  "rng state and running metrics are not restored")
+
+    def save_training_state(self, epoch, step, metrics=None, model_state=None):
+        '''
+        Queue a full training-state checkpoint. (epoch, step) is the position training continues from when resuming,
+        metrics are the running metrics of the current epoch.
+        '''
+        # the rng state and running metrics differ between the processes of a distributed run, rank 0 stores all of
+        # them
+        process_state = snapshot({'rng': get_rng_state(), 'metrics': metrics})
+        if self.distributed:
+            process_states = [None] * self.world_size
+            dist.all_gather_object(process_states, process_state)
+        else:
+            process_states = [process_state]
+        if not self.is_main_process:
+            return
+        self.checkpoint_writer.save_training_state(
+            {'model': model_state if model_state is not None else self.model.state_dict(),
+             'optimizer': self.optimizer.state_dict(),
+             'childtuning_generators': self.optimizer.generator_state_dict(),
+             'sampler': self.train_sampler.state_dict(),
+             'epoch': epoch,
+             'step': step,
+             'global_step': self.global_step,
+             'early_stopping': dict(self.early_stopping),
+             'processes': process_states}, epoch, step)
+
+    def save_epoch_model(self, model_state, model_prefix, replaced_model_prefix=None):
+        self.model.save_pretrained(f'{model_prefix}/', state_dict=model_state)
+        torch.save(model_state, f'{model_prefix}.model')
+        if replaced_model_prefix is not None:
+            shutil.rmtree(f'{replaced_model_prefix}/', ignore_errors=True)
+            if os.path.exists(f'{replaced_model_prefix}.model'):
+                os.remove(f'{replaced_model_prefix}.model')
+
+    def evaluate_holdout(self):
+        '''
+        Evaluate on the holdout split and update the early stopping state.
+        Returns the entity F1, whether the model should be saved and whether training should stop.
+        '''
+        result = evaluate_model(self.model, self.validation_loader, self.ids_to_labels, self.device)
+        f1 = result['all']['f1']
+        print(f"Holdout entity F1: {f1} (precision {result['all']['precision']}, recall {result['all']['recall']})")
+        for entity_type, type_result in result.items():
+            if entity_type != 'all':
+                print(f"\t{entity_type}: {type_result['f1']}")
+        early_stopping = self.early_stopping
+        improved = early_stopping['best_f1'] is None or \
+            f1 > early_stopping['best_f1'] + self.parameters['early_stopping_min_delta']
+        if improved:
+            early_stopping['best_f1'] = f1
+            early_stopping['best_result'] = result
+            early_stopping['evaluations_without_improvement'] = 0
+        else:
+            early_stopping['evaluations_without_improvement'] += 1
+        stop_training = 0 < self.parameters['early_stopping_patience'] <= \
+            early_stopping['evaluations_without_improvement']
+        return f1, improved or not self.parameters['save_best_only'], stop_training
+
+    # Defining the training function on the 80% of the dataset for tuning the bert model
+    def train(self, epoch, start_step=0, metrics=None):
+        model, train_model, optimizer, device = self.model, self.train_model, self.optimizer, self.device
+        log_interval = self.parameters['log_interval']
+        checkpoint_interval = self.parameters['checkpoint_interval']
+        # running metrics stay on the device and are only synced every log_interval steps and at the end of the epoch
+        num_labels = model.num_labels
+        tr_loss_sum = torch.zeros((), device=device)
+        # confusion matrix of active labels: rows are targets, columns are predictions
+        tr_confusion = torch.zeros(num_labels * num_labels, dtype=torch.long, device=device)
+        nb_tr_examples, nb_tr_steps = 0, 0
+        if metrics is not None:
+            # continue the running metrics of an epoch resumed from a checkpoint
+            tr_loss_sum += metrics['loss_sum'].to(device)
+            tr_confusion += metrics['confusion'].to(device)
+            nb_tr_examples, nb_tr_steps = metrics['examples'], metrics['steps']
+        steps_per_epoch = math.ceil(self.train_sampler.num_samples / self.parameters['train_batch_size'])
+        # put model in training mode
+        train_model.train()
+        trainable_parameters = [p for p in model.parameters() if p.requires_grad]
+        epoch_start_time, epoch_start_step = time.time(), nb_tr_steps
+
+        for idx, batch in enumerate(self.training_loader, start=start_step):
+
+            inputs = get_model_inputs(batch, device)
+            labels = inputs['labels']
+
+            outputs = train_model(**inputs)
+            loss = outputs[0]
+            tr_logits = outputs[1]
+
+            nb_tr_steps += 1
+            nb_tr_examples += labels.size(0)
+
+            # backward pass
+            optimizer.zero_grad()
+            loss.backward()
+
+            # gradient clipping
+            torch.nn.utils.clip_grad_norm_(
+                parameters=trainable_parameters, max_norm=self.parameters['max_grad_norm']
+            )
+
+            optimizer.step()
+
+            # accumulate training metrics at active labels only
+            with torch.no_grad():
+                tr_loss_sum += loss.detach()
+                flattened_targets = labels.view(-1) # shape (batch_size * seq_len,)
+                active_logits = tr_logits.view(-1, num_labels) # shape (batch_size * seq_len, num_labels)
+                flattened_predictions = torch.argmax(active_logits, axis=1) # shape (batch_size * seq_len,)
+                active_accuracy = flattened_targets != -100 # shape (batch_size * seq_len,)
+                # inactive positions are scattered with weight 0, which avoids the host sync of masked_select
+                confusion_index = torch.where(active_accuracy, flattened_targets * num_labels + flattened_predictions,
+                                              torch.zeros_like(flattened_targets))
+                tr_confusion.scatter_add_(0, confusion_index, active_accuracy.long())
+
+            if log_interval > 0 and idx % log_interval == 0 and self.is_main_process:
+                loss_step = tr_loss_sum.item() / nb_tr_steps
+                print(f"Training loss per {log_interval} training steps: {loss_step}")
+
+            self.global_step += 1
+            if checkpoint_interval > 0 and self.global_step % checkpoint_interval == 0 and idx + 1 < steps_per_epoch:
+                self.save_training_state(epoch, idx + 1, {'loss_sum': tr_loss_sum, 'confusion': tr_confusion,
+                                                          'examples': nb_tr_examples, 'steps': nb_tr_steps})
+
+        step_seconds = (time.time() - epoch_start_time) / max(nb_tr_steps - epoch_start_step, 1)
+        self.step_seconds.append(step_seconds)
+        if self.distributed:
+            # combine the metrics of all processes; every process runs the same number of steps
+            dist.all_reduce(tr_loss_sum)
+            dist.all_reduce(tr_confusion)
+            nb_tr_steps *= self.world_size
+        epoch_loss = tr_loss_sum.item() / nb_tr_steps
+        confusion = tr_confusion.view(num_labels, num_labels).cpu().numpy()
+        tr_accuracy = confusion.trace() / max(confusion.sum(), 1)
+        if self.is_main_process:
+            print(f"Training loss epoch: {epoch_loss}")
+            print(f"Training accuracy epoch: {tr_accuracy}")
+            print(f"Training step time: {step_seconds:.3f}s ({self.trainable_parameters} trainable parameters)")
+            for label_id in range(num_labels):
+                support = confusion[label_id].sum()
+                if support > 0:
+                    print(f"\t{self.ids_to_labels[label_id]}: {confusion[label_id, label_id] / support} "
+                          f"({support} tokens)")
+        return epoch_loss, tr_accuracy
+
+    def fit(self):
+        '''
+        Train until the last epoch or early stopping, and return the results of the run
+        '''
+        parameters = self.parameters
+        training_start_time = time.time()
+        epochs_trained = self.start_epoch
+        for epoch in range(self.start_epoch, parameters['epochs']):
+            print(f"Training epoch: {epoch + 1}")
+            epoch_start_step = self.start_step if epoch == self.start_epoch else 0
+            self.train_sampler.set_epoch(epoch, start_index=epoch_start_step * parameters['train_batch_size'])
+            epoch_loss, tr_accuracy = self.train(epoch, epoch_start_step,
+                                                 self.resume_metrics if epoch == self.start_epoch else None)
+            epochs_trained = epoch + 1
+
+            model_prefix = f'{self.output_dir}/{epoch + 1}_acc_{tr_accuracy}'
+            save_model, stop_training = not (self.has_holdout and parameters['save_best_only']), False
+            is_best_model = not self.has_holdout
+            if self.has_holdout and (epoch + 1) % parameters['eval_interval'] == 0:
+                # rank 0 evaluates and shares the early stopping decision with the other processes
+                if self.is_main_process:
+                    f1, save_model, stop_training = self.evaluate_holdout()
+                    model_prefix = f'{model_prefix}_f1_{f1}'
+                    is_best_model = self.early_stopping['evaluations_without_improvement'] == 0
+                if self.distributed:
+                    stop_flag = torch.tensor([int(stop_training)])
+                    dist.broadcast(stop_flag, src=0)
+                    stop_training = bool(stop_flag.item())
+
+            model_state = snapshot(self.model.state_dict()) if self.is_main_process else None
+            if is_best_model or self.bundle_model_state is None:
+                self.bundle_model_state = model_state
+                self.early_stopping['bundle_model_prefix'] = model_prefix if save_model else None
+            if self.is_main_process and save_model:
+                replaced_model_prefix = None
+                if parameters['save_best_only'] and self.has_holdout:
+                    replaced_model_prefix = self.early_stopping['best_model_prefix']
+                    self.early_stopping['best_model_prefix'] = model_prefix
+                self.checkpoint_writer.submit(self.save_epoch_model, model_state, model_prefix, replaced_model_prefix)
+            if stop_training:
+                # no checkpoint past the last epoch, a resumed run does not train beyond the early stop
+                print(f"Early stopping: no holdout F1 improvement for {parameters['early_stopping_patience']} "
+                      f"evaluations, best F1 {self.early_stopping['best_f1']}")
+                break
+            self.save_training_state(epoch + 1, 0, model_state=model_state)
+
+        bundle_dir = parameters['bundle_dir'] or os.path.join(self.output_dir, 'model_bundle')
+        results = {'best_f1': self.early_stopping['best_f1'],
+                   'best_result': self.early_stopping['best_result'],
+                   'best_model_prefix': self.early_stopping['best_model_prefix'],
+                   'model_bundle': bundle_dir,
+                   'epochs': epochs_trained,
+                   'global_steps': self.global_step,
+                   'trainable_parameters': self.trainable_parameters,
+                   'total_parameters': self.total_parameters,
+                   'step_seconds': float(np.mean(self.step_seconds)) if self.step_seconds else None,
+                   'training_seconds': time.time() - training_start_time}
+        if self.is_main_process:
+            if self.bundle_model_state is not None:
+                inference_config = {'max_len': parameters['max_len'], 'model_name': parameters['model_name']}
+                self.checkpoint_writer.submit(save_model_bundle, bundle_dir, self.model, self.tokenizer,
+                                              self.ids_to_labels, inference_config, state_dict=self.bundle_model_state)
+            self.checkpoint_writer.close()
+            if parameters['results_file']:
+                with open(parameters['results_file'], 'w') as handle:
+                    json.dump(results, handle, indent=2)
+        return results
+
+
+class HeadTrainer:
+    '''
+    Head-only training run: the encoder (of parameters['encoder_bundle'] or parameters['model_name']) is frozen and
+    runs once over the corpus, and only a linear classification head on the features of feature_layer is trained, for
+    many epochs at the cost of a matrix product per batch. The result is exported as a model bundle with the encoder
+    layers up to feature_layer and the trained head.
+    '''
+    def __init__(self, parameters, corpus=None):
+        self.parameters = utils.merge_dictionaries(DEFAULT_PARAMETERS, parameters or {})
+        parameters = self.parameters
+        self.device = 'cuda' if cuda.is_available() else 'cpu'
+        print(self.device)
+        set_seed(parameters['seed'])
+        self.generator = torch.Generator().manual_seed(parameters['seed'])
+
+        self.corpus = corpus if corpus is not None else read_conll(parameters['filepath'])
+        print(len(self.corpus))
+        self.label_dict, self.labels_to_ids, self.ids_to_labels = load_or_dump_label_maps(
+            self.corpus.label_vocabulary, parameters['label_dir'])
+        self.data = get_sentence_dataframe(self.corpus)
+        train_dataset, validation_dataset = split_data(self.data, parameters)
+        self.has_holdout = validation_dataset is not None
+        self.output_dir = parameters['output_dir']
+        utils.create_folder_if_not_exists(self.output_dir)
+
+        previous_labels_to_ids, previous_classifier = {}, None
+        if parameters['encoder_bundle']:
+            bundle = load_model_bundle(parameters['encoder_bundle'], device=self.device)
+            self.encoder_model, self.tokenizer = bundle.model, bundle.tokenizer
+            encoder_id = bundle.manifest['files'][WEIGHTS_FILENAME]['sha256']
+            previous_labels_to_ids, previous_classifier = bundle.labels_to_ids, bundle.model.classifier
+        else:
+            self.tokenizer = get_tokenizer(parameters['model_name'])
+            self.encoder_model = BertForTokenClassification.from_pretrained(parameters['model_name'],
+                                                                            num_labels=len(self.label_dict))
+            self.encoder_model.to(self.device)
+            encoder_id = parameters['model_name']
+        encoder_layers = self.encoder_model.config.num_hidden_layers
+        feature_layer = parameters['feature_layer']
+        # number of encoder layers the features go through, which is also their index in hidden_states
+        self.num_layers = feature_layer if feature_layer >= 0 else encoder_layers + 1 + feature_layer
+        if not 0 <= self.num_layers <= encoder_layers:
+            raise ValueError("feature_layer must be between {0} and {1}, got {2}".format(
+                -encoder_layers - 1, encoder_layers, feature_layer))
+
+        start_time = time.time()
+        self.features, self.sequence_indices = load_or_compute_features(
+            self.encoder_model, self.tokenizer, self.data['tokens'].tolist(), self.num_layers, parameters['max_len'],
+            parameters['feature_cache_dir'], encoder_id, self.device, parameters['valid_batch_size'] * 16)
+        self.feature_seconds = time.time() - start_time
+        self.train_words = self.get_words(train_dataset)
+        if self.has_holdout:
+            self.validation_words = self.get_words(validation_dataset)
+        print(f"Head-only training on {len(self.train_words[0])} words, features of layer {self.num_layers} "
+              f"({self.features.hidden_size} dimensions)")
+
+        self.head = torch.nn.Linear(self.features.hidden_size, len(self.ids_to_labels)).to(self.device)
+        if previous_classifier is not None and self.num_layers == encoder_layers:
+            # the labels the bundle already has start from its head
+            with torch.no_grad():
+                for label, label_id in self.labels_to_ids.items():
+                    if label in previous_labels_to_ids:
+                        self.head.weight[label_id] = previous_classifier.weight[previous_labels_to_ids[label]]
+                        self.head.bias[label_id] = previous_classifier.bias[previous_labels_to_ids[label]]
+        self.dropout = torch.nn.Dropout(self.encoder_model.config.hidden_dropout_prob)
+        self.optimizer = ChildTuningAdamW(params=self.head.parameters(), lr=parameters['head_learning_rate'])
+        self.early_stopping = {'best_f1': None, 'best_result': None, 'evaluations_without_improvement': 0}
+        self.bundle_head_state = None
+
+    def get_words(self, dataframe):
+        '''
+        Feature rows, label ids and sentence starts of the words of the sentences of dataframe
+        '''
+        word_counts = dataframe['labels'].map(len).values
+        rows, lengths = self.features.get_word_rows(self.sequence_indices[dataframe['sentence_id'].values],
+                                                    word_counts)
+        label_ids = np.fromiter((self.labels_to_ids[label] for labels, length in zip(dataframe['labels'], lengths)
+                                 for label in labels[:length]), dtype=np.int64, count=int(lengths.sum()))
+        sentence_starts = np.zeros(len(rows), dtype=bool)
+        sentence_starts[(np.cumsum(lengths) - lengths)[lengths > 0]] = True
+        return rows, label_ids, sentence_starts
+
+    def get_features(self, rows):
+        return torch.as_tensor(np.asarray(self.features.features[rows], dtype=np.float32), device=self.device)
+
+    def train(self):
+        rows, label_ids, _ = self.train_words
+        batch_size = self.parameters['head_batch_size']
+        order = torch.randperm(len(rows), generator=self.generator).numpy()
+        self.head.train()
+        loss_sum, steps = 0.0, 0
+        for start in range(0, len(order), batch_size):
+            # sorted positions read the memory-mapped features in order
+            batch = np.sort(order[start:start + batch_size])
+            logits = self.head(self.dropout(self.get_features(rows[batch])))
+            loss = torch.nn.functional.cross_entropy(logits, torch.as_tensor(label_ids[batch], device=self.device))
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            loss_sum += loss.item()
+            steps += 1
+        return loss_sum / max(steps, 1)
+
+    def evaluate_holdout(self):
+        rows, label_ids, sentence_starts = self.validation_words
+        self.head.eval()
+        predictions = []
+        with torch.no_grad():
+            for start in range(0, len(rows), self.parameters['head_batch_size']):
+                logits = self.head(self.get_features(rows[start:start + self.parameters['head_batch_size']]))
+                predictions.append(torch.argmax(logits, axis=-1).cpu().numpy())
+        evaluator = EntityEvaluator(self.ids_to_labels)
+        evaluator.update_batch(label_ids, np.concatenate(predictions) if predictions else [], sentence_starts)
+        return evaluator.compute()
+
+    def get_model(self, head_state):
+        '''
+        Token classification model of the encoder layers up to feature_layer and the head
+        '''
+        model = copy.deepcopy(self.encoder_model).cpu()
+        model.base_model.encoder.layer = model.base_model.encoder.layer[:self.num_layers]
+        model.config.num_hidden_layers = self.num_layers
+        if getattr(model.config, PRUNED_LAYERS_KEY, None):
+            setattr(model.config, PRUNED_LAYERS_KEY, getattr(model.config, PRUNED_LAYERS_KEY)[:self.num_layers])
+        model.classifier = torch.nn.Linear(self.features.hidden_size, len(self.ids_to_labels))
+        model.classifier.load_state_dict(head_state)
+        model.num_labels = len(self.ids_to_labels)
+        return model
+
+    def fit(self):
+        parameters = self.parameters
+        training_start_time = time.time()
+        epochs_trained = 0
+        for epoch in range(parameters['head_epochs']):
+            epoch_loss = self.train()
+            epochs_trained = epoch + 1
+            is_best_model, stop_training = not self.has_holdout, False
+            if self.has_holdout and (epoch + 1) % parameters['eval_interval'] == 0:
+                result = self.evaluate_holdout()
+                f1 = result['all']['f1']
+                print(f"Head epoch {epoch + 1}: loss {epoch_loss}, holdout entity F1 {f1}")
+                early_stopping = self.early_stopping
+                is_best_model = early_stopping['best_f1'] is None or \
+                    f1 > early_stopping['best_f1'] + parameters['early_stopping_min_delta']
+                if is_best_model:
+                    early_stopping.update({'best_f1': f1, 'best_result': result,
+                                           'evaluations_without_improvement': 0})
+                else:
+                    early_stopping['evaluations_without_improvement'] += 1
+                stop_training = 0 < parameters['head_early_stopping_patience'] <= \
+                    early_stopping['evaluations_without_improvement']
+            if is_best_model or self.bundle_head_state is None:
+                self.bundle_head_state = snapshot(self.head.state_dict())
+            if stop_training:
+                print(f"Early stopping: no holdout F1 improvement for {parameters['head_early_stopping_patience']} "
+                      f"evaluations, best F1 {self.early_stopping['best_f1']}")
+                break
+
+        bundle_dir = parameters['bundle_dir'] or os.path.join(self.output_dir, 'model_bundle')
+        model = self.get_model(self.bundle_head_state)
+        inference_config = {'max_len': parameters['max_len'],
+                            'model_name': parameters['encoder_bundle'] or parameters['model_name'],
+                            'feature_layer': self.num_layers}
+        save_model_bundle(bundle_dir, model, self.tokenizer, self.ids_to_labels, inference_config)
+        print(f"Model bundle written to {bundle_dir}")
+        results = {'best_f1': self.early_stopping['best_f1'],
+                   'best_result': self.early_stopping['best_result'],
+                   'best_model_prefix': None,
+                   'model_bundle': bundle_dir,
+                   'epochs': epochs_trained,
+                   'trainable_parameters': sum(p.numel() for p in self.head.parameters()),
+                   'total_parameters': sum(p.numel() for p in model.parameters()),
+                   'feature_seconds': self.feature_seconds,
+                   'training_seconds': time.time() - training_start_time}
+        if parameters['results_file']:
+            with open(parameters['results_file'], 'w') as handle:
+                json.dump(results, handle, indent=2)
+        return results
+
+
+def train_ner(parameters=None, corpus=None):
+    '''
+    Train a model with the given parameters (see DEFAULT_PARAMETERS) and return the results of the run.
+    A ConllCorpus that was already read can be passed to skip parsing parameters['filepath'].
+    '''
+    trainer_class = HeadTrainer if (parameters or {}).get('head_only') else NERTrainer
+    return trainer_class(parameters, corpus).fit()
+
+
+def parse_arguments(arguments=None):
+    '''
+    Command line options of the parameters, only the given ones override DEFAULT_PARAMETERS
+    '''
+    parser = argparse.ArgumentParser(description='Train the NER model')
+    parser.add_argument('--filepath', default=None, help='CoNLL training data')
+    parser.add_argument('--resume', action='store_true', default=None,
+                        help='continue from the latest training-state checkpoint in --checkpoint_dir')
+    parser.add_argument('--checkpoint_dir', default=None,
+                        help='folder of the training-state checkpoints (must be shared by all nodes of a distributed '
+                             'run), default: {output_dir}/checkpoints')
+    parser.add_argument('--output_dir', default=None, help='folder of the trained models, default: output')
+    parser.add_argument('--label_dir', default=None, help='folder of the label pickles, default: output')
+    parser.add_argument('--model_name', default=None, help='pretrained tokenizer and model')
+    parser.add_argument('--learning_rate', type=float, default=None)
+    parser.add_argument('--max_len', type=int, default=None)
+    parser.add_argument('--batch_size', dest='train_batch_size', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=None)
+    parser.add_argument('--optimizer_mode', default=None, choices=['none', 'ChildTuning-D', 'ChildTuning-F'])
+    parser.add_argument('--reserve_p', type=float, default=None)
+    parser.add_argument('--freeze_embeddings', action='store_true', default=None,
+                        help='partial fine-tuning: do not train the embedding layer')
+    parser.add_argument('--freeze_layers', type=int, default=None,
+                        help='partial fine-tuning: number of lower encoder layers to freeze')
+    parser.add_argument('--training_option', type=int, default=None, choices=[1, 2, 3, 4])
+    parser.add_argument('--num_folds', type=int, default=None,
+                        help='k-fold cross-validation: hold out fold --fold of --num_folds folds')
+    parser.add_argument('--fold', type=int, default=None)
+    parser.add_argument('--pack_sequences', action='store_true', default=None,
+                        help='pack several training sentences into each sequence of --max_len tokens')
+    parser.add_argument('--tokenized_cache_dir', default=None,
+                        help='folder to cache the tokenized dataset in, shared between runs')
+    parser.add_argument('--results_file', default=None, help='write the holdout results of the run to this json file')
+    parser.add_argument('--bundle_dir', default=None,
+                        help='folder of the model bundle of the best model, default: {output_dir}/model_bundle')
+    parser.add_argument('--cpu_affinity', default=None, type=lambda cores: [int(core) for core in cores.split(',')],
+                        help='comma-separated ids of the cores to pin the process to')
+    parser.add_argument('--head_only', action='store_true', default=None,
+                        help='freeze the encoder and only train the classification head, from cached encoder features')
+    parser.add_argument('--encoder_bundle', default=None,
+                        help='head-only training: model bundle to take the encoder from, instead of --model_name')
+    parser.add_argument('--feature_layer', type=int, default=None,
+                        help='head-only training: encoder layer of the features (0: embeddings, default -1: last)')
+    parser.add_argument('--feature_cache_dir', default=None,
+                        help='head-only training: folder of the encoder feature cache, default: output/feature_cache')
+    parser.add_argument('--head_epochs', type=int, default=None)
+    parser.add_argument('--head_learning_rate', type=float, default=None)
+    parser.add_argument('--head_early_stopping_patience', type=int, default=None,
+                        help='head-only training: holdout evaluations without F1 improvement before training stops '
+                             '(default 15, 0 disables it)')
+    args = parser.parse_args(arguments)
+
+    parameters = {name: value for name, value in vars(args).items() if value is not None}
+    if parameters.get('optimizer_mode') == 'none':
+        parameters['optimizer_mode'] = None
+    if args.num_folds and args.training_option is None:
+        parameters['training_option'] = 4
+    return parameters
+
+
+def main():
+    os.environ['CUDA_VISIBLE_DEVICES'] = '0'
+    parameters = parse_arguments()
+    if parameters.get('cpu_affinity') and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, parameters['cpu_affinity'])
+    train_ner(parameters)
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
 import codecs
+import hashlib
+import heapq
+import json
 import os
 import re
 
 import numpy as np
 
 import local_utils as utils
+from conll_io import open_conll
+from embedding_store import is_embedding_store, load_embedding_store
 
 
 def load_tokens_from_pretrained_token_embeddings(parameters):
+    '''
+    Tokens of the pretrained embeddings; for an embedding store (see embedding_store.py), the memory-mapped store,
+    which supports `token in tokens` without loading the tokens
+    '''
+    if is_embedding_store(parameters['token_pretrained_embedding_filepath']):
+        return load_embedding_store(parameters['token_pretrained_embedding_filepath'])
     file_input = codecs.open(parameters['token_pretrained_embedding_filepath'], 'r', 'UTF-8')
     count = -1
     tokens = set()
@@ -25,6 +36,12 @@ def load_tokens_from_pretrained_token_embeddings(parameters):
 
 
 def load_pretrained_token_embeddings(parameters):
+    '''
+    Dict of the pretrained vector of every token; for an embedding store (see embedding_store.py), the memory-mapped
+    store, which can be used like the dict
+    '''
+    if is_embedding_store(parameters['token_pretrained_embedding_filepath']):
+        return load_embedding_store(parameters['token_pretrained_embedding_filepath'])
     file_input = codecs.open(parameters['token_pretrained_embedding_filepath'], 'r', 'UTF-8')
     count = -1
     token_to_vector = {}
@@ -73,6 +90,24 @@ def get_parsed_conll_output(conll_output_filepath):
     return parsed_output
 
 
+def evaluate_conll_output(conll_output_filepath):
+    '''
+    conlleval scores of a space separated CoNLL file whose last two columns are the gold and the predicted labels, in
+    the dict of get_parsed_conll_output, computed without running conlleval
+    '''
+    from ner_evaluation import EntityEvaluator
+    label_index = {}
+    evaluator = EntityEvaluator({})
+    for _, token_lines, _, sentence_starts in read_conll_chunks(conll_output_filepath):
+        split_lines = [token_line.rpartition(' ') for token_line in token_lines]
+        label_ids = get_label_ids([split_line[0].rpartition(' ')[2] for split_line in split_lines], label_index)
+        prediction_ids = get_label_ids([split_line[2] for split_line in split_lines], label_index)
+        if len(label_index) != len(evaluator.ids_to_labels):
+            evaluator.set_labels(dict(enumerate(label_index)))
+        evaluator.update_batch(label_ids, prediction_ids, sentence_starts)
+    return evaluator.compute()
+
+
 def remove_bio_from_label_name(label_name):
     if label_name[:2] in ['B-', 'I-', 'E-', 'S-']:
         new_label_name = label_name[2:]
@@ -86,131 +121,297 @@ def replace_unicode_whitespaces_with_ascii_whitespace(string):
     return ' '.join(string.split())
 
 
-def end_current_entity(previous_label_without_bio, current_entity_length, new_labels, i):
+def get_first_overlapping_entities(tokens, entities):
+    '''
+    For every token (dicts with 'start' and 'end', in text order), the first entity in order of start offset (then in
+    annotation order) that overlaps it, or None. Empty entities (start == end) never overlap a token.
+    One sweep over tokens and entities: entities enter a heap (keyed by their rank) once they start before the end of
+    the current token, and leave it once they end before its start, so the cost is O((tokens + entities) log entities)
+    instead of scanning the entities for every token.
+    '''
+    entities = sorted(entities, key=lambda entity: entity['start'])
+    overlapping_entities = []
+    active_entities = []  # heap of entity ranks, may still contain entities that ended before the current token
+    next_entity = 0
+    for token in tokens:
+        while next_entity < len(entities) and entities[next_entity]['start'] < token['end']:
+            if entities[next_entity]['start'] < entities[next_entity]['end']:
+                heapq.heappush(active_entities, next_entity)
+            next_entity += 1
+        # tokens are in text order, an entity that ends before this token cannot overlap any later token either
+        while active_entities and entities[active_entities[0]]['end'] <= token['start']:
+            heapq.heappop(active_entities)
+        overlapping_entities.append(entities[active_entities[0]] if active_entities else None)
+    return overlapping_entities
+
+
+def get_bio_labels_from_entities(sentences, entities):
+    '''
+    BIO labels of the tokens of sentences (lists of token dicts in text order) from entity annotations.
+    A token takes the type of the first entity (by start offset) that overlaps it, so with overlapping or nested
+    entities the outer / earlier one wins until it ends, and the tokens after its end take the type of the next one.
+    A token continues the entity of the previous token (I-) if it has the same type and the previous token did not end
+    at the end of its entity. Sets token['label'] to the entity type ('-' replaced with '_') or 'O'.
+    '''
+    overlapping_entities = get_first_overlapping_entities([token for sentence in sentences for token in sentence],
+                                                          entities)
+    sentence_labels = []
+    position = 0
+    for sentence in sentences:
+        inside = False
+        previous_token_label = 'O'
+        labels = []
+        for token in sentence:
+            entity = overlapping_entities[position]
+            position += 1
+            # Because the ANN doesn't support tag with '-' in it
+            token['label'] = 'O' if entity is None else entity['type'].replace('-', '_')
+            if token['label'] == 'O':
+                gold_label = 'O'
+                inside = False
+            elif inside and token['label'] == previous_token_label:
+                gold_label = 'I-{0}'.format(token['label'])
+            else:
+                inside = True
+                gold_label = 'B-{0}'.format(token['label'])
+            if entity is not None and token['end'] == entity['end']:
+                inside = False
+            previous_token_label = token['label']
+            labels.append(gold_label)
+        sentence_labels.append(labels)
+    return sentence_labels
+
+
+BIOES_PREFIXES = ['B-', 'I-', 'E-', 'S-']
+# characters per chunk of the CoNLL files converted or checked at once
+CONLL_CHUNK_SIZE = 32 << 20
+
+
+def get_label_ids(labels, label_index):
+    '''
+    Ids of labels in label_index (label name: id), which is extended with the labels it does not have yet
+    '''
+    for label in set(labels) - label_index.keys():
+        label_index[label] = len(label_index)
+    return np.fromiter(map(label_index.__getitem__, labels), dtype=np.int64, count=len(labels))
+
+
+def get_label_prefixes_and_types(label_names):
+    prefixes = [label_name[:2] if label_name[:2] in BIOES_PREFIXES else 'O' for label_name in label_names]
+    return prefixes, [remove_bio_from_label_name(label_name) for label_name in label_names]
+
+
+def get_bio_to_bioes_tables(label_names):
+    '''
+    Transition tables of bio_to_bioes_ids over the ids of label_names, and the names of the output ids (label_names,
+    followed by the BIOES labels that are not in label_names):
+        continues[previous id, id]           whether the token continues the entity of the previous token
+        bioes_ids[id, is first, is last]     id of the BIOES label of a token, given its position in its entity
+    '''
+    prefixes, types = get_label_prefixes_and_types(label_names)
+    output_index = {label_name: i for i, label_name in enumerate(label_names)}
+    continues = np.zeros((len(label_names), len(label_names)), dtype=bool)
+    bioes_ids = np.empty((len(label_names), 2, 2), dtype=np.int64)
+    for i, (prefix, label_type) in enumerate(zip(prefixes, types)):
+        if prefix == 'I-':
+            continues[:, i] = [previous_prefix in ['B-', 'I-'] and previous_type == label_type
+                               for previous_prefix, previous_type in zip(prefixes, types)]
+        for is_first in [0, 1]:
+            for is_last in [0, 1]:
+                if prefix in ['B-', 'I-']:
+                    bioes_prefix = [['I-', 'E-'], ['B-', 'S-']][is_first][is_last]
+                    bioes_ids[i, is_first, is_last] = output_index.setdefault(bioes_prefix + label_type,
+                                                                              len(output_index))
+                else:
+                    bioes_ids[i, is_first, is_last] = i
+    return continues, bioes_ids, list(output_index)
+
+
+def get_bioes_to_bio_table(label_names):
+    '''
+    Transition table of bioes_to_bio_ids over the ids of label_names, and the names of the output ids (label_names,
+    followed by the BIO labels that are not in label_names):
+        bio_ids[previous id, id]   id of the BIO label of a token; the last row is the start of a sentence
+    '''
+    prefixes, types = get_label_prefixes_and_types(label_names)
+    output_index = {label_name: i for i, label_name in enumerate(label_names)}
+    bio_ids = np.empty((len(label_names) + 1, len(label_names)), dtype=np.int64)
+    for i, (prefix, label_type) in enumerate(zip(prefixes, types)):
+        for previous_id, previous_type in enumerate(types + ['O']):
+            if prefix in ['I-', 'E-'] and previous_type == label_type:
+                bio_ids[previous_id, i] = output_index.setdefault('I-' + label_type, len(output_index))
+            elif prefix in ['I-', 'E-', 'S-']:
+                bio_ids[previous_id, i] = output_index.setdefault('B-' + label_type, len(output_index))
+            else:
+                bio_ids[previous_id, i] = i
+    return bio_ids, list(output_index)
+
+
+def bio_to_bioes_ids(label_ids, sentence_starts, label_names):
+    '''
+    BIOES label ids of the BIO label ids of a whole corpus, whose sentences start where sentence_starts is True.
+    Returns the ids and their label names (see get_bio_to_bioes_tables).
+    '''
+    continues, bioes_ids, output_label_names = get_bio_to_bioes_tables(label_names)
+    is_continued = np.zeros(len(label_ids) + 1, dtype=bool)
+    is_continued[1:-1] = continues[label_ids[:-1], label_ids[1:]] & ~sentence_starts[1:]
+    return bioes_ids[label_ids, (~is_continued[:-1]).astype(np.int64), (~is_continued[1:]).astype(np.int64)], \
+        output_label_names
+
+
+def bioes_to_bio_ids(label_ids, sentence_starts, label_names):
     '''
-    Helper function for bio_to_bioes
+    BIO label ids of the BIOES label ids of a whole corpus, whose sentences start where sentence_starts is True.
+    Returns the ids and their label names (see get_bioes_to_bio_table).
     '''
-    if current_entity_length == 0:
-        return
-    if current_entity_length == 1:
-        new_labels[i - 1] = 'S-' + previous_label_without_bio
-    else:  # elif current_entity_length > 1
-        new_labels[i - 1] = 'E-' + previous_label_without_bio
+    bio_ids, output_label_names = get_bioes_to_bio_table(label_names)
+    previous_ids = np.empty(len(label_ids), dtype=np.int64)
+    previous_ids[1:] = label_ids[:-1]
+    previous_ids[sentence_starts] = len(label_names)
+    return bio_ids[previous_ids, label_ids], output_label_names
+
+
+def convert_labels(labels, conversion):
+    if len(labels) == 0:
+        return []
+    label_index = {}
+    label_ids = get_label_ids(labels, label_index)
+    sentence_starts = np.zeros(len(labels), dtype=bool)
+    sentence_starts[0] = True
+    new_label_ids, output_label_names = conversion(label_ids, sentence_starts, list(label_index))
+    return [output_label_names[label_id] for label_id in new_label_ids]
 
 
 def bio_to_bioes(labels):
-    previous_label_without_bio = 'O'
-    current_entity_length = 0
-    new_labels = labels.copy()
-    for i, label in enumerate(labels):
-        label_without_bio = remove_bio_from_label_name(label)
-        # end the entity
-        if current_entity_length > 0 and (
-                label[:2] in ['B-', 'O'] or label[:2] == 'I-' and previous_label_without_bio != label_without_bio):
-            end_current_entity(previous_label_without_bio, current_entity_length, new_labels, i)
-            current_entity_length = 0
-        if label[:2] == 'B-':
-            current_entity_length = 1
-        elif label[:2] == 'I-':
-            if current_entity_length == 0:
-                new_labels[i] = 'B-' + label_without_bio
-            current_entity_length += 1
-        previous_label_without_bio = label_without_bio
-    end_current_entity(previous_label_without_bio, current_entity_length, new_labels, i + 1)
-    return new_labels
+    return convert_labels(labels, bio_to_bioes_ids)
 
 
 def bioes_to_bio(labels):
-    previous_label_without_bio = 'O'
-    new_labels = labels.copy()
-    for i, label in enumerate(labels):
-        label_without_bio = remove_bio_from_label_name(label)
-        if label[:2] in ['I-', 'E-']:
-            if previous_label_without_bio == label_without_bio:
-                new_labels[i] = 'I-' + label_without_bio
-            else:
-                new_labels[i] = 'B-' + label_without_bio
-        elif label[:2] in ['S-']:
-            new_labels[i] = 'B-' + label_without_bio
-        previous_label_without_bio = label_without_bio
-    return new_labels
+    return convert_labels(labels, bioes_to_bio_ids)
+
+
+def get_file_sha256(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
 
-def check_bio_bioes_compatibility(labels_bio, labels_bioes):
-    if labels_bioes == []:
+def get_validity_filepath(conll_filepath):
+    return conll_filepath + '.valid.json'
+
+
+def is_recorded_as_valid(conll_filepath):
+    '''
+    Whether the checksum sidecar written by record_as_valid still matches conll_filepath: the size and modification
+    time, or else the sha256 of its content
+    '''
+    try:
+        with open(get_validity_filepath(conll_filepath)) as f:
+            validity = json.load(f)
+        stat = os.stat(conll_filepath)
+    except (OSError, ValueError):
+        return False
+    if validity.get('size') != stat.st_size:
+        return False
+    if validity.get('mtime_ns') == stat.st_mtime_ns:
         return True
-    new_labels_bio = bioes_to_bio(labels_bioes)
-    flag = True
-    if new_labels_bio != labels_bio:
-        print("Not valid.")
-        flag = False
-    del labels_bio[:]
-    del labels_bioes[:]
-    return flag
+    if validity.get('sha256') != get_file_sha256(conll_filepath):
+        return False
+    record_as_valid(conll_filepath, validity['sha256'])
+    return True
 
 
-def check_validity_of_conll_bioes(bioes_filepath):
-    dataset_type = utils.get_basename_without_extension(bioes_filepath).split('_')[0]
-    print("Checking validity of CONLL BIOES format... ".format(dataset_type), end='')
+def record_as_valid(conll_filepath, sha256=None):
+    stat = os.stat(conll_filepath)
+    validity = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'sha256': sha256 or get_file_sha256(conll_filepath)}
+    with open(get_validity_filepath(conll_filepath), 'w') as f:
+        json.dump(validity, f)
 
-    input_conll_file = codecs.open(bioes_filepath, 'r', 'UTF-8')
-    labels_bioes = []
-    labels_bio = []
-    for line in input_conll_file:
-        split_line = line.strip().split(' ')
-        # New sentence
-        if len(split_line) == 0 or len(split_line[0]) == 0 or '-DOCSTART-' in split_line[0]:
-            if check_bio_bioes_compatibility(labels_bio, labels_bioes):
+
+def read_conll_chunks(conll_filepath, chunk_size=CONLL_CHUNK_SIZE):
+    '''
+    Lines of a space separated CoNLL file in chunks of about chunk_size characters that end at a sentence boundary.
+    Yields (lines, token lines without surrounding whitespace, positions of the token lines in lines,
+    sentence_starts).
+    '''
+    with open_conll(conll_filepath) as input_conll_file:
+        remaining_lines = []
+        while True:
+            new_lines = input_conll_file.readlines(chunk_size)
+            lines = remaining_lines + new_lines
+            if not lines:
+                return
+            stripped_lines = [line.strip() for line in lines]
+            # New sentence
+            is_boundary = np.array([not line or '-DOCSTART-' in line and '-DOCSTART-' in line.split(' ', 1)[0]
+                                    for line in stripped_lines], dtype=bool)
+            # keep the last, maybe incomplete, sentence for the next chunk
+            boundaries = np.flatnonzero(is_boundary)
+            end = len(lines) if not new_lines or len(boundaries) == 0 else boundaries[-1] + 1
+            if new_lines and len(boundaries) == 0:
+                remaining_lines = lines
                 continue
-            return False
-        label_bioes = split_line[-1]
-        label_bio = split_line[-2]
-        labels_bioes.append(label_bioes)
-        labels_bio.append(label_bio)
-    input_conll_file.close()
-    if check_bio_bioes_compatibility(labels_bio, labels_bioes):
-        print("Done.")
-        return True
-    return False
+            remaining_lines = lines[end:]
+            lines, is_boundary = lines[:end], is_boundary[:end]
+            token_positions = np.flatnonzero(~is_boundary)
+            sentence_starts = np.concatenate([[True], is_boundary[:-1]])[token_positions]
+            token_lines = [stripped_lines[position] for position in token_positions.tolist()]
+            yield lines, token_lines, token_positions, sentence_starts
 
 
-def output_conll_lines_with_bioes(split_lines, labels, output_conll_file):
+def check_validity_of_conll_bioes(bioes_filepath, use_validity_record=True):
     '''
-    Helper function for convert_conll_from_bio_to_bioes
+    Check that the BIOES labels (last column) of bioes_filepath convert back to its BIO labels (second to last column).
+    A valid file is recorded in a checksum sidecar ({bioes_filepath}.valid.json), and not read again as long as it
+    does not change.
     '''
-    if labels == []:
-        return
-    new_labels = bio_to_bioes(labels)
-    assert (len(new_labels) == len(split_lines))
-    for split_line, new_label in zip(split_lines, new_labels):
-        output_conll_file.write(' '.join(split_line + [new_label]) + '\n')
-    del labels[:]
-    del split_lines[:]
+    dataset_type = utils.get_basename_without_extension(bioes_filepath).split('_')[0]
+    print("Checking validity of CONLL BIOES format... ".format(dataset_type), end='')
+    if use_validity_record and is_recorded_as_valid(bioes_filepath):
+        print("Done.")
+        return True
+    label_index = {}
+    for _, token_lines, _, sentence_starts in read_conll_chunks(bioes_filepath):
+        split_lines = [token_line.rpartition(' ') for token_line in token_lines]
+        labels_bio = get_label_ids([split_line[0].rpartition(' ')[2] for split_line in split_lines], label_index)
+        labels_bioes = get_label_ids([split_line[2] for split_line in split_lines], label_index)
+        new_labels_bio, _ = bioes_to_bio_ids(labels_bioes, sentence_starts, list(label_index))
+        if not np.array_equal(new_labels_bio, labels_bio):
+            print("Not valid.")
+            return False
+    if use_validity_record:
+        record_as_valid(bioes_filepath)
+    print("Done.")
+    return True
 
 
 def convert_conll_from_bio_to_bioes(input_conll_filepath, output_conll_filepath):
+    '''
+    Append the BIOES labels of the BIO labels (last column) of input_conll_filepath as a new column, converting the
+    whole file chunk by chunk. Nothing is done if output_conll_filepath is already valid.
+    '''
     if os.path.exists(output_conll_filepath):
         if check_validity_of_conll_bioes(output_conll_filepath):
             return
     dataset_type = utils.get_basename_without_extension(input_conll_filepath).split('_')[0]
     print("Converting CONLL from BIO to BIOES format... ".format(dataset_type), end='')
-    input_conll_file = codecs.open(input_conll_filepath, 'r', 'UTF-8')
-    output_conll_file = codecs.open(output_conll_filepath, 'w', 'UTF-8')
-
-    labels = []
-    split_lines = []
-    for line in input_conll_file:
-        split_line = line.strip().split(' ')
-        # New sentence
-        if len(split_line) == 0 or len(split_line[0]) == 0 or '-DOCSTART-' in split_line[0]:
-            output_conll_lines_with_bioes(split_lines, labels, output_conll_file)
-            output_conll_file.write(line)
-            continue
-        label = split_line[-1]
-        labels.append(label)
-        split_lines.append(split_line)
-    output_conll_lines_with_bioes(split_lines, labels, output_conll_file)
-
-    input_conll_file.close()
-    output_conll_file.close()
-    print("Done.")
\ No newline at end of file
+    label_index = {}
+    is_valid = True
+    with open_conll(output_conll_filepath, 'w') as output_conll_file:
+        for lines, token_lines, token_positions, sentence_starts in read_conll_chunks(input_conll_filepath):
+            labels = get_label_ids([token_line.rpartition(' ')[2] for token_line in token_lines], label_index)
+            label_names = list(label_index)
+            new_labels, output_label_names = bio_to_bioes_ids(labels, sentence_starts, label_names)
+            # the output is valid if its BIOES labels convert back to the input labels
+            labels_bio, _ = bioes_to_bio_ids(new_labels, sentence_starts, output_label_names)
+            is_valid = is_valid and np.array_equal(labels_bio, labels)
+            for token_position, token_line, new_label in zip(token_positions.tolist(), token_lines,
+                                                             new_labels.tolist()):
+                lines[token_position] = '{0} {1}\n'.format(token_line, output_label_names[new_label])
+            output_conll_file.write(''.join(lines))
+    if is_valid:
+        record_as_valid(output_conll_filepath)
+    print("Done.")